@@ -0,0 +1,181 @@
+# -*- coding: utf-8 -*-
+# vim: set fileencoding=utf-8:tabstop=4:softtabstop=4:shiftwidth=4:expandtab:textwidth=120
+
+"""
+    Copyright 2019 Samuel Déal
+
+    This file is part of Malice.
+
+    Malice is free software: you can redistribute it and/or modify
+    it under the terms of the GNU General Public License as published by
+    the Free Software Foundation, either version 3 of the License, or
+    (at your option) any later version.
+
+    This program is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU General Public License for more details.
+
+    You should have received a copy of the GNU General Public License
+    along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+    Static description of the malice command line.
+    This module is loaded on every invocation (including each shell completion request), so it must stay cheap:
+    the modules implementing the commands are only imported when a command is dispatched.
+"""
+
+# Python core libraries
+import collections
+
+
+Group = collections.namedtuple("Group", ("name", "help"))
+Command = collections.namedtuple("Command", ("group", "name", "module", "function", "help", "arguments"))
+Argument = collections.namedtuple("Argument", ("flags", "options"))
+
+
+def arg(*flags, **options):
+    """
+    Describe a command argument, with the same parameters as argparse.ArgumentParser.add_argument
+
+    :param flags:       The argument name or flags
+    :type flags:        str
+    :param options:     The add_argument options
+    :type options:      any
+    :return:            The argument description
+    :rtype:             Argument
+    """
+    return Argument(flags, options)
+
+
+GROUPS = (
+    Group("conf", "Manage the infrastructure configuration"),
+    Group("dev", "Manage the development environment"),
+    Group("self", "Manage malice itself"),
+    Group("daemon", "Manage the malice background daemon"),
+)
+
+COMMANDS = (
+    Command("conf", "generate", "malice.core.conf", "generate", "Generate the configuration from the config modules", (
+        arg("-j", "--jobs", type=int, metavar="N", help="The number of modules rendered in parallel (number of CPUs)"),
+    )),
+    Command("dev", "start", "malice.core.dev", "start", "Start the development services", (
+        arg("-w", "--watch", action="store_true", help="Restart the services when their files change"),
+        arg("services", nargs="*", metavar="SERVICE", help="The services to start, all of them by default"),
+    )),
+    Command("dev", "restart", "malice.core.dev", "restart", "Restart the development services", (
+        arg("services", nargs="*", metavar="SERVICE", help="The services to restart, all of them by default"),
+    )),
+    Command("dev", "stop", "malice.core.dev", "stop", "Stop the development services", (
+        arg("services", nargs="*", metavar="SERVICE", help="The services to stop, all of them by default"),
+    )),
+    Command("dev", "kill", "malice.core.dev", "kill", "Kill the development services", (
+        arg("services", nargs="*", metavar="SERVICE", help="The services to kill, all of them by default"),
+    )),
+    Command("dev", "status", "malice.core.dev", "status", "Show the status of the development services", (
+        arg("services", nargs="*", metavar="SERVICE", help="The services to show, all of them by default"),
+    )),
+    Command("dev", "logs", "malice.core.dev", "logs", "Show the development services logs", (
+        arg("-f", "--follow", action="store_true", help="Keep printing the new log lines"),
+        arg("--tail", type=int, default=10, metavar="N", help="The number of lines to show per log file (10)"),
+        arg("services", nargs="*", metavar="SERVICE", help="The services to show, all of them by default"),
+    )),
+    Command("dev", "clean", "malice.core.dev", "clean", "Clean the development artifacts", (
+        arg("--dry-run", action="store_true", help="Only show what would be removed"),
+    )),
+    Command("self", "check", "malice.core.self", "check", "Check the malice installation", (
+        arg("--refresh", action="store_true", help="Run all the checks again, ignoring the cached results"),
+    )),
+    Command("self", "bench", "malice.core.self", "bench", "Benchmark the malice hot paths", (
+        arg("only", nargs="*", metavar="BENCHMARK", help="The benchmarks to run, all of them by default"),
+        arg("--quick", action="store_true", help="Smaller runs: faster, less precise"),
+        arg("-o", "--output", metavar="FILE", help="Write the json results to FILE"),
+        arg("--baseline", metavar="FILE", help="Compare to previous results, exit with 1 on regression"),
+        arg("--threshold", type=float, default=0.2, help="The tolerated difference with the baseline (0.2)"),
+    )),
+    Command("daemon", "start", "malice.daemon", "start", "Start the background daemon", ()),
+    Command("daemon", "stop", "malice.daemon", "stop", "Stop the background daemon", ()),
+    Command("daemon", "status", "malice.daemon", "status", "Show the background daemon status", ()),
+)
+
+
+def argument_dest(argument):
+    """
+    Get the attribute name argparse will use to store an argument
+
+    :param argument:    The argument description
+    :type argument:     Argument
+    :return:            The destination attribute name
+    :rtype:             str
+    """
+    if "dest" in argument.options:
+        return argument.options["dest"]
+    names = [flag for flag in argument.flags if flag.startswith("--")] or list(argument.flags)
+    return names[0].lstrip("-").replace("-", "_")
+
+
+def build_parser():
+    """
+    Build the malice argument parser from the command table
+
+    :return:        The command line parser
+    :rtype:         argparse.ArgumentParser
+    """
+    import argparse
+
+    parser = argparse.ArgumentParser(prog="malice", description='Manipulate docker for this project')
+    parser.add_argument("--config", "-c", metavar='FILE', help="Configuration file location")
+    parser.add_argument("--profile", metavar='FILE',
+                        help="Write a trace of the command (Chrome trace event format) and print its slowest steps")
+
+    subparsers = parser.add_subparsers(help='sub-command help', dest="command")
+    for group in GROUPS:
+        group_parser = subparsers.add_parser(group.name, help=group.help)
+        group_subparsers = group_parser.add_subparsers(help='sub-command help', dest="sub_command")
+        for command in COMMANDS:
+            if command.group != group.name:
+                continue
+            command_parser = group_subparsers.add_parser(command.name, help=command.help)
+            for argument in command.arguments:
+                command_parser.add_argument(*argument.flags, **argument.options)
+    return parser
+
+
+def find_command(group, name):
+    """
+    Find a command in the command table
+
+    :param group:   The command group, ex: "dev"
+    :type group:    str
+    :param name:    The command name, ex: "start"
+    :type name:     str|None
+    :return:        The command description, None if not found
+    :rtype:         Command|None
+    """
+    for command in COMMANDS:
+        if command.group == group and command.name == name:
+            return command
+    return None
+
+
+def dispatch(command, args):
+    """
+    Import the module implementing a command and call it.
+    Each declared argument is passed as a named parameter
+
+    :param command:     The command to run
+    :type command:      Command
+    :param args:        The parsed command line
+    :type args:         argparse.Namespace
+    :return:            The command function result
+    :rtype:             any
+    """
+    import importlib
+    from malice.util import trace_util
+
+    with trace_util.span("command.import", module=command.module):
+        module = importlib.import_module(command.module)
+    kwargs = {}
+    for argument in command.arguments:
+        dest = argument_dest(argument)
+        kwargs[dest] = getattr(args, dest)
+    return getattr(module, command.function)(**kwargs)
@@ -0,0 +1,429 @@
+# -*- coding: utf-8 -*-
+# vim: set fileencoding=utf-8:tabstop=4:softtabstop=4:shiftwidth=4:expandtab:textwidth=120
+
+"""
+    Copyright 2019 Samuel Déal
+
+    This file is part of Malice.
+
+    Malice is free software: you can redistribute it and/or modify
+    it under the terms of the GNU General Public License as published by
+    the Free Software Foundation, either version 3 of the License, or
+    (at your option) any later version.
+
+    This program is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU General Public License for more details.
+
+    You should have received a copy of the GNU General Public License
+    along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+    Benchmarks of the malice hot paths
+"""
+
+# Python core libraries
+import os
+import sys
+import json
+import time
+import shutil
+import tempfile
+import collections
+
+# Project specific libs
+from malice.util import proc_util
+
+
+def bench_named_pipe(count, payload_size, batch_size=100):
+    """
+    Measure the NamedPipe throughput between two processes
+
+    :param count:           The number of messages to send
+    :type count:            int
+    :param payload_size:    The size of each message, in bytes
+    :type payload_size:     int
+    :param batch_size:      The number of messages sent per put_many call. Optional, default 100
+    :type batch_size:       int
+    :return:                The measures: messages per second and MB per second
+    :rtype:                 dict[str, float]
+    """
+    tmp_dir = tempfile.mkdtemp(prefix="malice-bench-")
+    name = os.path.join(tmp_dir, "pipe")
+    try:
+        os.mkfifo(name + ".in")
+        os.mkfifo(name + ".out")
+        payload = os.urandom(payload_size)
+        pid = os.fork()
+        if pid == 0:
+            code = 0
+            try:
+                pipe = proc_util.NamedPipe(name, 1, serializer=proc_util.RawSerializer)
+                sent = 0
+                while sent < count:
+                    batch = min(batch_size, count - sent)
+                    pipe.put_many([payload] * batch)
+                    sent += batch
+                pipe.get()  # Wait for the reader to acknowledge before closing
+            except BaseException:
+                code = 1
+            finally:
+                os._exit(code)
+
+        pipe = proc_util.NamedPipe(name, 0, serializer=proc_util.RawSerializer)
+        start = time.perf_counter()
+        received = 0
+        while received < count:
+            msgs = pipe.get_many(min(batch_size, count - received))
+            if not msgs:
+                raise RuntimeError("Benchmark writer stopped early")
+            received += len(msgs)
+        duration = time.perf_counter() - start
+        pipe.put(b"")
+        pipe.close()
+        os.waitpid(pid, 0)
+    finally:
+        shutil.rmtree(tmp_dir, ignore_errors=True)
+    return {
+        "messages": count,
+        "payload_size": payload_size,
+        "seconds": duration,
+        "messages_per_sec": count / duration,
+        "mb_per_sec": count * payload_size / duration / (1024 * 1024),
+    }
+
+
+def percentiles(samples, points=(50, 95, 99)):
+    """
+    Compute percentiles of a list of measures
+
+    :param samples:     The measures
+    :type samples:      list[float]
+    :param points:      The percentiles to compute. Optional, default p50, p95 and p99
+    :type points:       tuple[int]
+    :return:            The percentiles, by name (ex: "p99")
+    :rtype:             dict[str, float]
+    """
+    ordered = sorted(samples)
+    return {"p" + str(point): ordered[min(len(ordered) - 1, int(len(ordered) * point / 100.0))] for point in points}
+
+
+def _exit_now():
+    os._exit(0)
+
+
+def bench_double_fork(count=200):
+    """
+    Measure the latency of proc_util.double_fork, from the call to the return in the parent
+
+    :param count:   The number of double forks. Optional, default 200
+    :type count:    int
+    :return:        The latency percentiles, in seconds
+    :rtype:         dict[str, float]
+    """
+    samples = []
+    for _ in range(count):
+        start = time.perf_counter()
+        in_child, _, _ = proc_util.double_fork()
+        if in_child:
+            _exit_now()
+        samples.append(time.perf_counter() - start)
+    return percentiles(samples)
+
+
+def bench_double_forked_run(count=200):
+    """
+    Measure the latency of proc_util.double_forked_run
+
+    :param count:   The number of runs. Optional, default 200
+    :type count:    int
+    :return:        The latency percentiles, in seconds
+    :rtype:         dict[str, float]
+    """
+    samples = []
+    for _ in range(count):
+        start = time.perf_counter()
+        proc_util.double_forked_run(_exit_now)
+        samples.append(time.perf_counter() - start)
+    return percentiles(samples)
+
+
+def bench_fork_server_run(count=200):
+    """
+    Measure the latency of proc_util.double_forked_run through a fork server
+
+    :param count:   The number of runs. Optional, default 200
+    :type count:    int
+    :return:        The latency percentiles, in seconds
+    :rtype:         dict[str, float]
+    """
+    samples = []
+    with proc_util.ForkServer(preload=("malice.core.bench",)) as server:
+        server.wait_ready()
+        for _ in range(count):
+            start = time.perf_counter()
+            server.run(_exit_now)
+            samples.append(time.perf_counter() - start)
+    return percentiles(samples)
+
+
+def _make_inventory(hosts):
+    import uuid
+    import datetime
+
+    return {
+        "host" + str(i): {
+            "id": uuid.UUID(int=i),
+            "updated": datetime.datetime(2019, 1, 1),
+            "groups": ("web", "db"),
+            "tags": set(["a", "b"]),
+            "vars": {"port": i, "ratio": i / 3.0, "enabled": True, "path": "/srv/" + str(i)},
+        } for i in range(hosts)
+    }
+
+
+def bench_json(hosts=20000, count=5):
+    """
+    Compare the json encoding of an inventory: cast_for_json then json.dumps, json_encode with the standard
+    encoder, and json_encode with orjson (if installed)
+
+    :param hosts:   The number of hosts in the inventory. Optional, default 20000
+    :type hosts:    int
+    :param count:   The number of encodings per implementation. Optional, default 5
+    :type count:    int
+    :return:        The duration percentiles of each implementation, in seconds
+    :rtype:         dict[str, dict[str, float]]
+    """
+    from malice.util import util
+
+    inventory = _make_inventory(hosts)
+    implementations = {
+        "cast_for_json": lambda: json.dumps(util.cast_for_json(inventory)),
+        "json_encode": lambda: util.json_encode(inventory),
+    }
+    if util._get_orjson():
+        implementations["json_encode_orjson"] = lambda: util.json_encode(inventory, accelerated=True)
+    result = {}
+    for name, implementation in implementations.items():
+        samples = []
+        for _ in range(count):
+            start = time.perf_counter()
+            implementation()
+            samples.append(time.perf_counter() - start)
+        result[name] = percentiles(samples)
+    return result
+
+
+def bench_cold_start(count=10):
+    """
+    Measure the malice command line start up: "malice --help" in a new interpreter, without the daemon
+
+    :param count:   The number of runs. Optional, default 10
+    :type count:    int
+    :return:        The latency percentiles, in seconds
+    :rtype:         dict[str, float]
+    """
+    import subprocess
+
+    env = dict(os.environ)
+    env["MALICE_DAEMON"] = "off"
+    package_parent = os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+    env["PYTHONPATH"] = package_parent + (os.pathsep + env["PYTHONPATH"] if env.get("PYTHONPATH") else "")
+    cmd = [sys.executable, "-c", "import malice; malice.main()", "--help"]
+    samples = []
+    for _ in range(count):
+        start = time.perf_counter()
+        subprocess.check_call(cmd, env=env, stdout=subprocess.DEVNULL)
+        samples.append(time.perf_counter() - start)
+    return percentiles(samples)
+
+
+def bench_run_cmd(count=100):
+    """
+    Measure the overhead of proc_util.run_cmd, running "true"
+
+    :param count:   The number of runs. Optional, default 100
+    :type count:    int
+    :return:        The latency percentiles, in seconds
+    :rtype:         dict[str, float]
+    """
+    true_path = shutil.which("true") or "/bin/true"
+    samples = []
+    for _ in range(count):
+        start = time.perf_counter()
+        proc_util.run_cmd([true_path])
+        samples.append(time.perf_counter() - start)
+    return percentiles(samples)
+
+
+def bench_tcp_port_status(count=200):
+    """
+    Measure util.tcp_port_status against a local listener
+
+    :param count:   The number of checks. Optional, default 200
+    :type count:    int
+    :return:        The latency percentiles, in seconds
+    :rtype:         dict[str, float]
+    """
+    import socket
+    import threading
+    from malice.util import util
+
+    listener = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    listener.bind(("127.0.0.1", 0))
+    listener.listen(128)
+    port = listener.getsockname()[1]
+
+    def accept_all():
+        while True:
+            try:
+                connection, _ = listener.accept()
+            except OSError:
+                return
+            connection.close()
+
+    thread = threading.Thread(target=accept_all, daemon=True)
+    thread.start()
+    samples = []
+    try:
+        for _ in range(count):
+            start = time.perf_counter()
+            if not util.tcp_port_status("127.0.0.1", port):
+                raise RuntimeError("Benchmark listener unreachable")
+            samples.append(time.perf_counter() - start)
+    finally:
+        listener.close()
+    return percentiles(samples)
+
+
+def bench_ini(files=100, count=5):
+    """
+    Measure the writing and loading of ini files: bulk writes (changed and unchanged contents), parsing, and loading
+    from the compiled cache
+
+    :param files:   The number of ini files. Optional, default 100
+    :type files:    int
+    :param count:   The number of runs of each operation. Optional, default 5
+    :type count:    int
+    :return:        The duration percentiles of each operation, in seconds
+    :rtype:         dict[str, dict[str, float]]
+    """
+    from malice.util import util
+
+    tmp_dir = tempfile.mkdtemp(prefix="malice-bench-")
+    cache_home = os.environ.get("XDG_CACHE_HOME")
+    os.environ["XDG_CACHE_HOME"] = os.path.join(tmp_dir, "cache")  # Don't pollute the user cache
+    samples = {"write": [], "write_unchanged": [], "load_parse": [], "load_cached": []}
+    try:
+        for run in range(count):
+            confs = {os.path.join(tmp_dir, "conf", "host" + str(i) + ".ini"): {
+                "key" + str(key): "value " + str(run) + " " + str(key) for key in range(50)
+            } for i in range(files)}
+            for name in ("write", "write_unchanged"):
+                start = time.perf_counter()
+                util.write_confs(confs, fsync=False)
+                samples[name].append(time.perf_counter() - start)
+            for name, use_disk_cache in (("load_parse", False), ("load_cached", True)):
+                util.load_ini_dir(os.path.join(tmp_dir, "conf"))  # Fill the disk cache
+                util._ini_cache.clear()
+                start = time.perf_counter()
+                for path in confs:
+                    util.load_ini_values(path, use_disk_cache)
+                samples[name].append(time.perf_counter() - start)
+                util._ini_cache.clear()
+    finally:
+        if cache_home is None:
+            del os.environ["XDG_CACHE_HOME"]
+        else:
+            os.environ["XDG_CACHE_HOME"] = cache_home
+        shutil.rmtree(tmp_dir, ignore_errors=True)
+    return {name: percentiles(values) for name, values in samples.items()}
+
+
+# name: (function, parameters, quick parameters)
+BENCHMARKS = collections.OrderedDict((
+    ("cold_start", (bench_cold_start, {}, {"count": 3})),
+    ("double_fork", (bench_double_fork, {}, {"count": 20})),
+    ("double_forked_run", (bench_double_forked_run, {}, {"count": 20})),
+    ("fork_server_run", (bench_fork_server_run, {}, {"count": 20})),
+    ("run_cmd", (bench_run_cmd, {}, {"count": 20})),
+    ("named_pipe_small", (bench_named_pipe, {"count": 200000, "payload_size": 64},
+                          {"count": 20000, "payload_size": 64})),
+    ("named_pipe_large", (bench_named_pipe, {"count": 200, "payload_size": 4 * 1024 * 1024, "batch_size": 4},
+                          {"count": 20, "payload_size": 4 * 1024 * 1024, "batch_size": 4})),
+    ("tcp_port_status", (bench_tcp_port_status, {}, {"count": 20})),
+    ("ini", (bench_ini, {}, {"files": 20, "count": 2})),
+    ("json", (bench_json, {}, {"hosts": 2000, "count": 2})),
+))
+
+
+def run_all(names=None, quick=False):
+    """
+    Run the benchmarks
+
+    :param names:   The benchmarks to run. Optional, default all of them
+    :type names:    list[str]|None
+    :param quick:   Smaller runs: faster, less precise. Optional, default False
+    :type quick:    bool
+    :return:        The benchmark results, by name
+    :rtype:         dict[str, dict]
+    """
+    unknown = [name for name in names or () if name not in BENCHMARKS]
+    if unknown:
+        raise RuntimeError("Unknown benchmark(s): " + ", ".join(unknown) + ". Available: " + ", ".join(BENCHMARKS))
+    result = collections.OrderedDict()
+    for name, (function, parameters, quick_parameters) in BENCHMARKS.items():
+        if not names or name in names:
+            result[name] = function(**(quick_parameters if quick else parameters))
+    return result
+
+
+def _flatten(results, prefix=""):
+    flat = {}
+    for key, value in results.items():
+        if isinstance(value, dict):
+            flat.update(_flatten(value, prefix + key + "."))
+        else:
+            flat[prefix + key] = value
+    return flat
+
+
+def compare(results, baseline, threshold=0.2):
+    """
+    Find the regressions from a baseline: latencies (p50, p95, p99) higher, or throughputs (*_per_sec) lower, by more
+    than threshold. Measures missing from either side are ignored
+
+    :param results:     The benchmark results
+    :type results:      dict[str, dict]
+    :param baseline:    The baseline results
+    :type baseline:     dict[str, dict]
+    :param threshold:   The tolerated relative difference. Optional, default 0.2 (20%)
+    :type threshold:    float
+    :return:            The regressions: measure name, baseline value, current value
+    :rtype:             list[Tuple[str, float, float]]
+    """
+    current = _flatten(results)
+    regressions = []
+    for name, base_value in sorted(_flatten(baseline).items()):
+        value = current.get(name)
+        if value is None or not base_value:
+            continue
+        measure = name.rsplit(".", 1)[-1]
+        if measure.startswith("p") and measure[1:].isdigit():
+            regressed = value > base_value * (1 + threshold)
+        elif measure.endswith("_per_sec"):
+            regressed = value < base_value * (1 - threshold)
+        else:
+            continue
+        if regressed:
+            regressions.append((name, base_value, value))
+    return regressions
+
+
+def main():
+    json.dump(run_all(), sys.stdout, indent=4)
+    sys.stdout.write(os.linesep)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,240 @@
+# -*- coding: utf-8 -*-
+# vim: set fileencoding=utf-8:tabstop=4:softtabstop=4:shiftwidth=4:expandtab:textwidth=120
+
+"""
+    Copyright 2019 Samuel Déal
+
+    This file is part of Malice.
+
+    Malice is free software: you can redistribute it and/or modify
+    it under the terms of the GNU General Public License as published by
+    the Free Software Foundation, either version 3 of the License, or
+    (at your option) any later version.
+
+    This program is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU General Public License for more details.
+
+    You should have received a copy of the GNU General Public License
+    along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+    Environment checks, run concurrently.
+    The result of each check is cached on disk with an invalidation key (ex: the modification time of the binary it
+    runs), so that checking again an unchanged environment costs a few stat calls.
+"""
+
+# Python core libraries
+import os
+import re
+import sys
+import json
+import time
+import collections
+
+# Project specific libs
+from malice.util.type_util import *
+from malice.util import util
+
+
+MIN_PYTHON = (3, 7)  # time.perf_counter_ns, asyncio.all_tasks. Keep in sync with python_requires in setup.py
+# Keep in sync with requirements.txt
+REQUIRED_PACKAGES = (
+    ("pip", "19.1.1"),
+    ("ansible", "2.8.1"),
+    ("requests", "2.18.4"),
+    ("keyring", "10.6.0"),
+    ("argcomplete", "1.10.0"),
+)
+REQUIRED_BINARIES = ("ansible", "ansible-playbook")
+DEFAULT_TTL = 24 * 3600
+
+Check = collections.namedtuple("Check", ("name", "get_key", "run"))
+Check.__doc__ = """An environment check: get_key() returns what the result depends on (None: never cache it), run()
+returns (ok, details)"""
+
+CheckResult = collections.namedtuple("CheckResult", ("name", "ok", "details", "cached"))
+
+
+def get_cache_path():
+    """
+    :return:        The checks cache file, in the user cache directory
+    :rtype:         str
+    """
+    return util.get_user_cache_dir("checks.json")
+
+
+def _parse_version(version):
+    return tuple(int(part) for part in re.findall(r"\d+", version.split("+")[0])[:4])
+
+
+def _get_file_key(path):
+    stat = os.stat(path)
+    return [path, stat.st_mtime_ns, stat.st_size]
+
+
+def _get_packages_key():
+    # Installing or removing a package modifies its site-packages directory
+    key = []
+    for path in sys.path:
+        try:
+            key.append([path, os.stat(path or ".").st_mtime_ns])
+        except OSError:
+            pass
+    return key
+
+
+def python_check():
+    """Check the python version"""
+    def run():
+        version = ".".join(str(part) for part in sys.version_info[:3])
+        if sys.version_info[:2] < MIN_PYTHON:
+            return False, version + ", " + ".".join(str(part) for part in MIN_PYTHON) + " or newer required"
+        return True, version + " (" + sys.executable + ")"
+    return Check("python", lambda: None, run)
+
+
+def _get_package_version(name):
+    try:
+        import importlib.metadata
+    except ImportError:  # Python < 3.8
+        import pkg_resources
+
+        try:
+            return pkg_resources.get_distribution(name).version
+        except pkg_resources.DistributionNotFound:
+            return None
+    try:
+        return importlib.metadata.version(name)
+    except importlib.metadata.PackageNotFoundError:
+        return None
+
+
+def package_check(name, min_version):
+    """Check that a python package is installed, with a minimum version"""
+    def run():
+        version = _get_package_version(name)
+        if version is None:
+            return False, "not installed, " + min_version + " or newer required"
+        if _parse_version(version) < _parse_version(min_version):
+            return False, version + ", " + min_version + " or newer required"
+        return True, version
+    return Check("package " + name, _get_packages_key, run)
+
+
+def binary_check(name):
+    """Check that a program is in the PATH, and runs"""
+    import shutil
+
+    path = shutil.which(name)
+
+    def run():
+        if path is None:
+            return False, "not found in PATH"
+        from malice.util import proc_util
+
+        try:
+            _, out, err = proc_util.run_cmd([path, "--version"])
+        except (OSError, RuntimeError) as e:
+            return False, path + ": " + to_str(e)
+        lines = (to_str(out) or to_str(err)).strip().splitlines()
+        return True, path + (": " + lines[0] if lines else "")
+    return Check("binary " + name, lambda: None if path is None else _get_file_key(os.path.realpath(path)), run)
+
+
+def writable_dir_check(path):
+    """Check that a directory is writable, or can be created"""
+    def run():
+        parent = path
+        while not os.path.isdir(parent) and os.path.dirname(parent) != parent:
+            parent = os.path.dirname(parent)  # It will be created: its parent has to be writable
+        if not os.access(parent, os.W_OK | os.X_OK):
+            return False, parent + " is not writable"
+        return True, path
+    return Check("writable " + path, lambda: None, run)
+
+
+def port_check(host, port):
+    """Check that a tcp port accepts connections"""
+    def run():
+        if not ll_int(port) or not 0 < int(port) < 65536:
+            return False, "invalid port \"" + to_str(port) + "\""
+        if util.tcp_port_status(host, port):
+            return True, "open"
+        return False, "unreachable"
+    return Check("port " + host + ":" + to_str(port), lambda: None, run)
+
+
+def _read_cache(path):
+    try:
+        with open(path) as cache_file:
+            return json.load(cache_file)
+    except (OSError, ValueError):
+        return {}
+
+
+def _write_cache(path, cache):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    tmp_path = path + "." + str(os.getpid()) + ".tmp"
+    with open(tmp_path, "w") as cache_file:
+        json.dump(cache, cache_file, indent=4, sort_keys=True)
+    os.replace(tmp_path, path)
+
+
+def _run_check(check):
+    try:
+        return check.run()
+    except Exception as e:
+        return False, to_str(e)
+
+
+def run_checks(checks, cache_path=None, ttl=DEFAULT_TTL, refresh=False, max_workers=16):
+    """
+    Run checks concurrently, reusing the cached results whose key didn't change and which are younger than ttl
+
+    :param checks:          The checks
+    :type checks:           list[Check]
+    :param cache_path:      The cache file. Optional, default get_cache_path()
+    :type cache_path:       str|None
+    :param ttl:             The maximum age of a cached result, in seconds. Optional, default a day
+    :type ttl:              float
+    :param refresh:         Ignore the cached results. Optional, default False
+    :type refresh:          bool
+    :param max_workers:     The maximum number of checks running at the same time. Optional, default 16
+    :type max_workers:      int
+    :return:                The results, in the checks order
+    :rtype:                 list[CheckResult]
+    """
+    import concurrent.futures
+
+    cache_path = get_cache_path() if cache_path is None else cache_path
+    cache = _read_cache(cache_path)
+    now = time.time()
+    results = {}
+    keys = {}
+    to_run = []
+    for check in checks:
+        try:
+            keys[check.name] = check.get_key()
+        except OSError:
+            keys[check.name] = None
+        entry = cache.get(check.name)
+        if not refresh and keys[check.name] is not None and entry is not None and entry["key"] == keys[check.name] \
+                and now - entry["time"] < ttl:
+            results[check.name] = CheckResult(check.name, entry["ok"], entry["details"], True)
+        else:
+            to_run.append(check)
+
+    if to_run:
+        with concurrent.futures.ThreadPoolExecutor(min(max_workers, len(to_run))) as executor:
+            for check, (ok, details) in zip(to_run, executor.map(_run_check, to_run)):
+                results[check.name] = CheckResult(check.name, ok, details, False)
+                if keys[check.name] is not None:
+                    cache[check.name] = {"key": keys[check.name], "time": now, "ok": ok, "details": details}
+                else:
+                    cache.pop(check.name, None)
+        try:
+            _write_cache(cache_path, cache)
+        except OSError:
+            pass  # Only slower next time
+    return [results[check.name] for check in checks]
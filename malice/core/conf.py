@@ -0,0 +1,323 @@
+# -*- coding: utf-8 -*-
+# vim: set fileencoding=utf-8:tabstop=4:softtabstop=4:shiftwidth=4:expandtab:textwidth=120
+
+"""
+    Copyright 2019 Samuel Déal
+
+    This file is part of Malice.
+
+    Malice is free software: you can redistribute it and/or modify
+    it under the terms of the GNU General Public License as published by
+    the Free Software Foundation, either version 3 of the License, or
+    (at your option) any later version.
+
+    This program is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU General Public License for more details.
+
+    You should have received a copy of the GNU General Public License
+    along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+    Infrastructure configuration generation, from config modules.
+
+    Each sub-directory of the modules directory is a config module. Its files are copied to the output directory,
+    under the module name; the files ending with .tmpl are templates: their $variables are substituted and the suffix
+    removed. The variables come from the [vars] section of the configuration, overridden by the [vars] section of the
+    module.ini file of the module, if any:
+
+        [conf]
+        modules = modules
+        output = generated
+
+        [vars]
+        domain = example.org
+
+    Generation is incremental: the inputs of each module (its files and variables) are hashed, and the rendered files
+    are kept in a content addressed cache, in the state directory. Only the modules whose inputs changed are rendered
+    again, and only the output files which differ are written.
+"""
+
+# Python core libraries
+import os
+import json
+import hashlib
+
+# Project specific libs
+from malice.util.type_util import *
+import malice.core.config
+
+
+MODULE_FILE_NAME = "module.ini"
+TEMPLATE_SUFFIX = ".tmpl"
+# Change it when the rendering changes: it invalidates all the cached renderings
+RENDER_VERSION = 1
+
+
+def _list_files(module_dir):
+    result = []
+    for directory, dir_names, file_names in os.walk(module_dir):
+        dir_names[:] = sorted(name for name in dir_names if not name.startswith("."))
+        for name in sorted(file_names):
+            if not name.startswith(".") and not name.endswith("~"):
+                result.append(os.path.relpath(os.path.join(directory, name), module_dir))
+    return result
+
+
+def _write_file(path, data):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    tmp_path = path + "." + str(os.getpid()) + ".tmp"
+    with open(tmp_path, "wb") as tmp_file:
+        tmp_file.write(data)
+    os.replace(tmp_path, path)
+
+
+class _BuildCache(object):
+    """
+    The generation cache, in the state directory:
+        inputs.json:        digest of the input files, by path, with their modification time and size
+        outputs.json:       the files written by module, with their digest, modification time and size
+        modules/<hash>:     the rendered files (their digest, by relative path) of the module inputs with this hash
+        objects/<digest>:   the rendered files content
+    """
+
+    def __init__(self):
+        self.root = malice.core.config.get_state_path("conf-cache", "")
+        self.inputs = self._read_json("inputs.json") or {}
+        self._hashed = set()
+        self.outputs = self._read_json("outputs.json") or {}
+
+    def _read_json(self, name):
+        """:return: The file content, None if it is missing or unreadable"""
+        try:
+            with open(os.path.join(self.root, name)) as json_file:
+                return json.load(json_file)
+        except (OSError, ValueError):
+            return None
+
+    def save(self):
+        inputs = {path: value for path, value in self.inputs.items() if path in self._hashed}  # Forget removed files
+        _write_file(os.path.join(self.root, "inputs.json"), to_bytes(json.dumps(inputs)))
+        _write_file(os.path.join(self.root, "outputs.json"), to_bytes(json.dumps(self.outputs)))
+
+    def get_digest(self, path):
+        """Hash a file, unless its modification time and size show it didn't change since it was last hashed"""
+        stat = os.stat(path)
+        self._hashed.add(path)
+        cached = self.inputs.get(path)
+        if cached is not None and cached[0] == stat.st_mtime_ns and cached[1] == stat.st_size:
+            return cached[2]
+        with open(path, "rb") as input_file:
+            digest = hashlib.sha256(input_file.read()).hexdigest()
+        self.inputs[path] = [stat.st_mtime_ns, stat.st_size, digest]
+        return digest
+
+    def get_manifest(self, inputs_hash):
+        manifest = self._read_json(os.path.join("modules", inputs_hash))
+        if manifest is None or not all(os.path.exists(self._get_object_path(digest)) for digest in manifest.values()):
+            return None
+        return manifest
+
+    def put_manifest(self, inputs_hash, files):
+        manifest = {}
+        for rel_path, data in files.items():
+            digest = hashlib.sha256(data).hexdigest()
+            object_path = self._get_object_path(digest)
+            if not os.path.exists(object_path):
+                _write_file(object_path, data)
+            manifest[rel_path] = digest
+        _write_file(os.path.join(self.root, "modules", inputs_hash), to_bytes(json.dumps(manifest)))
+        return manifest
+
+    def prune(self, inputs_hashes):
+        """
+        Remove the manifests of the inputs which are not current anymore, then the objects no manifest references
+
+        :param inputs_hashes:   The inputs hashes of the current modules
+        :type inputs_hashes:    Iterable[str]
+        """
+        inputs_hashes = set(inputs_hashes)
+        referenced = set()
+        modules_dir = os.path.join(self.root, "modules")
+        for name in (os.listdir(modules_dir) if os.path.isdir(modules_dir) else []):
+            manifest = self._read_json(os.path.join("modules", name)) if name in inputs_hashes else None
+            if manifest is None:
+                os.unlink(os.path.join(modules_dir, name))
+            else:
+                referenced.update(manifest.values())
+        objects_dir = os.path.join(self.root, "objects")
+        for directory, _, file_names in os.walk(objects_dir, topdown=False):
+            for name in file_names:
+                if name not in referenced:
+                    os.unlink(os.path.join(directory, name))
+            if directory != objects_dir and not os.listdir(directory):
+                os.rmdir(directory)
+
+    def _get_object_path(self, digest):
+        return os.path.join(self.root, "objects", digest[:2], digest)
+
+    def read_object(self, digest):
+        with open(self._get_object_path(digest), "rb") as object_file:
+            return object_file.read()
+
+
+class ConfModule(object):
+    def __init__(self, name, path, variables):
+        """
+        :param name:        The module name
+        :type name:         str
+        :param path:        The module directory
+        :type path:         str
+        :param variables:   The global variables
+        :type variables:    dict[str, str]
+        """
+        self.name = name
+        self.path = path
+        self.files = [rel_path for rel_path in _list_files(path) if rel_path != MODULE_FILE_NAME]
+        self.variables = dict(variables)
+        module_file = os.path.join(path, MODULE_FILE_NAME)
+        if os.path.isfile(module_file):
+            from malice.util import util
+
+            module_conf = util.load_ini_file(module_file)
+            if module_conf.has_section("vars"):
+                self.variables.update(module_conf.items("vars"))
+
+    def get_inputs_hash(self, cache):
+        """
+        :param cache:   The build cache, to avoid hashing again unchanged files
+        :type cache:    _BuildCache
+        :return:        The hash of everything the rendering depends on
+        :rtype:         str
+        """
+        inputs = {
+            "version": RENDER_VERSION,
+            "files": [[rel_path, cache.get_digest(os.path.join(self.path, rel_path))] for rel_path in self.files],
+            "variables": sorted(self.variables.items()),
+        }
+        return hashlib.sha256(to_bytes(json.dumps(inputs, sort_keys=True))).hexdigest()
+
+
+def _render_module(path, files, variables):
+    """Render the files of a module. Run in a worker process: it only takes and returns simple values"""
+    import string
+
+    result = {}
+    for rel_path in files:
+        with open(os.path.join(path, rel_path), "rb") as input_file:
+            data = input_file.read()
+        if rel_path.endswith(TEMPLATE_SUFFIX):
+            try:
+                data = to_bytes(string.Template(to_str(data)).substitute(variables))
+            except (KeyError, ValueError) as e:
+                raise RuntimeError("Module " + os.path.basename(path) + ", " + rel_path + ": invalid template (" +
+                                   type(e).__name__ + " " + to_str(e) + ")")
+            rel_path = rel_path[:-len(TEMPLATE_SUFFIX)]
+        result[rel_path] = data
+    return result
+
+
+def load_modules():
+    """
+    Read the config modules
+
+    :return:        The modules, by name
+    :rtype:         dict[str, ConfModule]
+    """
+    section = malice.core.config.get_section("conf")
+    modules_dir = os.path.join(malice.core.config.get_base_dir(), section.get("modules", "modules"))
+    if not os.path.isdir(modules_dir):
+        raise RuntimeError("No config module directory " + modules_dir)
+    variables = malice.core.config.get_section("vars")
+    result = {}
+    for entry in sorted(os.scandir(modules_dir), key=lambda entry: entry.name):
+        if entry.is_dir() and not entry.name.startswith("."):
+            result[entry.name] = ConfModule(entry.name, entry.path, variables)
+    return result
+
+
+def _write_outputs(cache, output_dir, name, manifest):
+    """Write the files of a module which differ from what is on disk, and remove the ones it doesn't produce anymore"""
+    output_dir = os.path.normpath(output_dir)  # Compared to the parents of the removed files
+    written = 0
+    previous = cache.outputs.get(name, {})
+    current = {}
+    for rel_path, digest in sorted(manifest.items()):
+        path = os.path.join(output_dir, name, rel_path)
+        recorded = previous.get(rel_path)
+        try:
+            stat = os.stat(path)
+        except OSError:
+            stat = None
+        if stat is None or recorded is None or recorded != [digest, stat.st_mtime_ns, stat.st_size]:
+            _write_file(path, cache.read_object(digest))
+            stat = os.stat(path)
+            written += 1
+        current[rel_path] = [digest, stat.st_mtime_ns, stat.st_size]
+    for rel_path in previous:
+        if rel_path not in current:
+            path = os.path.join(output_dir, name, rel_path)
+            try:
+                os.unlink(path)
+                # Remove the directories left empty
+                while os.path.dirname(path) != output_dir:
+                    path = os.path.dirname(path)
+                    os.rmdir(path)
+            except OSError:
+                pass
+    cache.outputs[name] = current
+    return written
+
+
+def generate(jobs=None):
+    """
+    Generate the infrastructure configuration from the config modules, incrementally
+
+    :param jobs:    The number of modules rendered in parallel. Optional, default the number of CPUs
+    :type jobs:     int|None
+    :return:        0
+    :rtype:         int
+    """
+    import time
+
+    start_time = time.monotonic()
+    modules = load_modules()
+    output_dir = os.path.abspath(os.path.join(malice.core.config.get_base_dir(),
+                                              malice.core.config.get_section("conf").get("output", "generated")))
+    cache = _BuildCache()
+    manifests = {}
+    inputs_hashes = {}
+    to_render = {}
+    for name, module in modules.items():
+        inputs_hashes[name] = module.get_inputs_hash(cache)
+        manifests[name] = cache.get_manifest(inputs_hashes[name])
+        if manifests[name] is None:
+            to_render[name] = inputs_hashes[name]
+
+    jobs = jobs or os.cpu_count() or 1
+    if len(to_render) > 1 and jobs > 1:
+        import concurrent.futures
+
+        with concurrent.futures.ProcessPoolExecutor(min(jobs, len(to_render))) as executor:
+            futures = {name: executor.submit(_render_module, modules[name].path, modules[name].files,
+                                             modules[name].variables) for name in to_render}
+            rendered = {name: future.result() for name, future in futures.items()}
+    else:
+        rendered = {name: _render_module(modules[name].path, modules[name].files, modules[name].variables)
+                    for name in to_render}
+    for name, inputs_hash in to_render.items():
+        manifests[name] = cache.put_manifest(inputs_hash, rendered[name])
+
+    for name in modules:
+        written = _write_outputs(cache, output_dir, name, manifests[name])
+        state = "rendered" if name in to_render else "cached"
+        print(name + ": " + state + ", " + str(written) + " file(s) written")
+    for name in [name for name in cache.outputs if name not in modules]:
+        _write_outputs(cache, output_dir, name, {})  # Removed module
+        del cache.outputs[name]
+        print(name + ": removed")
+    cache.prune(inputs_hashes.values())
+    cache.save()
+    print("Generated " + str(len(modules)) + " module(s) (" + str(len(to_render)) + " rendered) in " +
+          "{:.2f}".format(time.monotonic() - start_time) + "s")
+    return 0
@@ -0,0 +1,133 @@
+# -*- coding: utf-8 -*-
+# vim: set fileencoding=utf-8:tabstop=4:softtabstop=4:shiftwidth=4:expandtab:textwidth=120
+
+"""
+    Copyright 2019 Samuel Déal
+
+    This file is part of Malice.
+
+    Malice is free software: you can redistribute it and/or modify
+    it under the terms of the GNU General Public License as published by
+    the Free Software Foundation, either version 3 of the License, or
+    (at your option) any later version.
+
+    This program is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU General Public License for more details.
+
+    You should have received a copy of the GNU General Public License
+    along with this program.  If not, see <https://www.gnu.org/licenses/>.
+"""
+
+# Python core libraries
+import os
+
+
+CONFIG_FILE_NAME = "malice.ini"
+CONFIG_ENV_VAR = "MALICE_CONFIG"
+
+_config_path = None
+
+
+def set_path(path):
+    """
+    Set the configuration file given on the command line
+
+    :param path:    The configuration file path, None to use the default lookup
+    :type path:     str|None
+    """
+    global _config_path
+    _config_path = path
+
+
+def find_path(path=None, cwd=None, env=None):
+    """
+    Find the configuration file to use.
+    In order: the given path, the one set via set_path, $MALICE_CONFIG, ./malice.ini, ~/.config/malice/malice.ini
+
+    :param path:    The explicit configuration path. Optional, default None
+    :type path:     str|None
+    :param cwd:     The directory to search from. Optional, default the current directory
+    :type cwd:      str|None
+    :param env:     The environment to use. Optional, default os.environ
+    :type env:      dict[str, str]|None
+    :return:        The absolute configuration path, None if there is none
+    :rtype:         str|None
+    """
+    cwd = os.getcwd() if cwd is None else cwd
+    env = os.environ if env is None else env
+    path = path or _config_path or env.get(CONFIG_ENV_VAR)
+    if path:
+        return os.path.abspath(os.path.join(cwd, os.path.expanduser(path)))
+    candidates = (
+        os.path.join(cwd, CONFIG_FILE_NAME),
+        os.path.join(os.path.expanduser("~"), ".config", "malice", CONFIG_FILE_NAME),
+    )
+    for candidate in candidates:
+        if os.path.isfile(candidate):
+            return candidate
+    return None
+
+
+def load(path=None):
+    """
+    Load the configuration as a dictionary of sections.
+    The parsed files are cached (see util.load_ini_values) and only reparsed when they change on disk
+
+    :param path:    The configuration file. Optional, default find_path()
+    :type path:     str|None
+    :return:        The configuration values, by section and key
+    :rtype:         dict[str, dict[str, str]]
+    """
+    path = find_path(path)
+    if path is None:
+        return {}
+
+    from malice.util import util
+    from malice.util import trace_util
+
+    with trace_util.span("config.load", path=path):
+        values = util.load_ini_values(path)
+    return {name: section for name, section in values.items() if name != "DEFAULT"}
+
+
+def get_section(name, path=None):
+    """
+    Get one section of the configuration
+
+    :param name:    The section name
+    :type name:     str
+    :param path:    The configuration file. Optional, default find_path()
+    :type path:     str|None
+    :return:        The section values, empty if the section doesn't exist
+    :rtype:         dict[str, str]
+    """
+    return load(path).get(name, {})
+
+
+def get_state_path(*parts):
+    """
+    Get a path in the malice state directory (pid files, logs...), creating its parent directory.
+    The state directory is "state_dir" in the [malice] section, or .malice next to the configuration file
+
+    :param parts:   The path parts, relative to the state directory
+    :type parts:    str
+    :return:        The absolute path
+    :rtype:         str
+    """
+    state_dir = get_section("malice").get("state_dir") or ".malice"
+    result = os.path.join(get_base_dir(), os.path.expanduser(state_dir), *parts)
+    os.makedirs(os.path.dirname(result), exist_ok=True)
+    return result
+
+
+def get_base_dir():
+    """
+    Get the directory relative paths of the configuration are resolved from
+
+    :return:        The configuration file directory, or the current directory if there is no configuration file
+    :rtype:         str
+    """
+    path = find_path()
+    return os.path.dirname(path) if path is not None else os.getcwd()
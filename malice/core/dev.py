@@ -20,22 +20,307 @@
     along with this program.  If not, see <https://www.gnu.org/licenses/>.
 """
 
+# Python core libraries
+import os
+import time
+import contextlib
 
-def start():
-    print("Coucou")
+# Project specific libs
+import malice.core.services
 
 
-def restart():
-    print("Coucou")
+@contextlib.contextmanager
+def _fork_server():
+    """
+    Launch the services through a fork server. Only worth it in watch mode: a one shot command would exit before the
+    server is ready, double_forked_run forking this process until then
+    """
+    from malice.util import proc_util
 
+    proc_util.start_fork_server(("malice.core.services",))
+    try:
+        yield
+    finally:
+        proc_util.stop_fork_server()
 
-def stop():
-    print("Coucou")
 
+def _load(names):
+    services = malice.core.services.load_services()
+    malice.core.services.select_services(services, names)  # Check the names
+    return services
 
-def kill():
-    print("Coucou")
 
+def _print_start(services, names, failures, start_time):
+    for name in services:
+        if name in failures:
+            print(name + ": " + failures[name])
+        elif not names or name in names:
+            print(name + ": ready")
+    if failures:
+        raise RuntimeError(str(len(failures)) + " service(s) failed to start")
+    print("Started in " + "{:.2f}".format(time.monotonic() - start_time) + "s")
 
-def clean():
-    print("Coucou")
+
+def _print_stop(stopped):
+    if not stopped:
+        print("No service running")
+    for name, graceful in stopped.items():
+        print(name + ": " + ("stopped" if graceful else "killed"))
+
+
+def start(services=None, watch=False):
+    """
+    Start the development services, and the ones they depend on, and wait until they are ready
+
+    :param services:    The names of the services to start. Optional, default all of them
+    :type services:     list[str]|None
+    :param watch:       Then restart the services when their files or their configuration change, until interrupted.
+                        Optional, default False
+    :type watch:        bool
+    """
+    all_services = _load(services)
+    if not all_services:
+        print("No service configured")
+        return 0
+    start_time = time.monotonic()
+    failures = malice.core.services.start(all_services, services or None)
+    _print_start(all_services, services, failures, start_time)
+    if watch:
+        with _fork_server():
+            _watch(all_services, services)
+    return 0
+
+
+def _get_config_changes(old_services, new_services, names):
+    result = set(name for name in old_services if name not in new_services)
+    result.update(name for name in new_services
+                  if name in old_services and new_services[name].values != old_services[name].values)
+    if not names:
+        result.update(name for name in new_services if name not in old_services)
+    return result
+
+
+def _watch(all_services, names):
+    """Restart the services owning the changed files, and the services whose configuration changed, forever"""
+    import malice.core.config
+    from malice.util import fs_util
+    from malice.util import graph_util
+
+    config_path = malice.core.config.find_path()
+    while True:
+        names = [name for name in names or () if name in all_services]
+        selected = graph_util.get_requirements(malice.core.services.get_dependencies(all_services),
+                                               names or all_services)
+        selected = [all_services[name] for name in all_services if name in selected]
+        roots = [path for service in selected for path in service.watch] + [config_path]
+        print("Watching for changes (Ctrl-C to stop)")
+        with fs_util.TreeWatcher(roots, [malice.core.config.get_state_path()]) as watcher:
+            new_services = all_services
+            while new_services is all_services:
+                changed = watcher.wait()
+                if config_path in changed:
+                    try:
+                        new_services = malice.core.services.load_services()
+                    except RuntimeError as e:
+                        print("Invalid configuration, ignored: " + str(e))
+                    changed.discard(config_path)
+                affected = malice.core.services.get_owners(selected, changed)
+                affected |= _get_config_changes(all_services, new_services, names)
+                if not affected:
+                    continue
+                print("Changes detected, restarting " + ", ".join(sorted(affected)))
+                start_time = time.monotonic()
+                stopped = malice.core.services.stop(all_services, [name for name in affected if name in all_services])
+                _print_stop(stopped)
+                affected = set(name for name in set(stopped) | affected if name in new_services)
+                try:
+                    failures = malice.core.services.start(new_services, affected)
+                    _print_start(new_services, affected, failures, start_time)
+                except RuntimeError as e:
+                    print(str(e))
+        all_services = new_services
+
+
+def restart(services=None):
+    """
+    Restart development services, and the ones depending on them
+
+    :param services:    The names of the services to restart. Optional, default all of them
+    :type services:     list[str]|None
+    """
+    all_services = _load(services)
+    start_time = time.monotonic()
+    stopped = malice.core.services.stop(all_services, services or None)
+    _print_stop(stopped)
+    affected = set(stopped) | set(services or all_services)
+    failures = malice.core.services.start(all_services, affected)
+    _print_start(all_services, affected, failures, start_time)
+    return 0
+
+
+def stop(services=None):
+    """
+    Stop development services, and the ones depending on them
+
+    :param services:    The names of the services to stop. Optional, default all of them
+    :type services:     list[str]|None
+    """
+    _print_stop(malice.core.services.stop(_load(services), services or None))
+    return 0
+
+
+def kill(services=None):
+    """
+    Kill development services, and the ones depending on them
+
+    :param services:    The names of the services to kill. Optional, default all of them
+    :type services:     list[str]|None
+    """
+    _print_stop(malice.core.services.stop(_load(services), services or None, kill=True))
+    return 0
+
+
+def status(services=None):
+    """
+    Print the status of the development services
+
+    :param services:    The names of the services. Optional, default all of them
+    :type services:     list[str]|None
+    :return:            0 if all the services are running, 3 otherwise
+    :rtype:             int
+    """
+    selected = malice.core.services.select_services(malice.core.services.load_services(), services)
+    if not selected:
+        print("No service configured")
+        return 0
+    now = time.time()
+    width = max(len(service.name) for service in selected)
+    all_running = True
+    for name, state, entry in malice.core.services.get_status(selected):
+        line = name.ljust(width) + "  " + state.ljust(7)
+        if entry is not None:
+            line += "  pid " + str(entry["pid"]).ljust(7) + "  up " + _format_duration(now - entry["started_at"])
+            line += "  " + entry["command"]
+        print(line)
+        all_running = all_running and state == "running"
+    return 0 if all_running else 3
+
+
+def _format_duration(seconds):
+    seconds = int(seconds)
+    if seconds < 60:
+        return str(seconds) + "s"
+    if seconds < 3600:
+        return str(seconds // 60) + "m" + str(seconds % 60).zfill(2) + "s"
+    return str(seconds // 3600) + "h" + str(seconds // 60 % 60).zfill(2) + "m"
+
+
+def logs(services=None, follow=False, tail=10):
+    """
+    Print the development services logs, each line prefixed with its service and stream
+
+    :param services:    The names of the services. Optional, default all of them
+    :type services:     list[str]|None
+    :param follow:      Keep printing the new lines, until interrupted. Optional, default False
+    :type follow:       bool
+    :param tail:        The number of lines to show from each log file. Optional, default 10
+    :type tail:         int
+    """
+    import sys
+    import malice.core.logs
+
+    selected = malice.core.services.select_services(malice.core.services.load_services(), services)
+    if not selected:
+        print("No service configured")
+        return 0
+    sources = []
+    for service in selected:
+        stdout_path, stderr_path = service.get_log_paths()
+        sources.append((service.name + ".out", stdout_path))
+        sources.append((service.name + ".err", stderr_path))
+    sys.stdout.flush()
+    multiplexer = malice.core.logs.LogMultiplexer(sources, sys.stdout.buffer)
+    multiplexer.print_tail(max(0, tail))
+    if follow:
+        multiplexer.follow()
+    return 0
+
+
+def _format_size(size):
+    for unit in ("B", "KiB", "MiB", "GiB"):
+        if size < 1024 or unit == "GiB":
+            return ("{:.1f}".format(size) if unit != "B" else str(size)) + " " + unit
+        size /= 1024.0
+
+
+def _get_clean_paths():
+    """
+    :return:    The paths to remove, and the matches skipped because they resolve outside of the project
+    :rtype:     Tuple[list[str], list[str]]
+    """
+    import glob
+    import malice.core.config
+
+    base_dir = malice.core.config.get_base_dir()
+    real_base_dir = os.path.join(os.path.realpath(base_dir), "")
+    patterns = [pattern.strip() for pattern in malice.core.config.get_section("dev").get("clean", "").split(",")]
+    result = []
+    skipped = []
+    for pattern in patterns:
+        if not pattern:
+            continue
+        for match in sorted(glob.glob(os.path.join(base_dir, os.path.expanduser(pattern)))):
+            match = os.path.normpath(match)
+            # glob follows symbolic links to directories: resolve the parents, but not the leaf, which is removed
+            # as a link if it's one
+            path = os.path.join(os.path.realpath(os.path.dirname(match)), os.path.basename(match))
+            if not path.startswith(real_base_dir):
+                skipped.append(match)
+            elif path not in result:
+                result.append(path)
+    return result, skipped
+
+
+def clean(dry_run=False):
+    """
+    Remove the development artifacts: the paths listed by "clean" in the [dev] section of the configuration
+    (comma separated, relative to the configuration file, glob patterns allowed), ex:
+
+        [dev]
+        clean = build, .cache, */node_modules
+
+    :param dry_run:     Only show what would be removed. Optional, default False
+    :type dry_run:      bool
+    """
+    from malice.util import fs_util
+    import malice.core.config
+
+    paths, skipped = _get_clean_paths()
+    base_dir = malice.core.config.get_base_dir()
+    for path in skipped:
+        print("Skipped " + path + ": not inside " + base_dir)
+    if not paths:
+        print("Nothing to clean")
+        return 0
+    start_time = time.monotonic()
+    stats = fs_util.remove_trees(paths, dry_run)
+    real_base_dir = os.path.realpath(base_dir)
+    total = 0
+    errors = []
+    for path in paths:
+        if path not in stats:
+            continue
+        total += stats[path].size
+        errors += stats[path].errors
+        print(os.path.relpath(path, real_base_dir) + ": " + _format_size(stats[path].size) + " in " +
+              str(stats[path].files) + " file(s), " + str(stats[path].dirs) + " dir(s)")
+    for error in errors[:10]:
+        print("Error: " + str(error))
+    duration = "{:.2f}".format(time.monotonic() - start_time) + "s"
+    if dry_run:
+        print("Would free " + _format_size(total) + " (scanned in " + duration + ")")
+    else:
+        print("Freed " + _format_size(total) + " in " + duration)
+    if errors:
+        raise RuntimeError(str(len(errors)) + " file(s) could not be removed")
+    return 0
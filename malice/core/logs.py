@@ -0,0 +1,151 @@
+# -*- coding: utf-8 -*-
+# vim: set fileencoding=utf-8:tabstop=4:softtabstop=4:shiftwidth=4:expandtab:textwidth=120
+
+"""
+    Copyright 2019 Samuel Déal
+
+    This file is part of Malice.
+
+    Malice is free software: you can redistribute it and/or modify
+    it under the terms of the GNU General Public License as published by
+    the Free Software Foundation, either version 3 of the License, or
+    (at your option) any later version.
+
+    This program is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU General Public License for more details.
+
+    You should have received a copy of the GNU General Public License
+    along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+    Multiplexed display of the development services logs
+"""
+
+# Python core libraries
+import os
+import time
+
+# Project specific libs
+from malice.util.type_util import *
+from malice.util import fs_util
+
+
+class _LogSource(object):
+    def __init__(self, prefix, path):
+        self.prefix = to_bytes(prefix)
+        self.path = path
+        self.offset = 0
+        self.partial = b""
+        self.file_id = None  # (st_dev, st_ino) of the file the offset is in, None if not read yet
+
+
+class LogMultiplexer(object):
+    """
+    Interleave several log files on one output, each line prefixed by its source.
+    Followed lines are also prefixed by the time they were read.
+    Files are read in large chunks and each chunk is written with one call, so a chatty source doesn't fall behind
+    """
+
+    chunk_size = 1024 * 1024
+
+    def __init__(self, sources, out):
+        """
+        :param sources:     The (prefix, path) of each log file
+        :type sources:      list[Tuple[str, str]]
+        :param out:         The binary output
+        :type out:          io.BufferedIOBase
+        """
+        width = max([len(prefix) for prefix, _ in sources] or [0])
+        self.sources = [_LogSource(prefix.ljust(width) + " | ", path) for prefix, path in sources]
+        self.out = out
+
+    def print_tail(self, count):
+        """
+        Print the last lines of each source, and start following from there
+
+        :param count:   The number of lines, per source
+        :type count:    int
+        """
+        blank = b" " * len(self._get_timestamp())
+        for source in self.sources:
+            lines, source.offset = fs_util.tail_lines(source.path, count + 1)
+            try:
+                stat = os.stat(source.path)
+                source.file_id = (stat.st_dev, stat.st_ino)
+            except OSError:
+                source.file_id = None
+            if lines and not lines[-1].endswith(b"\n"):
+                source.offset -= len(lines.pop())  # Incomplete line: it will be printed when followed
+            elif len(lines) > count:
+                lines.popleft()
+            self.out.write(b"".join(blank + source.prefix + line for line in lines))
+        self.out.flush()
+
+    @staticmethod
+    def _get_timestamp():
+        now = time.time()
+        return to_bytes(time.strftime("%H:%M:%S", time.localtime(now)) + "." + str(int(now % 1 * 1000)).zfill(3) + " ")
+
+    def _read(self, source):
+        try:
+            with open(source.path, "rb") as log_file:
+                stat = os.fstat(log_file.fileno())
+                file_id = (stat.st_dev, stat.st_ino)
+                if stat.st_size < source.offset or (source.file_id is not None and source.file_id != file_id):
+                    source.offset = 0  # Truncated, or replaced (rotated)
+                    source.partial = b""
+                source.file_id = file_id
+                log_file.seek(source.offset)
+                while True:
+                    data = log_file.read(self.chunk_size)
+                    if not data:
+                        break
+                    source.offset += len(data)
+                    data = source.partial + data
+                    end = data.rfind(b"\n") + 1
+                    source.partial = data[end:]
+                    if end:
+                        prefix = self._get_timestamp() + source.prefix
+                        self.out.write(b"".join(prefix + line for line in data[:end].splitlines(True)))
+        except OSError:
+            return
+        self.out.flush()
+
+    def follow(self, poll_interval=0.25):
+        """
+        Print the new lines of the sources as they are written, until interrupted.
+        Uses inotify when available, otherwise checks the files every poll_interval
+
+        :param poll_interval:   The delay between two checks without inotify, in seconds. Optional, default 0.25
+        :type poll_interval:    float
+        """
+        for source in self.sources:
+            self._read(source)
+        if not fs_util.Inotify.is_available():
+            while True:
+                time.sleep(poll_interval)
+                for source in self.sources:
+                    self._read(source)
+
+        by_name = {}
+        with fs_util.Inotify() as inotify:
+            # Watch the directories, so that files created or replaced later are seen too
+            for source in self.sources:
+                directory, name = os.path.split(source.path)
+                wd = inotify.add_watch(directory, fs_util.IN_MODIFY | fs_util.IN_CREATE | fs_util.IN_MOVED_TO)
+                by_name.setdefault((wd, name), []).append(source)
+            for source in self.sources:
+                self._read(source)  # Written while we were setting up the watches
+            while True:
+                events = inotify.read_events()
+                if any(event.mask & fs_util.IN_Q_OVERFLOW for event in events):
+                    changed = self.sources
+                else:
+                    changed = []
+                    for event in events:
+                        for source in by_name.get((event.wd, event.name), ()):
+                            if source not in changed:
+                                changed.append(source)
+                for source in changed:
+                    self._read(source)
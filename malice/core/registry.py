@@ -0,0 +1,162 @@
+# -*- coding: utf-8 -*-
+# vim: set fileencoding=utf-8:tabstop=4:softtabstop=4:shiftwidth=4:expandtab:textwidth=120
+
+"""
+    Copyright 2019 Samuel Déal
+
+    This file is part of Malice.
+
+    Malice is free software: you can redistribute it and/or modify
+    it under the terms of the GNU General Public License as published by
+    the Free Software Foundation, either version 3 of the License, or
+    (at your option) any later version.
+
+    This program is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU General Public License for more details.
+
+    You should have received a copy of the GNU General Public License
+    along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+    Registry of the processes launched by malice, in the state directory.
+    Each entry records the pid and its start time (from /proc/<pid>/stat), so a reused pid is never mistaken for
+    the process we launched. Changes are made under an exclusive file lock and written atomically, so concurrent
+    malice invocations agree; readers don't need to lock.
+"""
+
+# Python core libraries
+import os
+import json
+import time
+import fcntl
+import contextlib
+
+# Project specific libs
+from malice.util import proc_util
+import malice.core.config
+
+
+REGISTRY_FILE_NAME = "registry.json"
+
+
+def _get_path():
+    return malice.core.config.get_state_path(REGISTRY_FILE_NAME)
+
+
+@contextlib.contextmanager
+def locked():
+    """
+    This method should be used via the 'with' keyword
+    Hold the registry lock: only one malice invocation at a time modifies the registry or launches processes
+    """
+    with open(_get_path() + ".lock", "a") as lock_file:
+        fcntl.flock(lock_file.fileno(), fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(lock_file.fileno(), fcntl.LOCK_UN)
+
+
+def read():
+    """
+    Read the registry
+
+    :return:        The registry entries, by name
+    :rtype:         dict[str, dict]
+    """
+    try:
+        with open(_get_path()) as registry_file:
+            return json.load(registry_file)
+    except (OSError, ValueError):
+        return {}
+
+
+def _write(entries):
+    path = _get_path()
+    tmp_path = path + "." + str(os.getpid()) + ".tmp"
+    with open(tmp_path, "w") as registry_file:
+        json.dump(entries, registry_file, indent=4, sort_keys=True)
+    os.replace(tmp_path, path)
+
+
+def register(name, pid, command, **extra):
+    """
+    Record a launched process. The caller should hold the lock (see locked)
+
+    :param name:        The process name, usually the service name
+    :type name:         str
+    :param pid:         The process id
+    :type pid:          int
+    :param command:     The command the process runs
+    :type command:      str
+    :param extra:       Other values to record
+    :type extra:        any
+    """
+    entries = read()
+    entry = dict(extra)
+    entry.update({
+        "pid": pid,
+        "start_time": proc_util.get_start_time(pid),
+        "command": command,
+        "started_at": time.time(),
+    })
+    entries[name] = entry
+    _write(entries)
+
+
+def unregister(names):
+    """
+    Forget processes. The caller should hold the lock (see locked)
+
+    :param names:       The process names
+    :type names:        collections.Iterable[str]
+    """
+    entries = read()
+    removed = False
+    for name in names:
+        removed = entries.pop(name, None) is not None or removed
+    if removed:
+        _write(entries)
+
+
+def is_alive(entry):
+    """
+    Check if the process of a registry entry is still running: the pid exists, with the recorded start time
+
+    :param entry:       The registry entry
+    :type entry:        dict
+    :return:            True if the recorded process is running
+    :rtype:             bool
+    """
+    if entry.get("start_time") is None:
+        return False  # Exited before its start time was read: the pid may now be an unrelated process
+    return proc_util.get_start_time(entry["pid"]) == entry["start_time"]
+
+
+def get_entry(name):
+    """
+    Get the registry entry of a running process
+
+    :param name:        The process name
+    :type name:         str
+    :return:            The registry entry, None if the process is not running
+    :rtype:             dict|None
+    """
+    entry = read().get(name)
+    if entry is None or not is_alive(entry):
+        return None
+    return entry
+
+
+def get_pid(name):
+    """
+    Get the pid of a registered process
+
+    :param name:        The process name
+    :type name:         str
+    :return:            The pid, None if the process is not running
+    :rtype:             int|None
+    """
+    entry = get_entry(name)
+    return None if entry is None else entry["pid"]
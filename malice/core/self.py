@@ -21,5 +21,106 @@
 """
 
 
-def check():
-    print("Coucou")
+# Python core libraries
+import os
+import time
+
+
+def _get_checks():
+    import malice.core.config
+    from malice.core import checks
+
+    section = malice.core.config.get_section("check")
+    result = [checks.python_check()]
+    result += [checks.package_check(name, min_version) for name, min_version in checks.REQUIRED_PACKAGES]
+    binaries = list(checks.REQUIRED_BINARIES)
+    binaries += [name.strip() for name in section.get("binaries", "").split(",") if name.strip()]
+    result += [checks.binary_check(name) for name in binaries]
+    dirs = [os.path.dirname(checks.get_cache_path())]
+    if malice.core.config.find_path() is not None:
+        dirs.append(malice.core.config.get_state_path())
+    base_dir = malice.core.config.get_base_dir()
+    dirs += [os.path.join(base_dir, path.strip()) for path in section.get("dirs", "").split(",") if path.strip()]
+    result += [checks.writable_dir_check(os.path.normpath(path)) for path in dirs]
+    for endpoint in section.get("ports", "").split(","):
+        host, _, port = endpoint.strip().rpartition(":")
+        if endpoint.strip():
+            result.append(checks.port_check(host or "127.0.0.1", port))
+    return result
+
+
+def check(refresh=False):
+    """
+    Check the malice installation and the environment it needs.
+    More checks can be configured in the [check] section, ex:
+
+        [check]
+        binaries = docker, git
+        dirs = build, /var/tmp/project
+        ports = 127.0.0.1:5432, registry.local:443
+
+    :param refresh:     Ignore the cached results. Optional, default False
+    :type refresh:      bool
+    :return:            0 if all the checks passed, 1 otherwise
+    :rtype:             int
+    """
+    from malice.core import checks
+
+    start_time = time.monotonic()
+    results = checks.run_checks(_get_checks(), refresh=refresh)
+    width = max(len(result.name) for result in results)
+    for result in results:
+        print(("[ OK ] " if result.ok else "[FAIL] ") + result.name.ljust(width) + "  " + result.details +
+              ("  (cached)" if result.cached else ""))
+    failed = len([result for result in results if not result.ok])
+    duration = "{:.2f}".format(time.monotonic() - start_time) + "s"
+    if failed:
+        print(str(failed) + " check(s) failed, in " + duration)
+        return 1
+    print("All checks passed, in " + duration)
+    return 0
+
+
+def bench(only=None, quick=False, output=None, baseline=None, threshold=0.2):
+    """
+    Benchmark the malice hot paths, and print the results as json
+
+    :param only:        The benchmarks to run. Optional, default all of them
+    :type only:         list[str]|None
+    :param quick:       Smaller runs: faster, less precise. Optional, default False
+    :type quick:        bool
+    :param output:      Write the results to this file instead of printing them. Optional, default None
+    :type output:       str|None
+    :param baseline:    Compare the results to these ones (a previous output). Optional, default None
+    :type baseline:     str|None
+    :param threshold:   The tolerated relative difference with the baseline. Optional, default 0.2 (20%)
+    :type threshold:    float
+    :return:            0, or 1 if a measure regressed from the baseline
+    :rtype:             int
+    """
+    import sys
+    import json
+    from malice.core import bench as benchmarks
+
+    base_results = None
+    if baseline is not None:
+        with open(baseline) as baseline_file:
+            base_results = json.load(baseline_file)
+    results = benchmarks.run_all(only, quick)
+    if output is not None:
+        with open(output, "w") as output_file:
+            json.dump(results, output_file, indent=4)
+    else:
+        json.dump(results, sys.stdout, indent=4)
+        print("")
+    if base_results is None:
+        return 0
+    regressions = benchmarks.compare(results, base_results, threshold)
+    for name, base_value, value in regressions:
+        sys.stderr.write("Regression: " + name + " " + "{:.6g}".format(base_value) + " -> " +
+                         "{:.6g}".format(value) + os.linesep)
+    if regressions:
+        sys.stderr.write(str(len(regressions)) + " regression(s) from " + baseline + os.linesep)
+        return 1
+    sys.stderr.write("No regression from " + baseline + os.linesep)
+    return 0
@@ -0,0 +1,363 @@
+# -*- coding: utf-8 -*-
+# vim: set fileencoding=utf-8:tabstop=4:softtabstop=4:shiftwidth=4:expandtab:textwidth=120
+
+"""
+    Copyright 2019 Samuel Déal
+
+    This file is part of Malice.
+
+    Malice is free software: you can redistribute it and/or modify
+    it under the terms of the GNU General Public License as published by
+    the Free Software Foundation, either version 3 of the License, or
+    (at your option) any later version.
+
+    This program is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU General Public License for more details.
+
+    You should have received a copy of the GNU General Public License
+    along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+    Development services, declared in the configuration file:
+
+        [service:web]
+        command = python3 -m http.server 8000
+        cwd = web
+        ready_tcp = 127.0.0.1:8000
+        ready_http = http://127.0.0.1:8000/
+        ready_log = Serving HTTP
+        ready_timeout = 60
+        depends_on = db, cache
+        stop_timeout = 30
+        watch = web/src, web/templates
+
+    "watch" lists the files and directories whose changes restart the service in watch mode (dev start --watch),
+    the service cwd by default.
+"""
+
+# Python core libraries
+import os
+import collections
+
+# Project specific libs
+from malice.util.type_util import *
+from malice.util import proc_util
+from malice.util import ready_util
+from malice.util import graph_util
+from malice.util import trace_util
+import malice.core.config
+import malice.core.registry
+
+
+SECTION_PREFIX = "service:"
+DEFAULT_READY_TIMEOUT = 60
+DEFAULT_STOP_TIMEOUT = 30
+
+SERVICE_SCHEMA = Schema({
+    "command": field("str", ""),
+    "cwd": field("str", "."),
+    "ready_tcp": field("str", ""),
+    "ready_http": field("str", ""),
+    "ready_log": field("str", ""),
+    "ready_timeout": field("float", DEFAULT_READY_TIMEOUT),
+    "stop_timeout": field("float", DEFAULT_STOP_TIMEOUT),
+    "depends_on": field("list", []),
+    "watch": field("list", []),
+})
+
+
+class Service(object):
+    def __init__(self, name, values, base_dir):
+        """
+        :param name:        The service name
+        :type name:         str
+        :param values:      The service configuration section
+        :type values:       dict[str, str]
+        :param base_dir:    The directory relative paths are resolved from
+        :type base_dir:     str
+        """
+        self.name = name
+        self.values = dict(values)
+        conf = SERVICE_SCHEMA.coerce(values, "Service " + name)
+        if not conf["command"].strip():
+            raise RuntimeError("Service " + name + " has no command")
+        self.command = conf["command"].strip()
+        self.cwd = os.path.join(base_dir, conf["cwd"])
+        self.ready_tcp = None
+        if conf["ready_tcp"].strip():
+            host, _, port = conf["ready_tcp"].strip().rpartition(":")
+            if not ll_int(port):
+                raise RuntimeError("Service " + name + ": invalid ready_tcp " + conf["ready_tcp"])
+            self.ready_tcp = (host or "127.0.0.1", int(port))
+        self.ready_http = conf["ready_http"].strip() or None
+        self.ready_log = conf["ready_log"].strip() or None
+        self.ready_timeout = conf["ready_timeout"]
+        self.stop_timeout = conf["stop_timeout"]
+        self.depends_on = conf["depends_on"]
+        self.watch = [os.path.normpath(os.path.join(base_dir, path)) for path in conf["watch"]] or \
+            [os.path.normpath(self.cwd)]
+
+    def __repr__(self):
+        return "Service(" + self.name + ")"
+
+    def get_log_paths(self):
+        """
+        :return:        The stdout and stderr log files of the service
+        :rtype:         Tuple[str, str]
+        """
+        return (malice.core.config.get_state_path("logs", self.name + ".stdout.log"),
+                malice.core.config.get_state_path("logs", self.name + ".stderr.log"))
+
+    def get_probes(self):
+        """
+        :return:        The readiness probes of the service
+        :rtype:         list[ready_util.TcpProbe|ready_util.HttpProbe|ready_util.LogProbe]
+        """
+        probes = []
+        if self.ready_log:
+            probes.append(ready_util.LogProbe(self.get_log_paths(), self.ready_log))
+        if self.ready_tcp:
+            probes.append(ready_util.TcpProbe(*self.ready_tcp))
+        if self.ready_http:
+            probes.append(ready_util.HttpProbe(self.ready_http))
+        return probes
+
+
+def load_services():
+    """
+    Read the services from the configuration, and check their dependencies
+
+    :return:        The services, by name, in configuration order
+    :rtype:         collections.OrderedDict[str, Service]
+    """
+    base_dir = malice.core.config.get_base_dir()
+    result = collections.OrderedDict()
+    for section, values in malice.core.config.load().items():
+        if section.startswith(SECTION_PREFIX):
+            name = section[len(SECTION_PREFIX):].strip()
+            result[name] = Service(name, values, base_dir)
+    for service in result.values():
+        unknown = [dep for dep in service.depends_on if dep not in result]
+        if unknown:
+            raise RuntimeError("Service " + service.name + " depends on unknown service(s): " + ", ".join(unknown))
+    graph_util.topological_waves(get_dependencies(result))  # Detect cycles up front
+    return result
+
+
+def get_dependencies(services):
+    """
+    :param services:    The services, by name
+    :type services:     dict[str, Service]
+    :return:            The dependency graph of the services
+    :rtype:             dict[str, list[str]]
+    """
+    return {name: service.depends_on for name, service in services.items()}
+
+
+def select_services(services, names):
+    """
+    Select services by name
+
+    :param services:    All the services, by name
+    :type services:     dict[str, Service]
+    :param names:       The wanted names, all the services if empty
+    :type names:        list[str]|None
+    :return:            The selected services
+    :rtype:             list[Service]
+    """
+    if not names:
+        return list(services.values())
+    unknown = [name for name in names if name not in services]
+    if unknown:
+        raise RuntimeError("Unknown service(s): " + ", ".join(unknown))
+    return [services[name] for name in names]
+
+
+def get_owners(services, paths):
+    """
+    Find the services watching changed paths
+
+    :param services:    The services
+    :type services:     list[Service]
+    :param paths:       The changed files or directories, absolute
+    :type paths:        collections.Iterable[str]
+    :return:            The names of the services watching at least one of the paths
+    :rtype:             set[str]
+    """
+    result = set()
+    for path in paths:
+        for service in services:
+            if service.name not in result and \
+                    any(path == root or path.startswith(os.path.join(root, "")) for root in service.watch):
+                result.add(service.name)
+    return result
+
+
+def _exec_service(command, cwd, stdout_path, stderr_path):
+    """Run in the double forked process: redirect the standard streams and replace the process with the service"""
+    null_fd = os.open(os.devnull, os.O_RDONLY)
+    os.dup2(null_fd, 0)
+    os.close(null_fd)
+    for target_fd, path in ((1, stdout_path), (2, stderr_path)):
+        fd = os.open(path, os.O_WRONLY | os.O_CREAT | os.O_APPEND, 0o644)
+        os.dup2(fd, target_fd)
+        os.close(fd)
+    os.chdir(cwd)
+    os.execv("/bin/sh", ["/bin/sh", "-c", "exec " + command])
+
+
+def get_pid(service):
+    """
+    Get the pid of a running service
+
+    :param service:     The service
+    :type service:      Service
+    :return:            The service pid, None if it's not running
+    :rtype:             int|None
+    """
+    return malice.core.registry.get_pid(service.name)
+
+
+def launch(service):
+    """
+    Start a service in background, without waiting for it to be ready, and record it in the registry.
+    The caller should hold the registry lock
+
+    :param service:     The service to start
+    :type service:      Service
+    :return:            The service pid
+    :rtype:             int
+    """
+    with trace_util.span("services.launch", service=service.name):
+        log_paths = service.get_log_paths()
+        log_offsets = [os.path.getsize(path) if os.path.exists(path) else 0 for path in log_paths]
+        pid = proc_util.double_forked_run(_exec_service, service.command, service.cwd, *log_paths)
+        malice.core.registry.register(service.name, pid, service.command, log_offsets=log_offsets)
+    return pid
+
+
+def _get_failure(service, result):
+    if result is None:
+        return None
+    if result == "exited":
+        return "exited during start up"
+    return "not ready after " + to_str(service.ready_timeout) + "s (waiting for " + to_str(result) + ")"
+
+
+def _launch_locked(service):
+    """
+    Launch a service unless it's already running, holding the registry lock.
+    Blocking (the lock, the fork): run it out of the event loop
+
+    :return:    The service pid, and its registry entry (None if it already exited)
+    :rtype:     Tuple[int, dict|None]
+    """
+    with malice.core.registry.locked():
+        entry = malice.core.registry.get_entry(service.name)
+        if entry is not None:
+            return entry["pid"], entry
+        pid = launch(service)
+        return pid, malice.core.registry.get_entry(service.name)
+
+
+async def _start_graph(services, names):
+    import asyncio
+
+    tasks = {}
+    loop = asyncio.get_event_loop()
+
+    async def start_one(service):
+        for dep in service.depends_on:
+            if await tasks[dep] is not None:
+                return "dependency " + dep + " failed"
+        probes = service.get_probes()
+        # Waiting for the lock of another malice invocation must not stall the readiness waits of the others
+        pid, entry = await loop.run_in_executor(None, _launch_locked, service)
+        for probe in probes:
+            if isinstance(probe, ready_util.LogProbe):
+                probe.skip_existing(entry.get("log_offsets") if entry is not None else None)
+        with trace_util.span("services.wait_ready", service=service.name):
+            result = await ready_util.wait_until_ready(probes, service.ready_timeout,
+                                                       lambda: proc_util.is_process_running(pid))
+        return _get_failure(service, result)
+
+    for wave in graph_util.topological_waves({name: services[name].depends_on for name in names}):
+        for name in wave:
+            tasks[name] = loop.create_task(start_one(services[name]))
+    return {name: await task for name, task in tasks.items()}
+
+
+def start(services, names=None):
+    """
+    Start services, and the services they depend on, and wait until they are all ready.
+    Each service is launched as soon as all its dependencies are ready, and all the readiness probes are polled
+    concurrently: the dependency waves are the worst case
+
+    :param services:    All the services, by name
+    :type services:     dict[str, Service]
+    :param names:       The services to start. Optional, default all of them
+    :type names:        collections.Iterable[str]|None
+    :return:            The services which failed to start, with the reason
+    :rtype:             dict[str, str]
+    """
+    names = graph_util.get_requirements(get_dependencies(services), services if names is None else names)
+    results = proc_util.run_async(_start_graph(services, names))
+    return collections.OrderedDict((name, results[name]) for name in services
+                                   if name in results and results[name] is not None)
+
+
+def stop(services, names=None, kill=False):
+    """
+    Stop services, and the services depending on them, in reverse dependency order.
+    The services of each dependency wave are stopped in parallel
+
+    :param services:    All the services, by name
+    :type services:     dict[str, Service]
+    :param names:       The services to stop. Optional, default all of them
+    :type names:        collections.Iterable[str]|None
+    :param kill:        Kill the services instead of asking them to stop. Optional, default False
+    :type kill:         bool
+    :return:            The stopped services, True for each one which stopped gracefully
+    :rtype:             collections.OrderedDict[str, bool]
+    """
+    names = graph_util.get_dependents(get_dependencies(services), services if names is None else names)
+    result = collections.OrderedDict()
+    for wave in reversed(graph_util.topological_waves({name: services[name].depends_on for name in names})):
+        running = [(services[name], get_pid(services[name])) for name in wave]
+        running = [(service, pid) for service, pid in running if pid is not None]
+        if not running:
+            continue
+        if kill:
+            for service, pid in running:
+                proc_util.ensure_kill_proc(pid)
+            stopped = [False] * len(running)
+        else:
+            timeout = max(service.stop_timeout for service, _ in running)
+            stopped = proc_util.ensure_stop_procs([pid for _, pid in running], timeout)
+        with malice.core.registry.locked():
+            malice.core.registry.unregister(service.name for service, _ in running)
+        for (service, _), graceful in zip(running, stopped):
+            result[service.name] = graceful
+    return result
+
+
+def get_status(services):
+    """
+    Get the status of services from the registry, without spawning anything
+
+    :param services:    The services
+    :type services:     list[Service]
+    :return:            For each service: its name, its state ("running", "dead" or "stopped") and its registry
+                        entry (None if stopped)
+    :rtype:             list[Tuple[str, str, dict|None]]
+    """
+    entries = malice.core.registry.read()
+    result = []
+    for service in services:
+        entry = entries.get(service.name)
+        if entry is None:
+            result.append((service.name, "stopped", None))
+        else:
+            result.append((service.name, "running" if malice.core.registry.is_alive(entry) else "dead", entry))
+    return result
@@ -0,0 +1,380 @@
+# -*- coding: utf-8 -*-
+# vim: set fileencoding=utf-8:tabstop=4:softtabstop=4:shiftwidth=4:expandtab:textwidth=120
+
+"""
+    Copyright 2019 Samuel Déal
+
+    This file is part of Malice.
+
+    Malice is free software: you can redistribute it and/or modify
+    it under the terms of the GNU General Public License as published by
+    the Free Software Foundation, either version 3 of the License, or
+    (at your option) any later version.
+
+    This program is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU General Public License for more details.
+
+    You should have received a copy of the GNU General Public License
+    along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+    Optional background server keeping malice modules and configuration loaded.
+    Once started (malice daemon start), the malice entry point becomes a thin client: it sends its arguments,
+    environment and standard streams (as file descriptors) over a unix socket, the daemon forks a worker that runs
+    the command directly on the client streams, and only the exit code comes back on the socket.
+    Set MALICE_DAEMON=off to bypass a running daemon.
+    The client sends its environment and terminal: it only talks to a socket owned by its user, and checks the peer
+    credentials of the daemon. The daemon only serves its own user too.
+"""
+
+# Python core libraries
+import os
+import sys
+import stat
+import socket
+import struct
+import json
+import array
+import signal
+
+# Project specific libs
+from malice.daemon_env import private_dir, socket_path
+
+
+_HEADER = struct.Struct("!I")
+_INT = struct.Struct("!i")
+_PEER_CRED = struct.Struct("3i")  # struct ucred: pid, uid, gid
+_STD_FDS = (0, 1, 2)
+
+
+def _send_message(sock, message, fds=()):
+    data = json.dumps(message).encode("UTF-8")
+    data = _HEADER.pack(len(data)) + data
+    if fds:
+        sent = sock.sendmsg([data], [(socket.SOL_SOCKET, socket.SCM_RIGHTS, array.array("i", fds))])
+        data = data[sent:]
+    if data:
+        sock.sendall(data)
+
+
+def _recv_exactly(sock, length):
+    data = bytearray()
+    while len(data) < length:
+        chunk = sock.recv(length - len(data))
+        if not chunk:
+            raise EOFError("Connection closed by peer")
+        data += chunk
+    return bytes(data)
+
+
+def _recv_message(sock, max_fds=0):
+    fds = array.array("i")
+    if max_fds:
+        header, ancdata, _, _ = sock.recvmsg(_HEADER.size, socket.CMSG_LEN(max_fds * fds.itemsize))
+        for level, kind, cdata in ancdata:
+            if level == socket.SOL_SOCKET and kind == socket.SCM_RIGHTS:
+                fds.frombytes(cdata[:len(cdata) - (len(cdata) % fds.itemsize)])
+        if not header:
+            raise EOFError("Connection closed by peer")
+        header += _recv_exactly(sock, _HEADER.size - len(header))
+    else:
+        header = _recv_exactly(sock, _HEADER.size)
+    length = _HEADER.unpack(header)[0]
+    return json.loads(_recv_exactly(sock, length).decode("UTF-8")), list(fds)
+
+
+def _get_peer_uid(sock):
+    """The user id of the process at the other end of a unix socket, None if the platform can't tell"""
+    if not hasattr(socket, "SO_PEERCRED"):
+        return None
+    return _PEER_CRED.unpack(sock.getsockopt(socket.SOL_SOCKET, socket.SO_PEERCRED, _PEER_CRED.size))[1]
+
+
+def _warn(message):
+    sys.stderr.write("malice: " + message + ", ignoring the daemon" + os.linesep)
+    sys.stderr.flush()
+
+
+def _connect(path=None):
+    path = socket_path() if path is None else path
+    try:
+        path_stat = os.lstat(path)
+    except OSError:
+        return None
+    if not stat.S_ISSOCK(path_stat.st_mode) or path_stat.st_uid != os.getuid():
+        _warn(path + " is not a socket owned by the current user")
+        return None
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        sock.connect(path)
+        peer_uid = _get_peer_uid(sock)
+    except OSError:
+        sock.close()
+        return None
+    if peer_uid != os.getuid():
+        sock.close()
+        _warn(path + " is served by " + ("an unknown user" if peer_uid is None else "user " + str(peer_uid)))
+        return None
+    return sock
+
+
+def forward(argv):
+    """
+    Run a malice command through the daemon
+
+    :param argv:    The command line arguments, without the program name
+    :type argv:     list[str]
+    :return:        The command exit code, None if no daemon is available
+    :rtype:         int|None
+    """
+    sock = _connect()
+    if sock is None:
+        return None
+    with sock:
+        try:
+            _send_message(sock, {"type": "run", "argv": list(argv), "cwd": os.getcwd(), "env": dict(os.environ)},
+                          fds=_STD_FDS)
+            worker_pid = _INT.unpack(_recv_exactly(sock, _INT.size))[0]
+        except (OSError, EOFError):
+            return None
+        except KeyboardInterrupt:
+            _interrupt_pending_worker(sock)
+            return 130
+        while True:
+            try:
+                return _INT.unpack(_recv_exactly(sock, _INT.size))[0]
+            except KeyboardInterrupt:
+                # The worker is not in our process group: forward the interruption
+                try:
+                    os.kill(worker_pid, signal.SIGINT)
+                except OSError:
+                    pass
+            except EOFError:
+                return 1
+
+
+def _interrupt_pending_worker(sock):
+    """
+    Interrupted before the worker pid arrived: if the daemon forked it anyway, interrupt it too,
+    rather than leave it running on our terminal
+    """
+    try:
+        sock.settimeout(1.0)
+        worker_pid = _INT.unpack(_recv_exactly(sock, _INT.size))[0]
+        os.kill(worker_pid, signal.SIGINT)
+    except (OSError, EOFError):
+        pass
+
+
+def request(message_type, path=None):
+    """
+    Send a control request to the daemon
+
+    :param message_type:    The request type, "ping" or "stop"
+    :type message_type:     str
+    :param path:            The daemon socket. Optional, default socket_path()
+    :type path:             str|None
+    :return:                The daemon answer, None if no daemon is available
+    :rtype:                 dict|None
+    """
+    sock = _connect(path)
+    if sock is None:
+        return None
+    with sock:
+        try:
+            _send_message(sock, {"type": message_type})
+            return _recv_message(sock)[0]
+        except (OSError, EOFError):
+            return None
+
+
+def _config_arg(argv):
+    for i, arg in enumerate(argv):
+        if arg in ("--config", "-c") and i + 1 < len(argv):
+            return argv[i + 1]
+        if arg.startswith("--config="):
+            return arg[len("--config="):]
+    return None
+
+
+def _preload(message):
+    """Refresh the state kept in the daemon, so that workers inherit it already loaded"""
+    import malice.core.config
+    try:
+        path = malice.core.config.find_path(_config_arg(message["argv"]), message["cwd"], message["env"])
+        if path is not None:
+            malice.core.config.load(path)
+    except Exception:
+        pass  # The worker will report the error
+
+
+def _run_worker(server, conn, message, fds):
+    import malice.malice
+
+    server.close()
+    signal.signal(signal.SIGCHLD, signal.SIG_DFL)
+    signal.signal(signal.SIGTERM, signal.SIG_DFL)
+    signal.signal(signal.SIGINT, signal.default_int_handler)
+    for target_fd, client_fd in zip(_STD_FDS, fds):
+        os.dup2(client_fd, target_fd)
+    for client_fd in fds:
+        if client_fd not in _STD_FDS:
+            os.close(client_fd)
+    os.chdir(message["cwd"])
+    os.environ.clear()
+    os.environ.update(message["env"])
+    sys.argv = ["malice"] + message["argv"]
+    code = 1
+    try:
+        code = malice.malice.run(message["argv"])
+        if code is None:
+            code = 0
+        elif not isinstance(code, int):
+            sys.stderr.write(str(code) + os.linesep)
+            code = 1
+    finally:
+        try:
+            sys.stdout.flush()
+            sys.stderr.flush()
+            conn.sendall(_INT.pack(code))
+        finally:
+            os._exit(code & 0xff)
+
+
+def _handle(server, conn):
+    if _get_peer_uid(conn) != os.getuid():
+        return True  # Only serve our own user
+    message, fds = _recv_message(conn, max_fds=len(_STD_FDS))
+    if message["type"] == "ping":
+        _send_message(conn, {"pid": os.getpid()})
+        return True
+    elif message["type"] == "stop":
+        _send_message(conn, {"pid": os.getpid()})
+        return False
+    elif message["type"] != "run":
+        for client_fd in fds:
+            os.close(client_fd)
+        _send_message(conn, {"error": "unknown request type " + str(message["type"])})
+        return True
+
+    _preload(message)
+    sys.stdout.flush()
+    sys.stderr.flush()
+    pid = os.fork()
+    if pid == 0:
+        _run_worker(server, conn, message, fds)
+    for client_fd in fds:
+        os.close(client_fd)
+    conn.sendall(_INT.pack(pid))
+    return True
+
+
+def _make_private_dir(path):
+    """Create the private socket directory, and check that nobody else owns or can access it"""
+    try:
+        os.mkdir(path, 0o700)
+    except FileExistsError:
+        pass
+    dir_stat = os.lstat(path)
+    if not stat.S_ISDIR(dir_stat.st_mode) or dir_stat.st_uid != os.getuid() or dir_stat.st_mode & 0o077:
+        raise RuntimeError(path + " must be a directory owned by the current user, with mode 0700")
+
+
+def serve(path=None):
+    """
+    Run the daemon loop until a stop request
+
+    :param path:    The unix socket path. Optional, default socket_path()
+    :type path:     str|None
+    """
+    import importlib
+    import malice.commands
+
+    path = socket_path() if path is None else path
+    if os.path.dirname(path) == private_dir():
+        _make_private_dir(private_dir())
+    for command in malice.commands.COMMANDS:
+        importlib.import_module(command.module)
+
+    null_fd = os.open(os.devnull, os.O_RDWR)
+    for std_fd in _STD_FDS:
+        os.dup2(null_fd, std_fd)
+    os.close(null_fd)
+    signal.signal(signal.SIGCHLD, signal.SIG_IGN)  # Workers are reaped automatically
+
+    try:
+        os.unlink(path)
+    except OSError:
+        pass
+    server = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    old_umask = os.umask(0o077)
+    try:
+        server.bind(path)
+    finally:
+        os.umask(old_umask)
+    server.listen(64)
+    try:
+        running = True
+        while running:
+            conn, _ = server.accept()
+            with conn:
+                try:
+                    running = _handle(server, conn)
+                except (OSError, EOFError, ValueError, KeyError):
+                    pass
+    finally:
+        server.close()
+        try:
+            os.unlink(path)
+        except OSError:
+            pass
+
+
+def start():
+    """
+    Start the daemon in background, if it's not already running
+    """
+    import time
+    from malice.util import proc_util
+
+    answer = request("ping")
+    if answer is not None:
+        print("Daemon already running (pid " + str(answer["pid"]) + ")")
+        return 0
+    path = socket_path()
+    if os.path.dirname(path) == private_dir():
+        _make_private_dir(private_dir())  # Checked here too: errors in the daemon process are not visible
+    proc_util.double_forked_run(serve, path)
+    deadline = time.time() + 10
+    while time.time() < deadline:
+        answer = request("ping", path)
+        if answer is not None:
+            print("Daemon started (pid " + str(answer["pid"]) + ")")
+            return 0
+        time.sleep(0.01)
+    raise RuntimeError("Unable to start the malice daemon")
+
+
+def stop():
+    """
+    Stop the daemon, if it's running
+    """
+    answer = request("stop")
+    if answer is None:
+        print("Daemon not running")
+    else:
+        print("Daemon stopped (pid " + str(answer["pid"]) + ")")
+    return 0
+
+
+def status():
+    """
+    Print the daemon status
+    """
+    answer = request("ping")
+    if answer is None:
+        print("Daemon not running")
+        return 3
+    print("Daemon running (pid " + str(answer["pid"]) + ", socket " + socket_path() + ")")
+    return 0
@@ -0,0 +1,67 @@
+# -*- coding: utf-8 -*-
+# vim: set fileencoding=utf-8:tabstop=4:softtabstop=4:shiftwidth=4:expandtab:textwidth=120
+
+"""
+    Copyright 2019 Samuel Déal
+
+    This file is part of Malice.
+
+    Malice is free software: you can redistribute it and/or modify
+    it under the terms of the GNU General Public License as published by
+    the Free Software Foundation, either version 3 of the License, or
+    (at your option) any later version.
+
+    This program is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU General Public License for more details.
+
+    You should have received a copy of the GNU General Public License
+    along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+    Location and switch of the background daemon.
+    The entry point reads them on every invocation, before deciding to import malice.daemon: only use os here.
+"""
+
+# Python core libraries
+import os
+
+
+DAEMON_ENV_VAR = "MALICE_DAEMON"
+SOCKET_ENV_VAR = "MALICE_SOCKET"
+
+
+def private_dir():
+    """
+    Get the per user directory holding the socket when there is no $XDG_RUNTIME_DIR.
+    The daemon creates it with mode 0700
+
+    :return:        The directory path
+    :rtype:         str
+    """
+    return os.path.join("/tmp", "malice-" + str(os.getuid()))
+
+
+def socket_path():
+    """
+    Get the daemon socket location
+
+    :return:        The unix socket path
+    :rtype:         str
+    """
+    if os.environ.get(SOCKET_ENV_VAR):
+        return os.environ[SOCKET_ENV_VAR]
+    runtime_dir = os.environ.get("XDG_RUNTIME_DIR")
+    if runtime_dir and os.path.isdir(runtime_dir):
+        return os.path.join(runtime_dir, "malice.sock")
+    return os.path.join(private_dir(), "malice.sock")
+
+
+def is_disabled():
+    """
+    Check if the user asked to bypass the daemon
+
+    :return:        True if $MALICE_DAEMON is off
+    :rtype:         bool
+    """
+    return os.environ.get(DAEMON_ENV_VAR, "").strip().lower() in ('no', 'false', 'f', 'n', '0', 'non', 'off')
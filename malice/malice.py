@@ -25,68 +25,33 @@
 # Core libs
 import sys
 import os
-import argparse
-import argcomplete
-# import configparser
-#
+# argparse, argcomplete and the command modules are imported on demand: see malice.commands
 
 # Project specific libs
-import malice.core.dev
-import malice.core.self
+from malice.util import trace_util
+from malice import daemon_env
+import malice.commands
 
 
-def run():
-    usage_str = """
-    
-    """
+def run(argv=None):
+    args = None
     try:
-        # common_parser = argparse.ArgumentParser(prog="malice", add_help=False)
-        parser = argparse.ArgumentParser(prog="malice",
-                                         description='Manipulate docker for this project',
-                                         #usage=usage_str,
-                                         # parents=[common_parser]
-                                         )
-        parser.add_argument("--config", "-c", metavar='FILE', help="Configuration file location")
-
-        subparsers = parser.add_subparsers(help='sub-command help', dest="command")
-        parser_dev = subparsers.add_parser("dev")
-        dev_subparsers = parser_dev.add_subparsers(help='sub-command help', dest="sub_command")
-        dev_subparsers.add_parser("start")
-        dev_subparsers.add_parser("restart")
-        dev_subparsers.add_parser("stop")
-        dev_subparsers.add_parser("kill")
-        dev_subparsers.add_parser("clean")
-
-        parser_self = subparsers.add_parser("self")
-        self_subparsers = parser_self.add_subparsers(help='sub-command help', dest="sub_command")
-        self_subparsers.add_parser("check")
-
-        argcomplete.autocomplete(parser)
-        args = parser.parse_args()
+        parser = malice.commands.build_parser()
+        if "_ARGCOMPLETE" in os.environ:
+            import argcomplete
+            argcomplete.autocomplete(parser)
+        args = parser.parse_args(argv)
         if args.command is None:
             parser.error("No command provided")
-        command = args.command
-        if args.sub_command:
-            command += ":" + args.sub_command
-
-        if command == "dev":
-            parser.error("Missing check sub command")
-        elif command == "dev:start":
-            malice.core.dev.start()
-        elif command == "dev:restart":
-            malice.core.dev.restart()
-        elif command == "dev:stop":
-            malice.core.dev.stop()
-        elif command == "dev:kill":
-            malice.core.dev.kill()
-        elif command == "dev:clean":
-            malice.core.dev.clean()
-        elif command == "self":
-            parser.error("Missing check sub command")
-        elif command == "self:check":
-            malice.core.self.check()
-        else:
-            parser.error("Missing check sub command")
+        command = malice.commands.find_command(args.command, args.sub_command)
+        if command is None:
+            parser.error("Missing " + args.command + " sub command")
+        if args.profile:
+            trace_util.enable()
+        from malice.core import config
+        config.set_path(args.config)
+        with trace_util.span("command " + command.group + " " + command.name):
+            return malice.commands.dispatch(command, args)
     except KeyboardInterrupt:
         sys.stderr.write(os.linesep+"Aborted"+os.linesep)
         sys.stderr.flush()
@@ -97,9 +62,31 @@ def run():
         sys.stderr.write(os.linesep + str(e) + os.linesep)
         sys.stderr.flush()
         return 1
+    finally:
+        if args is not None and getattr(args, "profile", None):
+            _write_profile(args.profile)
+
+
+def _write_profile(path):
+    trace_util.disable()
+    try:
+        trace_util.write_chrome_trace(path)
+    except OSError as e:
+        sys.stderr.write("Can't write the trace: " + str(e) + os.linesep)
+    sys.stderr.write(trace_util.get_summary() + os.linesep)
+    sys.stderr.flush()
 
 
 def main():
+    argv = sys.argv[1:]
+    # Profiled commands run here: the trace then covers what the command really costs, start up included.
+    # malice.daemon (sockets, json) is only imported when there is a daemon to forward to
+    if "_ARGCOMPLETE" not in os.environ and argv[:1] != ["daemon"] and "--profile" not in argv \
+            and not daemon_env.is_disabled() and os.path.exists(daemon_env.socket_path()):
+        import malice.daemon
+        code = malice.daemon.forward(argv)
+        if code is not None:
+            sys.exit(code)
     sys.exit(run())
 
 
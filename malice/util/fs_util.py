@@ -0,0 +1,468 @@
+# -*- coding: utf-8 -*-
+# vim: set fileencoding=utf-8:tabstop=4:softtabstop=4:shiftwidth=4:expandtab:textwidth=120
+
+"""
+    Copyright 2019 Samuel Déal
+
+    This file is part of Malice.
+
+    Malice is free software: you can redistribute it and/or modify
+    it under the terms of the GNU General Public License as published by
+    the Free Software Foundation, either version 3 of the License, or
+    (at your option) any later version.
+
+    This program is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU General Public License for more details.
+
+    You should have received a copy of the GNU General Public License
+    along with this program.  If not, see <https://www.gnu.org/licenses/>.
+"""
+
+# Python core libraries
+import os
+import struct
+import select
+import collections
+
+
+IN_MODIFY = 0x00000002
+IN_ATTRIB = 0x00000004
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_FROM = 0x00000040
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_DELETE = 0x00000200
+IN_DELETE_SELF = 0x00000400
+IN_MOVE_SELF = 0x00000800
+IN_Q_OVERFLOW = 0x00004000
+IN_IGNORED = 0x00008000
+IN_ONLYDIR = 0x01000000
+IN_ISDIR = 0x40000000
+
+_EVENT_STRUCT = struct.Struct("iIII")
+
+InotifyEvent = collections.namedtuple("InotifyEvent", ("wd", "mask", "cookie", "name"))
+
+
+class Inotify(object):
+    """
+    Minimal inotify binding (Linux only), through ctypes.
+    Use is_available() before creating one, and fall back to polling otherwise
+    """
+
+    _libc = None
+
+    @classmethod
+    def _get_libc(cls):
+        if cls._libc is None:
+            import ctypes
+            import ctypes.util
+
+            libc = ctypes.CDLL(ctypes.util.find_library("c") or "libc.so.6", use_errno=True)
+            libc.inotify_init1.argtypes = (ctypes.c_int,)
+            libc.inotify_add_watch.argtypes = (ctypes.c_int, ctypes.c_char_p, ctypes.c_uint32)
+            libc.inotify_rm_watch.argtypes = (ctypes.c_int, ctypes.c_int)
+            cls._libc = libc
+        return cls._libc
+
+    @classmethod
+    def is_available(cls):
+        """
+        :return:        True if inotify can be used on this system
+        :rtype:         bool
+        """
+        try:
+            return hasattr(cls._get_libc(), "inotify_init1")
+        except (OSError, AttributeError):
+            return False
+
+    def __init__(self):
+        import ctypes
+
+        self.fd = self._get_libc().inotify_init1(os.O_CLOEXEC | os.O_NONBLOCK)
+        if self.fd < 0:
+            errno = ctypes.get_errno()
+            raise OSError(errno, os.strerror(errno))
+
+    def add_watch(self, path, mask):
+        """
+        Watch a file or a directory
+
+        :param path:    The path to watch
+        :type path:     str
+        :param mask:    The events to watch (IN_* constants)
+        :type mask:     int
+        :return:        The watch descriptor
+        :rtype:         int
+        """
+        import ctypes
+
+        wd = self._get_libc().inotify_add_watch(self.fd, os.fsencode(path), mask)
+        if wd < 0:
+            errno = ctypes.get_errno()
+            raise OSError(errno, os.strerror(errno), path)
+        return wd
+
+    def rm_watch(self, wd):
+        self._get_libc().inotify_rm_watch(self.fd, wd)
+
+    def read_events(self, timeout=None):
+        """
+        Wait for events
+
+        :param timeout:     The maximum amount of time to wait, in seconds. Optional, default None: wait forever
+        :type timeout:      float|None
+        :return:            The events, empty if the timeout expired
+        :rtype:             list[InotifyEvent]
+        """
+        if not select.select([self.fd], [], [], timeout)[0]:
+            return []
+        try:
+            data = os.read(self.fd, 256 * 1024)
+        except BlockingIOError:
+            return []
+        events = []
+        offset = 0
+        while offset < len(data):
+            wd, mask, cookie, length = _EVENT_STRUCT.unpack_from(data, offset)
+            offset += _EVENT_STRUCT.size
+            name = os.fsdecode(data[offset:offset + length].rstrip(b"\0"))
+            offset += length
+            events.append(InotifyEvent(wd, mask, cookie, name))
+        return events
+
+    def close(self):
+        if self.fd >= 0:
+            os.close(self.fd)
+            self.fd = -1
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *unused):
+        self.close()
+
+
+def tail_lines(path, count, block_size=64 * 1024):
+    """
+    Read the last lines of a file, reading it backwards by blocks: the cost doesn't depend on the file size
+
+    :param path:        The file path
+    :type path:         str
+    :param count:       The number of lines to read
+    :type count:        int
+    :param block_size:  The size of each read. Optional, default 64 KiB
+    :type block_size:   int
+    :return:            The lines (with their end of line), and the file size they were read from
+    :rtype:             Tuple[collections.deque[bytes], int]
+    """
+    lines = collections.deque(maxlen=count)
+    try:
+        with open(path, "rb") as tail_file:
+            size = tail_file.seek(0, os.SEEK_END)
+            if count <= 0:
+                return lines, size
+            end = size
+            data = b""
+            while end > 0 and data.count(b"\n") <= count:
+                start = max(0, end - block_size)
+                tail_file.seek(start)
+                data = tail_file.read(end - start) + data
+                end = start
+    except OSError:
+        return lines, 0
+    chunks = data.splitlines(True)
+    if end > 0 and len(chunks) > count:
+        chunks = chunks[1:]  # Probably a partial line
+    lines.extend(chunks)
+    return lines, size
+
+
+_TREE_EVENTS = IN_MODIFY | IN_CLOSE_WRITE | IN_CREATE | IN_DELETE | IN_MOVED_FROM | IN_MOVED_TO | IN_DELETE_SELF
+
+
+class TreeWatcher(object):
+    """
+    Watch files and directory trees for changes, and report them in debounced batches.
+    Directories are registered recursively once, then directories created later are registered as they appear.
+    Uses inotify when available, otherwise compares snapshots of the trees (modification time and size)
+    """
+
+    def __init__(self, roots, ignored=None, poll_interval=0.5):
+        """
+        :param roots:           The files and directories to watch
+        :type roots:            list[str]
+        :param ignored:         Paths not to watch (with everything below). Optional, default None
+        :type ignored:          list[str]|None
+        :param poll_interval:   The delay between two snapshots without inotify, in seconds. Optional, default 0.5
+        :type poll_interval:    float
+        """
+        self.roots = [os.path.abspath(root) for root in roots]
+        self.ignored = set(os.path.abspath(path) for path in ignored or ())
+        self.poll_interval = poll_interval
+        self._inotify = Inotify() if Inotify.is_available() else None
+        self._dirs = {}  # wd -> directory
+        self._filters = {}  # wd -> names watched in the directory, None for all of them
+        self._snapshot = None
+        if self._inotify is None:
+            self._snapshot = self._take_snapshot()
+            return
+        for root in self.roots:
+            if os.path.isdir(root):
+                self._add_tree(root)
+            else:
+                self._add_dir(os.path.dirname(root), os.path.basename(root))
+
+    def _is_ignored(self, path):
+        name = os.path.basename(path)
+        return name.startswith(".") or name.endswith("~") or name == "__pycache__" or path in self.ignored
+
+    def _add_dir(self, directory, name=None):
+        try:
+            wd = self._inotify.add_watch(directory, _TREE_EVENTS)
+        except OSError:
+            return  # Removed meanwhile, or not readable
+        self._dirs[wd] = directory
+        if name is None:
+            self._filters[wd] = None
+        elif self._filters.get(wd, set()) is not None:
+            self._filters.setdefault(wd, set()).add(name)
+
+    def _add_tree(self, root):
+        self._add_dir(root)
+        for directory, dir_names, _ in os.walk(root):
+            dir_names[:] = [name for name in dir_names if not self._is_ignored(os.path.join(directory, name))]
+            for name in dir_names:
+                self._add_dir(os.path.join(directory, name))
+
+    def _take_snapshot(self):
+        result = {}
+        for root in self.roots:
+            if not os.path.isdir(root):
+                try:
+                    stat = os.stat(root)
+                    result[root] = (stat.st_mtime_ns, stat.st_size)
+                except OSError:
+                    pass
+                continue
+            pending = [root]
+            while pending:
+                try:
+                    entries = list(os.scandir(pending.pop()))
+                except OSError:
+                    continue
+                for entry in entries:
+                    if self._is_ignored(entry.path):
+                        continue
+                    try:
+                        if entry.is_dir(follow_symlinks=False):
+                            pending.append(entry.path)
+                            continue
+                        stat = entry.stat()
+                    except OSError:
+                        continue
+                    result[entry.path] = (stat.st_mtime_ns, stat.st_size)
+        return result
+
+    def _read_changes(self, timeout):
+        if self._inotify is None:
+            import time
+
+            time.sleep(timeout if timeout is not None else self.poll_interval)
+            snapshot = self._take_snapshot()
+            changed = set(path for path in set(snapshot) | set(self._snapshot)
+                          if snapshot.get(path) != self._snapshot.get(path))
+            self._snapshot = snapshot
+            return changed
+
+        changed = set()
+        for event in self._inotify.read_events(timeout):
+            if event.mask & IN_Q_OVERFLOW:
+                changed.update(self.roots)  # Events were lost: consider everything changed
+                continue
+            directory = self._dirs.get(event.wd)
+            if directory is None:
+                continue
+            if event.mask & IN_IGNORED:
+                del self._dirs[event.wd]
+                self._filters.pop(event.wd, None)
+                continue
+            names = self._filters.get(event.wd)
+            path = os.path.join(directory, event.name) if event.name else directory
+            if names is not None:
+                if event.name not in names:
+                    continue
+            elif self._is_ignored(path):
+                continue
+            if event.mask & IN_ISDIR and event.mask & (IN_CREATE | IN_MOVED_TO):
+                self._add_tree(path)
+            changed.add(path)
+        return changed
+
+    def wait(self, timeout=None, debounce=0.3, max_delay=2.0):
+        """
+        Wait for changes. Once something changed, wait until nothing changes for debounce seconds, so a burst of
+        events (a checkout, a build, an editor saving) is reported once
+
+        :param timeout:     The maximum amount of time to wait for a first change, in seconds. Optional, default None:
+                            wait forever
+        :type timeout:      float|None
+        :param debounce:    The quiet time ending a burst, in seconds. Optional, default 0.3
+        :type debounce:     float
+        :param max_delay:   The maximum duration of a burst, in seconds. Optional, default 2
+        :type max_delay:    float
+        :return:            The changed paths, empty if the timeout expired
+        :rtype:             set[str]
+        """
+        import time
+
+        deadline = None if timeout is None else time.monotonic() + timeout
+        changed = set()
+        while not changed:
+            remaining = None if deadline is None else deadline - time.monotonic()
+            if remaining is not None and remaining <= 0:
+                return changed
+            if self._inotify is None:
+                remaining = self.poll_interval if remaining is None else min(remaining, self.poll_interval)
+            changed = self._read_changes(remaining)
+        burst_end = time.monotonic() + max_delay
+        while True:
+            remaining = burst_end - time.monotonic()
+            if remaining <= 0:
+                return changed
+            more = self._read_changes(min(remaining, debounce if self._inotify else max(debounce, self.poll_interval)))
+            if not more:
+                return changed
+            changed |= more
+
+    def close(self):
+        if self._inotify is not None:
+            self._inotify.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *unused):
+        self.close()
+
+
+TreeStats = collections.namedtuple("TreeStats", ("files", "dirs", "size", "errors"))
+TreeStats.__doc__ = """Result of remove_trees: the number of files and directories, their disk usage (directories
+included) and the failures"""
+
+
+def _clear_dir(path, dry_run):
+    files = 0
+    size = 0
+    sub_dirs = []
+    errors = []
+    try:
+        entries = list(os.scandir(path))
+    except OSError as e:
+        return files, size, sub_dirs, [e]
+    for entry in entries:
+        try:
+            size += entry.stat(follow_symlinks=False).st_blocks * 512
+            if entry.is_dir(follow_symlinks=False):
+                sub_dirs.append(entry.path)
+                continue
+            if not dry_run:
+                os.unlink(entry.path)
+            files += 1
+        except OSError as e:
+            errors.append(e)
+    return files, size, sub_dirs, errors
+
+
+def _clear_dir_entry(path, dry_run):
+    try:
+        size = os.lstat(path).st_blocks * 512
+        if not dry_run:
+            os.unlink(path)
+    except OSError as e:
+        return TreeStats(0, 0, 0, [e])
+    return TreeStats(1, 0, size, [])
+
+
+def _remove_dir(path):
+    try:
+        os.rmdir(path)
+    except OSError as e:
+        return e
+    return None
+
+
+def remove_trees(paths, dry_run=False, max_workers=16):
+    """
+    Remove directory trees, listing and deleting the directories in parallel, all the trees at once: on trees of many
+    small files the cost is the system calls latency, which threads overlap.
+    Symbolic links are removed, never followed
+
+    :param paths:           The trees to remove. Missing paths are ignored, and so are the ones inside another tree:
+                            they are removed with it
+    :type paths:            list[str]
+    :param dry_run:         Only compute what would be removed. Optional, default False
+    :type dry_run:          bool
+    :param max_workers:     The number of threads. Optional, default 16
+    :type max_workers:      int
+    :return:                What was removed (or would be), by path
+    :rtype:                 dict[str, TreeStats]
+    """
+    import queue
+    import concurrent.futures
+
+    result = {}
+    trees = {}  # [files, size, dirs, errors] by root directory
+    roots = [os.path.join(os.path.normpath(path), "") for path in paths]
+    with concurrent.futures.ThreadPoolExecutor(max_workers) as executor:
+        done = queue.SimpleQueue()  # Cheaper than concurrent.futures.wait on millions of futures
+
+        def submit(root, directory):
+            executor.submit(_clear_dir, directory, dry_run).add_done_callback(lambda future: done.put((root, future)))
+
+        seen = set()
+        for root, prefix in zip(paths, roots):
+            if prefix in seen or not os.path.lexists(root) or \
+                    any(prefix != other and prefix.startswith(other) for other in roots):
+                continue
+            seen.add(prefix)
+            if os.path.islink(root) or not os.path.isdir(root):
+                result[root] = _clear_dir_entry(root, dry_run)
+                continue
+            try:
+                root_size = os.lstat(root).st_blocks * 512
+            except OSError:
+                root_size = 0
+            trees[root] = [0, root_size, [root], []]
+            submit(root, root)
+        pending = len(trees)
+        while pending:
+            root, future = done.get()
+            dir_files, dir_size, sub_dirs, dir_errors = future.result()
+            pending -= 1
+            tree = trees[root]
+            tree[0] += dir_files
+            tree[1] += dir_size
+            tree[2] += sub_dirs
+            tree[3] += dir_errors
+            for sub_dir in sub_dirs:
+                submit(root, sub_dir)
+            pending += len(sub_dirs)
+
+        if not dry_run:
+            # Deepest first: a directory is empty once its sub-directories are removed
+            by_depth = {}
+            for root, tree in trees.items():
+                for directory in tree[2]:
+                    by_depth.setdefault(directory.count(os.sep), []).append((root, directory))
+            for depth in sorted(by_depth, reverse=True):
+                removals = by_depth[depth]
+                for (root, _), error in zip(removals, executor.map(_remove_dir, [path for _, path in removals])):
+                    if error is not None:
+                        trees[root][3].append(error)
+    for root, (files, size, dirs, errors) in trees.items():
+        result[root] = TreeStats(files, len(dirs), size, errors)
+    return {path: result[path] for path in paths if path in result}
+
@@ -0,0 +1,124 @@
+# -*- coding: utf-8 -*-
+# vim: set fileencoding=utf-8:tabstop=4:softtabstop=4:shiftwidth=4:expandtab:textwidth=120
+
+"""
+    Copyright 2019 Samuel Déal
+
+    This file is part of Malice.
+
+    Malice is free software: you can redistribute it and/or modify
+    it under the terms of the GNU General Public License as published by
+    the Free Software Foundation, either version 3 of the License, or
+    (at your option) any later version.
+
+    This program is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU General Public License for more details.
+
+    You should have received a copy of the GNU General Public License
+    along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+    Dependency graphs, given as a dictionary: node => the nodes it depends on
+"""
+
+
+class CycleError(RuntimeError):
+    def __init__(self, cycle):
+        RuntimeError.__init__(self, "Dependency cycle: " + " -> ".join(cycle))
+        self.cycle = cycle
+
+
+def _find_cycle(dependencies, nodes):
+    """
+    Find a dependency cycle among nodes which all belong to (or lead to) one
+
+    :param dependencies:    The dependency graph
+    :type dependencies:     dict[str, list[str]]
+    :param nodes:           The nodes left by the topological sort
+    :type nodes:            set[str]
+    :return:                The cycle, its first node repeated at the end
+    :rtype:                 list[str]
+    """
+    path = [sorted(nodes)[0]]
+    seen = {path[0]: 0}
+    while True:
+        node = next(dep for dep in sorted(dependencies[path[-1]]) if dep in nodes)
+        if node in seen:
+            return path[seen[node]:] + [node]
+        seen[node] = len(path)
+        path.append(node)
+
+
+def topological_waves(dependencies):
+    """
+    Sort a dependency graph in waves: each node comes after all its dependencies,
+    and the nodes of a wave don't depend on each other
+
+    :param dependencies:    The dependency graph. Dependencies outside the graph are ignored
+    :type dependencies:     dict[str, collections.Iterable[str]]
+    :return:                The waves, each one sorted by name
+    :rtype:                 list[list[str]]
+    """
+    dependencies = {node: set(deps) & set(dependencies) for node, deps in dependencies.items()}
+    dependents = {node: [] for node in dependencies}
+    remaining = {}
+    for node, deps in dependencies.items():
+        remaining[node] = len(deps)
+        for dep in deps:
+            dependents[dep].append(node)
+
+    waves = []
+    wave = sorted(node for node, count in remaining.items() if count == 0)
+    while wave:
+        waves.append(wave)
+        next_wave = []
+        for node in wave:
+            del remaining[node]
+            for dependent in dependents[node]:
+                remaining[dependent] -= 1
+                if remaining[dependent] == 0:
+                    next_wave.append(dependent)
+        wave = sorted(next_wave)
+    if remaining:
+        raise CycleError(_find_cycle(dependencies, set(remaining)))
+    return waves
+
+
+def get_requirements(dependencies, nodes):
+    """
+    Get nodes and everything they depend on, directly or not
+
+    :param dependencies:    The dependency graph
+    :type dependencies:     dict[str, collections.Iterable[str]]
+    :param nodes:           The starting nodes
+    :type nodes:            collections.Iterable[str]
+    :return:                The nodes and their dependencies
+    :rtype:                 set[str]
+    """
+    result = set()
+    todo = list(nodes)
+    while todo:
+        node = todo.pop()
+        if node not in result:
+            result.add(node)
+            todo.extend(dependencies.get(node, ()))
+    return result
+
+
+def get_dependents(dependencies, nodes):
+    """
+    Get nodes and everything depending on them, directly or not
+
+    :param dependencies:    The dependency graph
+    :type dependencies:     dict[str, collections.Iterable[str]]
+    :param nodes:           The starting nodes
+    :type nodes:            collections.Iterable[str]
+    :return:                The nodes and their dependents
+    :rtype:                 set[str]
+    """
+    dependents = {}
+    for node, deps in dependencies.items():
+        for dep in deps:
+            dependents.setdefault(dep, []).append(node)
+    return get_requirements(dependents, nodes)
@@ -23,47 +23,65 @@
 
 # Python core libraries
 import sys
+import collections
 import subprocess
 import os
 import signal
 import time
-import multiprocessing
-import queue
-import pickle
-try:
-    import readline  # For readline input support
-except ImportError:
-    pass
+import struct
+# pickle is imported where it is used, to keep malice start up fast
 
 # Project specific libs
-from util.type_util import *
-import util.util
+from malice.util.type_util import *
+from malice.util import util
+from malice.util import trace_util
+
+
+_PID_STRUCT = struct.Struct("!i")
+_FRAME_HEADER = struct.Struct("!Q")
+_fork_server = None
 
 
 def double_fork():
     """
-    Do a double fork and kill intermediate parent
+    Do a double fork and kill intermediate parent.
+    The intermediate process sends the grandchild pid back through a pipe, so nobody waits actively.
+    The grandchild runs in its own session (and process group).
 
     :return:        True on child, False for parent (and raise exception on error)
     :rtype:         Tuple[bool, int, int]
     """
-    child_pid_val = multiprocessing.Value('i', 0)
-    parent_ready_val = multiprocessing.Value('i', 0)
+    read_fd, write_fd = os.pipe()
     parent_pid = os.getpid()
     newpid = os.fork()
     if newpid == 0:  # We are in the first child process
-        newpid = os.fork()
+        os.close(read_fd)
+        try:
+            newpid = os.fork()
+        except BaseException:
+            os._exit(1)
         if newpid == 0:
-            child_pid_val.value = os.getpid()
-            while parent_ready_val.value != 0:
-                time.sleep(0.0001)
+            os.close(write_fd)
+            os.setsid()
             return True, parent_pid, os.getpid()
         else:
-            os._exit(0)  # Ensure brutal kill of intermediate parent
+            try:
+                os.write(write_fd, _PID_STRUCT.pack(newpid))
+            finally:
+                os._exit(0)  # Ensure brutal kill of intermediate parent
     else:
-        while child_pid_val.value == 0:
-            time.sleep(0.0001)
-        return False, parent_pid, int(child_pid_val.value)
+        os.close(write_fd)
+        try:
+            os.waitpid(newpid, 0)
+            data = b""
+            while len(data) < _PID_STRUCT.size:
+                chunk = os.read(read_fd, _PID_STRUCT.size - len(data))
+                if not chunk:
+                    raise RuntimeError("Unable to run a double fork cleanly")
+                data += chunk
+        finally:
+            os.close(read_fd)
+        return False, parent_pid, _PID_STRUCT.unpack(data)[0]
 
 
 def double_forked_run(func, *func_args, **func_kwargs):
@@ -79,17 +97,311 @@ def double_forked_run(func, *func_args, **func_kwargs):
     :return:                The pid of the double-forked function process
     :rtype:                 int
     """
-    proc_queue = multiprocessing.Queue()
-    proc = multiprocessing.Process(target=_forked_call, args=(proc_queue, func, func_args, func_kwargs))
-    proc.start()
+    # Until the fork server is ready, forking this process is faster than waiting for it
+    if _fork_server is not None and _fork_server.is_ready():
+        try:
+            return _fork_server.run(func, *func_args, **func_kwargs)
+        except (ForkServer.NotPicklable, ForkServer.Stopped):
+            pass  # Lambdas, closures..., or a dead template: fork this process instead
+    in_child, _, child_pid = double_fork()
+    if not in_child:
+        return child_pid
+    _run_and_exit(func, func_args, func_kwargs)
+
+
+def _run_and_exit(func, func_args, func_kwargs):
+    """
+    Run a function in a forked process, then exit without going back to the caller
+
+    :param func:            The function to run
+    :type func:             callable
+    :param func_args:       The position arguments passed to the called function
+    :type func_args:        tuple
+    :param func_kwargs:     The named arguments passed to the called function
+    :type func_kwargs:      dict
+    """
+    code = 1
     try:
-        child_pid = proc_queue.get(timeout=1)
-    except queue.Empty:
-        raise RuntimeError("Unable to run a double fork cleanly")
-    proc.join(timeout=1)
-    if proc.is_alive():
-        raise RuntimeError("Unable to run a double fork cleanly")
-    return int(child_pid)
+        func(*func_args, **func_kwargs)
+        code = 0
+    except SystemExit as e:
+        code = e.code if is_int(e.code) else (0 if e.code is None else 1)
+    except BaseException:
+        import traceback
+        traceback.print_exc()
+    finally:
+        try:
+            sys.stdout.flush()
+            sys.stderr.flush()
+        finally:
+            os._exit(code)
+
+
+class ForkServer(object):
+    """
+    Fork server: a small template python process, started once, which double-forks detached workers on request.
+    Launching a task costs one round-trip on a unix socket, and the worker is forked from a process holding only
+    the preloaded modules instead of the whole (big) caller.
+    The function and its arguments are sent with pickle: the function must be importable by name.
+    Workers run in the working directory and environment of the caller at the time of the request.
+    Only the process which started the server uses it: forked children fork themselves.
+    """
+
+    class NotPicklable(RuntimeError):
+        pass
+
+    class Stopped(RuntimeError):
+        pass
+
+    def __init__(self, preload=()):
+        """
+        :param preload:     The modules to import in the template process. Optional, default none
+        :type preload:      collections.Iterable[str]
+        """
+        import threading
+
+        self.preload = tuple(preload)
+        self.proc = None
+        self._sock = None
+        self._owner_pid = None
+        self._ready = False
+        self._lock = threading.Lock()
+
+    def start(self):
+        """
+        Start the template process
+        """
+        import socket
+
+        parent_sock, child_sock = socket.socketpair()
+        package_path = os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+        env = dict(os.environ)
+        env["PYTHONPATH"] = os.pathsep.join(path for path in (package_path, env.get("PYTHONPATH")) if path)
+        code = "import sys; from malice.util.proc_util import _fork_server_main; " \
+               "_fork_server_main(int(sys.argv[1]), sys.argv[2:])"
+        try:
+            self.proc = subprocess.Popen([sys.executable, "-c", code, str(child_sock.fileno())] + list(self.preload),
+                                         stdin=subprocess.DEVNULL, pass_fds=(child_sock.fileno(),), env=env)
+        finally:
+            child_sock.close()
+        self._sock = parent_sock
+        self._owner_pid = os.getpid()
+        self._ready = False
+        return self
+
+    def is_running(self):
+        # A forked child shares the socket with its parent: their requests would mix
+        return self.proc is not None and self._owner_pid == os.getpid() and self.proc.poll() is None
+
+    def _read_ready(self):
+        """Read the message the template sends once its modules are loaded. The caller holds the lock"""
+        if self._ready:
+            return
+        if _recv_frame(self._sock) is None:
+            raise ForkServer.Stopped("Fork server stopped during its start up")
+        self._ready = True
+
+    def is_ready(self):
+        """
+        Check without blocking if the template process is running and done loading its modules
+
+        :return:        True if run() would be served without waiting for the template start up
+        :rtype:         bool
+        """
+        import select
+
+        if not self.is_running():
+            return False
+        if self._ready:
+            return True
+        with self._lock:
+            try:
+                if select.select([self._sock], [], [], 0)[0]:
+                    self._read_ready()
+            except (OSError, EOFError, ForkServer.Stopped):
+                return False
+        return self._ready
+
+    def wait_ready(self):
+        """
+        Wait until the template process is done loading its modules
+        """
+        with self._lock:
+            self._read_ready()
+
+    def run(self, func, *func_args, **func_kwargs):
+        """
+        Run a function in a new double forked process
+
+        :param func:            The function to run, it must be importable by name
+        :type func:             callable
+        :param func_args:       The position arguments passed to the called function
+        :type func_args:        any
+        :param func_kwargs:     The named arguments passed to the called function
+        :type func_kwargs:      any
+        :return:                The pid of the double-forked function process
+        :rtype:                 int
+        :raise ForkServer.NotPicklable: If func or its arguments can't be sent to the template process
+        :raise ForkServer.Stopped:      If the template process is not running
+        """
+        import pickle
+
+        try:
+            data = pickle.dumps((func, func_args, func_kwargs, os.getcwd(), dict(os.environ)),
+                                pickle.HIGHEST_PROTOCOL)
+        except (pickle.PicklingError, AttributeError, TypeError) as e:
+            raise ForkServer.NotPicklable(str(e))
+        with self._lock:
+            if not self.is_running():
+                raise ForkServer.Stopped("Fork server not running")
+            try:
+                self._read_ready()
+                _send_frame(self._sock, data)
+                answer = _recv_frame(self._sock)
+            except (OSError, EOFError) as e:
+                raise ForkServer.Stopped("Fork server connection lost: " + to_str(e))
+            if answer is None:
+                raise ForkServer.Stopped("Fork server stopped unexpectedly")
+        status, result = pickle.loads(answer)
+        if status != "ok":
+            raise RuntimeError("Fork server failed to run " + to_str(func) + ": " + to_str(result))
+        return result
+
+    def stop(self, timeout=5):
+        """
+        Stop the template process. The running workers are not affected
+
+        :param timeout:     The amount of time (in second) we wait before killing it. Optional, default 5
+        :type timeout:      float
+        """
+        import socket
+
+        if self._sock is not None:
+            # End of stream for the template, which then exits. Closing the socket before, with the "ready" message
+            # unread, would make the kernel reset the connection under its feet
+            try:
+                self._sock.shutdown(socket.SHUT_WR)
+            except OSError:
+                pass
+        if self.proc is not None:
+            if wait_for_procs((self.proc,), timeout):
+                ensure_kill_proc(self.proc)
+            self.proc = None
+        if self._sock is not None:
+            self._sock.close()
+            self._sock = None
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *unused):
+        self.stop()
+
+
+def start_fork_server(preload=()):
+    """
+    Start a fork server, used by the next double_forked_run calls.
+    Call it early, while the process is still small.
+
+    :param preload:     The modules to import in the template process. Optional, default none
+    :type preload:      collections.Iterable[str]
+    :return:            The fork server
+    :rtype:             ForkServer
+    """
+    global _fork_server
+    stop_fork_server()
+    _fork_server = ForkServer(preload).start()
+    return _fork_server
+
+
+def stop_fork_server():
+    """
+    Stop the fork server used by double_forked_run, if any
+    """
+    global _fork_server
+    if _fork_server is not None:
+        _fork_server.stop()
+        _fork_server = None
+
+
+def _send_frame(sock, data):
+    sock.sendall(_FRAME_HEADER.pack(len(data)) + data)
+
+
+def _recv_frame(sock):
+    """
+    Receive a length prefixed message from a socket
+
+    :param sock:    The socket
+    :type sock:     socket.socket
+    :return:        The message, None on end of stream
+    :rtype:         bytearray|None
+    """
+    header = bytearray(_FRAME_HEADER.size)
+    view = memoryview(header)
+    received = 0
+    while received < len(header):
+        read = sock.recv_into(view[received:])
+        if not read:
+            if received:
+                raise EOFError("Truncated message header")
+            return None
+        received += read
+    data = bytearray(_FRAME_HEADER.unpack(header)[0])
+    view = memoryview(data)
+    received = 0
+    while received < len(data):
+        read = sock.recv_into(view[received:])
+        if not read:
+            raise EOFError("Truncated message")
+        received += read
+    return data
+
+
+def _run_in_context(cwd, env, func, func_args, func_kwargs):
+    """Run a function in the working directory and environment of the fork server client"""
+    os.chdir(cwd)
+    os.environ.clear()
+    os.environ.update(env)
+    return func(*func_args, **func_kwargs)
+
+
+def _fork_server_main(fd, preload):
+    """
+    Fork server template process loop
+
+    :param fd:          The socket file descriptor connected to the client
+    :type fd:           int
+    :param preload:     The modules to import
+    :type preload:      list[str]
+    """
+    import importlib
+    import pickle
+    import socket
+
+    sock = socket.socket(fileno=fd)
+    try:
+        for module_name in preload:
+            importlib.import_module(module_name)
+        _send_frame(sock, pickle.dumps(("ready", os.getpid()), pickle.HIGHEST_PROTOCOL))
+        while True:
+            data = _recv_frame(sock)
+            if data is None:
+                break
+            try:
+                func, func_args, func_kwargs, cwd, env = pickle.loads(data)
+                in_child, _, child_pid = double_fork()
+                if in_child:
+                    sock.close()
+                    _run_and_exit(_run_in_context, (cwd, env, func, func_args, func_kwargs), {})
+                answer = ("ok", child_pid)
+            except Exception as e:
+                answer = ("error", to_str(e))
+            _send_frame(sock, pickle.dumps(answer, pickle.HIGHEST_PROTOCOL))
+    except (OSError, EOFError, KeyboardInterrupt):
+        pass  # The client went away, or the user interrupted it: nothing to report
+    finally:
+        sock.close()
 
 
 def shell_quote(arg):
@@ -120,15 +432,7 @@ def is_process_running(proc):
     """
     if hasattr(proc, "is_running"):
         return proc.is_running()
-    pid = int(proc) if ll_int(proc) else proc.pid
-    try:
-        os.kill(int(pid), 0)
-        return not is_zombie(proc)
-    except OSError as e:
-        if e.errno == 3:  # process is dead
-            return False
-        else:
-            raise
+    return not _has_exited(proc)
 
 
 def is_zombie(proc):
@@ -148,6 +452,163 @@ def is_zombie(proc):
     return bool(dead)
 
 
+def _read_proc_stat(pid):
+    """
+    Read the fields of /proc/<pid>/stat which follow the command name
+
+    :param pid:     The process id
+    :type pid:      int
+    :return:        The fields (the first one is the state), None if unknown
+    :rtype:         list[bytes]|None
+    """
+    try:
+        with open("/proc/" + str(pid) + "/stat", "rb") as stat_file:
+            stat = stat_file.read()
+    except OSError:
+        return None
+    return stat[stat.rindex(b")") + 2:].split()
+
+
+def _proc_state(pid):
+    """
+    Read a process state from /proc
+
+    :param pid:     The process id
+    :type pid:      int
+    :return:        The state letter (R, S, Z...), None if unknown
+    :rtype:         str|None
+    """
+    fields = _read_proc_stat(pid)
+    return None if fields is None else to_str(fields[0])
+
+
+def get_start_time(pid):
+    """
+    Get the start time of a process: with the pid, it identifies a process even if pids are reused.
+    Without /proc, 0 is returned for any running process
+
+    :param pid:     The process id
+    :type pid:      int
+    :return:        The start time, in clock ticks after boot, None if the process is not running (or a zombie)
+    :rtype:         int|None
+    """
+    if not os.path.isdir("/proc"):
+        return 0 if is_process_running(int(pid)) else None
+    fields = _read_proc_stat(pid)
+    if fields is None or fields[0] == b"Z":
+        return None
+    return int(fields[19])
+
+
+def _has_exited(proc):
+    """
+    Check without blocking if a process exited. Our own children are reaped.
+
+    :param proc:        The process to check, a pid or a subprocess
+    :type proc:         subprocess.Popen|int
+    :return:            True if the process is not running anymore
+    :rtype:             bool
+    """
+    if not ll_int(proc):
+        return proc.poll() is not None
+    pid = int(proc)
+    try:
+        return os.waitpid(pid, os.WNOHANG)[0] != 0
+    except ChildProcessError:
+        pass  # Not one of our children
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return True
+    except PermissionError:
+        pass  # The process exists, but belongs to someone else
+    return _proc_state(pid) == "Z"
+
+
+def _open_pidfd(pid):
+    """
+    Open a pidfd on a process
+
+    :param pid:     The process id
+    :type pid:      int
+    :return:        The pidfd, -1 if the process is already gone, None if pidfds are not available
+    :rtype:         int|None
+    """
+    if not hasattr(os, "pidfd_open"):
+        return None
+    try:
+        return os.pidfd_open(pid)
+    except ProcessLookupError:
+        return -1
+    except OSError:  # Old kernel (ENOSYS), or too many open files
+        return None
+
+
+@trace_util.traced("proc.wait_for_procs")
+def wait_for_procs(procs, timeout=None):
+    """
+    Wait for several processes to finish.
+    On Linux >= 5.3 this waits on pidfds with epoll: no signal, no polling, and sub-millisecond timeouts.
+    Elsewhere (or when no more file descriptors are available) it falls back to polling with a growing interval.
+    Our own children are reaped.
+
+    :param procs:       The processes we are waiting for, pids or subprocesses
+    :type procs:        collections.Iterable[subprocess.Popen|int]
+    :param timeout:     The number of seconds we wait, None to wait forever. Optional, default None
+    :type timeout:      float|None
+    :return:            The processes still running when the timeout expired
+    :rtype:             list[subprocess.Popen|int]
+    """
+    import select
+
+    deadline = None if timeout is None else time.monotonic() + float(timeout)
+    pending = [proc for proc in procs if not _has_exited(proc)]
+    polled = []
+    pidfds = {}
+    epoll = None
+    try:
+        for proc in pending:
+            pidfd = _open_pidfd(int(proc) if ll_int(proc) else proc.pid)
+            if pidfd is None:
+                polled.append(proc)
+            elif pidfd >= 0:
+                if epoll is None:
+                    epoll = select.epoll()  # pidfds only exist on Linux, epoll is always there
+                epoll.register(pidfd, select.EPOLLIN)
+                pidfds[pidfd] = proc
+
+        delay = 0.0005
+        while pidfds or polled:
+            remaining = None if deadline is None else deadline - time.monotonic()
+            if remaining is not None and remaining <= 0:
+                break
+            wait = remaining
+            if polled:
+                # Some processes can't be watched with a pidfd: poll them and cap the wait accordingly
+                polled = [proc for proc in polled if not _has_exited(proc)]
+                if not polled and not pidfds:
+                    break
+                wait = delay if remaining is None else min(delay, remaining)
+                delay = min(delay * 2, 0.05)
+            if pidfds:
+                # epoll_wait has a millisecond granularity: select on the epoll fd itself is precise to the microsecond
+                if select.select([epoll.fileno()], [], [], wait)[0]:
+                    for pidfd, _ in epoll.poll(0):
+                        proc = pidfds.pop(pidfd)
+                        epoll.unregister(pidfd)
+                        os.close(pidfd)
+                        _has_exited(proc)  # Reap it if it's one of our children
+            else:
+                time.sleep(wait)
+    finally:
+        for pidfd in pidfds:
+            os.close(pidfd)
+        if epoll is not None:
+            epoll.close()
+    return list(pidfds.values()) + polled
+
+
+@trace_util.traced("proc.ensure_stop_proc")
 def ensure_stop_proc(proc, timeout=30):
     """
     Ask gracefully a process tpo stop. If it doesn't we kill it and all it's children (vengeance !!!!)
@@ -167,22 +628,20 @@ def ensure_stop_proc(proc, timeout=30):
             return True  # The process should have stopped
     else:
         proc.terminate()
-    try:
-        wait_for_proc(proc, timeout)
-        return True
-    except OSError:
+    if not wait_for_procs((proc,), timeout):
         return True
-    except util.util.TimeoutError:
-        ensure_kill_proc(proc)
-        return False
+    ensure_kill_proc(proc)
+    return False
 
 
-def ensure_kill_proc(proc):
+def ensure_kill_proc(proc, timeout=5):
     """
     Kill a processus and all it's children
 
     :param proc:        The process to stop, a pid or a subprocess
     :type proc:         subprocess.Popen|int
+    :param timeout:     The amount of time (in second) we wait for the process to disappear. Optional, default 5
+    :type timeout:      float
     """
     if ll_int(proc):
         proc_pid = int(proc)
@@ -198,9 +657,124 @@ def ensure_kill_proc(proc):
             else:
                 os.killpg(proc_pid, signal.SIGKILL)
         except OSError:
-            pass  # The process may stopped between the two calls
+            try:
+                os.kill(proc_pid, signal.SIGKILL)  # Not a process group leader
+            except OSError:
+                pass  # The process may stopped between the two calls
+        if not hasattr(proc, "is_distant"):
+            wait_for_procs((proc,), timeout)
+
+
+def scan_processes():
+    """
+    Read the process table from /proc in one pass
+
+    :return:        The parent pid and start time (in clock ticks since boot) of every process, by pid.
+                    Empty if /proc is not available
+    :rtype:         dict[int, Tuple[int, int]]
+    """
+    result = {}
+    try:
+        entries = os.listdir("/proc")
+    except OSError:
+        return result
+    for entry in entries:
+        if not entry.isdigit():
+            continue
+        fields = _read_proc_stat(entry)
+        if fields is None:
+            continue  # The process is gone
+        result[int(entry)] = (int(fields[1]), int(fields[19]))
+    return result
+
+
+def get_descendants(pid, processes=None):
+    """
+    Get all the descendants of a process (children, grandchildren...)
+
+    :param pid:         The process id
+    :type pid:          int
+    :param processes:   The process table, as returned by scan_processes. Optional, default a new scan
+    :type processes:    dict[int, Tuple[int, int]]|None
+    :return:            The descendant pids, parents before children
+    :rtype:             list[int]
+    """
+    processes = scan_processes() if processes is None else processes
+    children = {}
+    for child_pid, (parent_pid, _) in processes.items():
+        children.setdefault(parent_pid, []).append(child_pid)
+    result = []
+    todo = [int(pid)]
+    while todo:
+        for child_pid in children.get(todo.pop(), ()):
+            result.append(child_pid)
+            todo.append(child_pid)
+    return result
+
+
+def _ask_stop(proc):
+    if ll_int(proc):
+        try:
+            os.kill(int(proc), signal.SIGINT)
+            os.kill(int(proc), signal.SIGTERM)
+        except OSError:
+            pass  # The process should have stopped
+    else:
+        proc.terminate()
+
+
+@trace_util.traced("proc.ensure_stop_procs")
+def ensure_stop_procs(procs, timeout=30):
+    """
+    Ask gracefully several processes, and all their descendants, to stop.
+    They are all signaled at once and waited for against the same deadline:
+    only the ones still alive when it expires are killed.
+
+    :param procs:       The processes to stop, pids or subprocesses
+    :type procs:        collections.Iterable[subprocess.Popen|int]
+    :param timeout:     The amount of time (in second) we wait before killing the processes. Optional, default 30
+    :type timeout:      float
+    :return:            For each process, True if it and its descendants stopped gracefully, False if we had to kill
+    :rtype:             list[bool]
+    """
+    procs = list(procs)
+    processes = scan_processes()
+    trees = [get_descendants(int(proc) if ll_int(proc) else proc.pid, processes) for proc in procs]
+    for proc, descendants in zip(procs, trees):
+        _ask_stop(proc)
+        for pid in descendants:
+            _ask_stop(pid)
 
+    stragglers = set()
+    for proc in wait_for_procs(procs + [pid for descendants in trees for pid in descendants], timeout):
+        stragglers.add(int(proc) if ll_int(proc) else proc.pid)
+    if not stragglers:
+        return [True] * len(procs)
 
+    # Kill the stragglers which are still the processes we saw (and not new ones reusing the pid)
+    current = scan_processes()
+    killed = []
+    for proc in procs:
+        if not ll_int(proc) and proc.pid in stragglers:
+            proc.kill()
+            killed.append(proc)
+    for pid in stragglers:
+        if pid in processes and current.get(pid, (None, None))[1] == processes[pid][1]:
+            try:
+                os.kill(pid, signal.SIGKILL)
+                killed.append(pid)
+            except OSError:
+                pass  # Stopped in the meantime
+    wait_for_procs(killed, 5)
+
+    result = []
+    for proc, descendants in zip(procs, trees):
+        pids = [int(proc) if ll_int(proc) else proc.pid] + descendants
+        result.append(not any(pid in stragglers for pid in pids))
+    return result
+
+
+@trace_util.traced("proc.wait_for_proc")
 def wait_for_proc(proc, timeout):
     """
     Wait for a process to finish with a timeout.
@@ -211,13 +785,8 @@ def wait_for_proc(proc, timeout):
     :param timeout:     The number of seconds we wait before throwing the exception
     :type timeout:      float
     """
-    with util.util.using_timeout(int(timeout)):
-        if ll_int(proc):
-            os.waitpid(int(proc), 0)
-        else:
-            proc.wait()
-    if is_process_running(proc):
-        raise util.util.TimeoutError()
+    if wait_for_procs((proc,), timeout):
+        raise util.TimeoutError()
 
 
 def wait_for_proc_and_streams(proc, timeout):
@@ -228,42 +797,359 @@ def wait_for_proc_and_streams(proc, timeout):
     :param proc:        The process we are waiting for
     :type proc:         subprocess.Popen
     :param timeout:     The number of seconds we wait before throwing the exception
-    :type timeout:      int
+    :type timeout:      float
     :return:            Return code, stdout, and stderr
                         If the return code is greater than 256, it means we can't get the return code
                         If the return code is negative, it's the number of the signal
     :rtype:             Tuple[int, str, str]
     """
-    with util.util.using_timeout(timeout):
-        stdout, stderr = proc.communicate()
+    try:
+        stdout, stderr = proc.communicate(timeout=timeout)
+    except subprocess.TimeoutExpired:
+        raise util.TimeoutError()
+    return_code = proc.poll()
+    if return_code is None:
+        proc.wait()
         return_code = proc.poll()
         if return_code is None:
-            proc.wait()
-            return_code = proc.poll()
-            if return_code is None:
-                return_code = 258
-        return return_code, stdout, stderr
+            return_code = 258
+    return return_code, stdout, stderr
 
 
 def run_cmd(cmd, shell=False, cwd=None):
-    child_proc = subprocess.Popen(cmd, stdout=subprocess.PIPE, stderr=subprocess.PIPE, cwd=cwd, shell=shell)
-    std_out, std_err = child_proc.communicate()
-    if child_proc.poll() is None:
-        child_proc.wait()
+    with trace_util.span("proc.run_cmd", cmd=cmd):
+        child_proc = subprocess.Popen(cmd, stdout=subprocess.PIPE, stderr=subprocess.PIPE, cwd=cwd, shell=shell)
+        std_out, std_err = child_proc.communicate()
         if child_proc.poll() is None:
-            raise RuntimeError("Unexpected behaviour: process failed without exit code")
+            child_proc.wait()
+            if child_proc.poll() is None:
+                raise RuntimeError("Unexpected behaviour: process failed without exit code")
     if int(child_proc.returncode) == 0:
         return int(child_proc.returncode), std_out, std_err
     raise RuntimeError("process failed with exit code "+to_str(child_proc.returncode))
 
 
+class CmdError(RuntimeError):
+    """A command failed. The last lines of its output are kept in tail"""
+
+    def __init__(self, message, returncode=None, tail=()):
+        RuntimeError.__init__(self, message)
+        self.returncode = returncode
+        self.tail = list(tail)
+
+
+def stream_cmd(cmd, shell=False, cwd=None, lines=True, tail_size=100, log_file=None, timeout=None,
+               chunk_size=65536, max_line_size=65536):
+    """
+    Run a command and yield its output as it arrives, with a bounded memory usage.
+    On failure, a CmdError is raised with the last lines of the output.
+    Stopping the iteration early kills the command.
+
+    :param cmd:             The command to run
+    :type cmd:              list[str]|str
+    :param shell:           Run the command through the shell. Optional, default False
+    :type shell:            bool
+    :param cwd:             The command working directory. Optional, default the current one
+    :type cwd:              str|None
+    :param lines:           Yield whole lines (with their end of line) instead of raw chunks. Optional, default True
+    :type lines:            bool
+    :param tail_size:       The number of output lines kept for the error report. Optional, default 100
+    :type tail_size:        int
+    :param log_file:        A path or a binary file to copy the whole output into. Optional, default None
+    :type log_file:         str|io.BufferedIOBase|None
+    :param timeout:         The number of seconds before killing the command and raising a TimeoutError.
+                            Optional, default None: no timeout
+    :type timeout:          float|None
+    :param chunk_size:      The maximum size of each read. Optional, default 64 KiB
+    :type chunk_size:       int
+    :param max_line_size:   In lines mode, longer lines (ex: progress bars redrawn with \\r, binary output) are
+                            yielded in pieces of this size, without end of line. Optional, default 64 KiB
+    :type max_line_size:    int
+    :return:                The stream name ("stdout" or "stderr") and the data, for each line or chunk
+    :rtype:                 collections.Iterator[Tuple[str, bytes]]
+    """
+    import selectors
+
+    with trace_util.span("proc.stream_cmd", cmd=cmd):
+        deadline = None if timeout is None else time.monotonic() + timeout
+        tail = collections.deque(maxlen=tail_size)
+        log = open(log_file, "ab") if is_string(log_file) else log_file
+        child_proc = subprocess.Popen(cmd, stdin=subprocess.DEVNULL, stdout=subprocess.PIPE, stderr=subprocess.PIPE,
+                                      cwd=cwd, shell=shell)
+        selector = selectors.DefaultSelector()
+        try:
+            partials = {}
+            for name, stream in (("stdout", child_proc.stdout), ("stderr", child_proc.stderr)):
+                selector.register(stream, selectors.EVENT_READ, name)
+                partials[name] = bytearray()  # The end of the output not yet yielded, without end of line
+            while selector.get_map():
+                remaining = None if deadline is None else deadline - time.monotonic()
+                if remaining is not None and remaining <= 0:
+                    raise util.TimeoutError("Command timed out after " + to_str(timeout) + " seconds")
+                for key, _ in selector.select(remaining):
+                    name = key.data
+                    data = os.read(key.fileobj.fileno(), chunk_size)
+                    if not data:
+                        selector.unregister(key.fileobj)
+                        if partials[name]:
+                            line = bytes(partials[name])
+                            partials[name].clear()
+                            tail.append(line)
+                            yield name, line
+                        continue
+                    if log is not None:
+                        log.write(data)
+                    if not lines:
+                        tail.extend(data.splitlines(True))
+                        yield name, data
+                        continue
+                    partial = partials[name]
+                    end = data.rfind(b"\n") + 1
+                    if end:
+                        # Only the new data is searched and copied: the cost stays linear with long lines
+                        complete = bytes(partial) + data[:end] if partial else data[:end]
+                        partial.clear()
+                        partial += data[end:]
+                        for line in complete.splitlines(True):
+                            tail.append(line)
+                            yield name, line
+                    else:
+                        partial += data
+                    while len(partial) >= max_line_size:
+                        line = bytes(partial[:max_line_size])
+                        del partial[:max_line_size]
+                        tail.append(line)
+                        yield name, line
+
+            remaining = None if deadline is None else max(0, deadline - time.monotonic())
+            if wait_for_procs((child_proc,), remaining):
+                raise util.TimeoutError("Command timed out after " + to_str(timeout) + " seconds")
+            if child_proc.returncode != 0:
+                raise CmdError("process failed with exit code " + to_str(child_proc.returncode) + os.linesep +
+                               b"".join(tail).decode("UTF-8", "replace").rstrip(),
+                               child_proc.returncode, tail)
+        finally:
+            selector.close()
+            if child_proc.poll() is None:
+                ensure_kill_proc(child_proc)
+            child_proc.stdout.close()
+            child_proc.stderr.close()
+            if log is not None:
+                log.flush()
+                if log is not log_file:
+                    log.close()
+
+
+def run_cmd_streaming(cmd, callback, shell=False, cwd=None, **kwargs):
+    """
+    Run a command and give its output to a callback as it arrives. See stream_cmd for the other parameters
+
+    :param cmd:         The command to run
+    :type cmd:          list[str]|str
+    :param callback:    Called with the stream name ("stdout" or "stderr") and the data
+    :type callback:     callable
+    :param shell:       Run the command through the shell. Optional, default False
+    :type shell:        bool
+    :param cwd:         The command working directory. Optional, default the current one
+    :type cwd:          str|None
+    :return:            The command exit code
+    :rtype:             int
+    """
+    for name, data in stream_cmd(cmd, shell=shell, cwd=cwd, **kwargs):
+        callback(name, data)
+    return 0
+
+
+CmdResult = collections.namedtuple("CmdResult", ("cmd", "returncode", "stdout", "stderr", "duration", "error"))
+CmdResult.__doc__ = """Result of a command run by run_cmds. error is None on success,
+otherwise "exit code N", "timeout", "cancelled" or the reason the command could not start"""
+
+
+def _install_child_watcher(loop):
+    """
+    Watch the asyncio children with pidfds where possible: the default watcher (Python 3.8 to 3.11) uses one thread
+    per child process
+
+    :param loop:    The event loop
+    :type loop:     asyncio.AbstractEventLoop
+    :return:        The installed watcher, None if the default one is kept
+    :rtype:         asyncio.AbstractChildWatcher|None
+    """
+    import asyncio
+
+    if sys.version_info >= (3, 12) or not hasattr(asyncio, "PidfdChildWatcher"):
+        return None
+    pidfd = _open_pidfd(os.getpid())
+    if pidfd is None:
+        return None
+    os.close(pidfd)
+    watcher = asyncio.PidfdChildWatcher()
+    watcher.attach_loop(loop)
+    asyncio.get_event_loop_policy().set_child_watcher(watcher)
+    return watcher
+
+
+def run_async(coroutine):
+    """
+    Run a coroutine, which may start subprocesses, in a new event loop
+
+    :param coroutine:   The coroutine to run
+    :type coroutine:    collections.abc.Coroutine
+    :return:            The coroutine result
+    :rtype:             any
+    """
+    import asyncio
+
+    loop = asyncio.new_event_loop()
+    watcher = _install_child_watcher(loop)
+    try:
+        return loop.run_until_complete(coroutine)
+    finally:
+        try:
+            # On error (Ctrl-C...), let the pending tasks clean up their processes
+            pending = [task for task in asyncio.all_tasks(loop) if not task.done()]
+            for task in pending:
+                task.cancel()
+            if pending:
+                loop.run_until_complete(asyncio.gather(*pending, return_exceptions=True))
+            loop.run_until_complete(loop.shutdown_asyncgens())
+        finally:
+            if watcher is not None:
+                asyncio.get_event_loop_policy().set_child_watcher(None)
+                watcher.close()
+            loop.close()
+
+
+async def _run_cmds_async(cmds, max_parallel, timeout, fail_fast, shell, cwd):
+    import asyncio
+
+    semaphore = asyncio.Semaphore(max_parallel)
+    results = [None] * len(cmds)
+    tasks = []
+
+    async def kill(proc):
+        if proc.returncode is None:
+            try:
+                os.killpg(proc.pid, signal.SIGKILL)  # The whole session: shells don't always exec their command
+            except OSError:
+                proc.kill()
+            await proc.wait()
+
+    async def run_one(index, cmd):
+        start = time.monotonic()
+        proc = None
+        try:
+            async with semaphore:
+                start = time.monotonic()
+                options = dict(stdin=subprocess.DEVNULL, stdout=subprocess.PIPE, stderr=subprocess.PIPE, cwd=cwd,
+                               start_new_session=True)
+                if shell:
+                    proc = await asyncio.create_subprocess_shell(cmd, **options)
+                else:
+                    proc = await asyncio.create_subprocess_exec(*cmd, **options)
+                try:
+                    stdout, stderr = await asyncio.wait_for(proc.communicate(), timeout)
+                    error = None if proc.returncode == 0 else "exit code " + to_str(proc.returncode)
+                except asyncio.TimeoutError:
+                    await kill(proc)
+                    stdout, stderr, error = b"", b"", "timeout"
+                results[index] = CmdResult(cmd, proc.returncode, stdout, stderr, time.monotonic() - start, error)
+        except asyncio.CancelledError:
+            if proc is not None:
+                await kill(proc)
+            results[index] = CmdResult(cmd, None if proc is None else proc.returncode, b"", b"",
+                                       time.monotonic() - start, "cancelled")
+            return
+        except OSError as e:
+            results[index] = CmdResult(cmd, None, b"", b"", time.monotonic() - start, to_str(e))
+        if fail_fast and results[index].error is not None:
+            for other_index, task in enumerate(tasks):
+                if other_index != index:
+                    task.cancel()
+
+    loop = asyncio.get_event_loop()
+    tasks.extend(loop.create_task(run_one(index, cmd)) for index, cmd in enumerate(cmds))
+    await asyncio.gather(*tasks, return_exceptions=True)
+    return results
+
+
+def run_cmds(cmds, max_parallel=None, timeout=None, fail_fast=False, shell=False, cwd=None):
+    """
+    Run many commands concurrently, at most max_parallel at a time.
+    Everything runs on one asyncio event loop: no thread per command.
+
+    :param cmds:            The commands to run
+    :type cmds:             collections.Iterable[list[str]|str]
+    :param max_parallel:    The maximum number of commands running at the same time.
+                            Optional, default the number of cores
+    :type max_parallel:     int|None
+    :param timeout:         The number of seconds before killing each command. Optional, default None: no timeout
+    :type timeout:          float|None
+    :param fail_fast:       Cancel the other commands as soon as one fails. Optional, default False: run them all
+    :type fail_fast:        bool
+    :param shell:           Run the commands through the shell. Optional, default False
+    :type shell:            bool
+    :param cwd:             The commands working directory. Optional, default the current one
+    :type cwd:              str|None
+    :return:                The command results, in the same order as the commands
+    :rtype:                 list[CmdResult]
+    """
+    cmds = list(cmds)
+    if not cmds:
+        return []
+    max_parallel = max_parallel or os.cpu_count() or 1
+    with trace_util.span("proc.run_cmds", count=len(cmds), max_parallel=max_parallel):
+        return run_async(_run_cmds_async(cmds, max_parallel, timeout, fail_fast, shell, cwd))
+
+
+class PickleSerializer(object):
+    """Default NamedPipe serializer: any picklable python object"""
+
+    @staticmethod
+    def dumps(msg):
+        import pickle
+        return pickle.dumps(msg, pickle.HIGHEST_PROTOCOL)
+
+    @staticmethod
+    def loads(data):
+        import pickle
+        return pickle.loads(data)
+
+
+class RawSerializer(object):
+    """NamedPipe serializer for bytes-like messages, sent as is"""
+
+    @staticmethod
+    def dumps(msg):
+        return msg
+
+    @staticmethod
+    def loads(data):
+        return bytes(data)
+
+
 class NamedPipe(object):
-    def __init__(self, name, end=0, mode=0x666):
+    """
+    Message channel over a pair of fifos.
+    Each message is framed by a fixed size length header; messages are read in large chunks into a reusable buffer
+    and deserialized from memoryviews over that buffer, without intermediate copies.
+    """
+
+    header = _FRAME_HEADER
+    read_size = 256 * 1024
+
+    def __init__(self, name, end=0, mode=0o666, serializer=None):
         """Open a pair of pipes, name.in and name.out for communication
         with another process.  One process should pass 1 for end, and the
-        other 0.  Data is marshalled with pickle."""
+        other 0.  Data is marshalled with the serializer, pickle by default.
+        A serializer is any object with dumps(msg) -> bytes-like and loads(bytes-like) -> msg methods."""
         self.inp = None
         self.out = None
+        self.serializer = PickleSerializer if serializer is None else serializer
+        self._buffer = bytearray(self.read_size)
+        self._view = memoryview(self._buffer)
+        self._start = 0
+        self._end = 0
         self.in_name, self.out_name = name + '.in', name + '.out',
         try:
             os.mkfifo(self.in_name, mode)
@@ -277,35 +1163,114 @@ class NamedPipe(object):
         # NOTE: The order the ends are opened in is important - both ends
         # of pipe 1 must be opened before the second pipe can be opened.
         if end:
-            self.inp = open(self.out_name, 'r')
-            self.out = open(self.in_name, 'w')
+            self.inp = open(self.out_name, 'rb', buffering=0)
+            self.out = open(self.in_name, 'wb', buffering=0)
         else:
-            self.out = open(self.out_name, 'w')
-            self.inp = open(self.in_name, 'r')
+            self.out = open(self.out_name, 'wb', buffering=0)
+            self.inp = open(self.in_name, 'rb', buffering=0)
         self._open = True
 
     def is_open(self):
         return not (self.inp is None or self.out is None or self.inp.closed or self.out.closed)
 
     def put(self, msg):
-        if self.is_open():
-            data = pickle.dumps(msg, 1)
-            self.out.write("%d\n" % len(data))
-            self.out.write(data)
-            self.out.flush()
-        else:
+        """
+        Send a message
+
+        :param msg:     The message to send
+        :type msg:      any
+        """
+        self.put_many((msg,))
+
+    def put_many(self, msgs):
+        """
+        Send several messages with as few system calls as possible
+
+        :param msgs:    The messages to send
+        :type msgs:     collections.Iterable
+        """
+        if not self.is_open():
             raise Exception("Pipe closed")
+        buffers = []
+        for msg in msgs:
+            data = self.serializer.dumps(msg)
+            buffers.append(self.header.pack(len(data)))
+            buffers.append(data)
+        _write_all(self.out.fileno(), buffers)
 
-    def get(self):
-        txt = self.inp.readline()
-        if not txt:
+    def _fill(self, length):
+        """Ensure at least length bytes (length <= read_size) are buffered, return False on end of file"""
+        if self._end - self._start >= length:
+            return True
+        if self._start + length > len(self._buffer):
+            remaining = self._end - self._start
+            self._buffer[:remaining] = self._view[self._start:self._end]
+            self._start, self._end = 0, remaining
+        while self._end - self._start < length:
+            read = self.inp.readinto(self._view[self._end:])
+            if not read:
+                return False
+            self._end += read
+        return True
+
+    def _read_message(self):
+        if self.inp is None or self.inp.closed:
+            return None
+        if not self._fill(self.header.size):
+            if self._end != self._start:
+                self.inp.close()
+                raise EOFError("Truncated message header")
             self.inp.close()
-        else:
-            length = int(txt)
-            data = self.inp.read(length)
-            if len(data) < length:
+            return None
+        length = self.header.unpack_from(self._buffer, self._start)[0]
+        self._start += self.header.size
+        if length <= len(self._buffer):
+            if not self._fill(length):
+                self.inp.close()
+                raise EOFError("Truncated message")
+            msg = self.serializer.loads(self._view[self._start:self._start + length])
+            self._start += length
+            return msg
+
+        # Big message: read it directly into its own buffer
+        data = bytearray(length)
+        view = memoryview(data)
+        received = self._end - self._start
+        view[:received] = self._view[self._start:self._end]
+        self._start = self._end = 0
+        while received < length:
+            read = self.inp.readinto(view[received:])
+            if not read:
                 self.inp.close()
-            return pickle.loads(data)  # Convert back to python object.
+                raise EOFError("Truncated message")
+            received += read
+        return self.serializer.loads(view)
+
+    def get(self):
+        """
+        Receive a message, waiting for it if needed
+
+        :return:        The message, None if the other end closed the pipe
+        :rtype:         any
+        """
+        return self._read_message()
+
+    def get_many(self, count):
+        """
+        Receive several messages, waiting for them if needed
+
+        :param count:   The number of messages to receive
+        :type count:    int
+        :return:        The messages, less than count if the other end closed the pipe
+        :rtype:         list
+        """
+        result = []
+        while len(result) < count:
+            msg = self._read_message()
+            if msg is None and (self.inp is None or self.inp.closed):
+                break
+            result.append(msg)
+        return result
 
     def close(self):
         if self.inp is not None:
@@ -325,10 +1290,24 @@ class NamedPipe(object):
         self.close()
 
 
-def _forked_call(proc_queue, func, func_args, func_kwargs):
-    in_child, parent_pid, child_pid = double_fork()
-    if not in_child:
-        proc_queue.put(child_pid)
-        return child_pid
-    func(*func_args, **func_kwargs)
-    sys.exit(0)
+def _write_all(fd, buffers):
+    """
+    Write buffers to a file descriptor with gathered writes, handling partial writes
+
+    :param fd:          The file descriptor
+    :type fd:           int
+    :param buffers:     The data to write
+    :type buffers:      list[bytes|bytearray|memoryview]
+    """
+    max_buffers = os.sysconf("SC_IOV_MAX") if "SC_IOV_MAX" in os.sysconf_names else 1024
+    views = [memoryview(buf).cast("B") for buf in buffers if len(buf)]
+    first = 0
+    while first < len(views):
+        written = os.writev(fd, views[first:first + max_buffers])
+        while written:
+            if written >= len(views[first]):
+                written -= len(views[first])
+                first += 1
+            else:
+                views[first] = views[first][written:]
+                written = 0
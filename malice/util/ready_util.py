@@ -0,0 +1,165 @@
+# -*- coding: utf-8 -*-
+# vim: set fileencoding=utf-8:tabstop=4:softtabstop=4:shiftwidth=4:expandtab:textwidth=120
+
+"""
+    Copyright 2019 Samuel Déal
+
+    This file is part of Malice.
+
+    Malice is free software: you can redistribute it and/or modify
+    it under the terms of the GNU General Public License as published by
+    the Free Software Foundation, either version 3 of the License, or
+    (at your option) any later version.
+
+    This program is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU General Public License for more details.
+
+    You should have received a copy of the GNU General Public License
+    along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+    Readiness probes: asyncio checks telling when a freshly started service is usable
+"""
+
+# Python core libraries
+import os
+import re
+import time
+import random
+import asyncio
+
+# Project specific libs
+from malice.util.type_util import *
+from malice.util import util
+
+
+class TcpProbe(object):
+    """Ready when a tcp port accepts connections"""
+
+    def __init__(self, host, port):
+        self.host = host
+        self.port = int(port)
+
+    def __str__(self):
+        return "tcp port " + self.host + ":" + to_str(self.port)
+
+    async def check(self, timeout=1):
+        status = await util.tcp_port_status_async(self.host, self.port, timeout)
+        return status.is_open
+
+
+class HttpProbe(object):
+    """Ready when an http url answers with a 200 status"""
+
+    def __init__(self, url):
+        import urllib.parse
+
+        self.url = url
+        parsed = urllib.parse.urlsplit(url)
+        if parsed.scheme != "http" or not parsed.hostname:
+            raise ValueError("Unsupported readiness url " + url + ", expected http://host[:port]/path")
+        self.host = parsed.hostname
+        self.port = parsed.port or 80
+        self.path = (parsed.path or "/") + ("?" + parsed.query if parsed.query else "")
+
+    def __str__(self):
+        return "http " + self.url
+
+    async def check(self, timeout=1):
+        try:
+            reader, writer = await asyncio.wait_for(asyncio.open_connection(self.host, self.port), timeout)
+        except (OSError, asyncio.TimeoutError):
+            return False
+        try:
+            writer.write(to_bytes("GET " + self.path + " HTTP/1.0\r\nHost: " + self.host + "\r\n\r\n"))
+            status_line = await asyncio.wait_for(reader.readline(), timeout)
+        except (OSError, asyncio.TimeoutError):
+            return False
+        finally:
+            writer.close()
+        parts = status_line.split(None, 2)
+        return len(parts) >= 2 and parts[1] == b"200"
+
+
+class LogProbe(object):
+    """Ready when a line matching a regular expression appears in a log file. Only new data is read on each check"""
+
+    def __init__(self, paths, pattern):
+        self.paths = list(paths)
+        self.pattern = re.compile(to_bytes(pattern))
+        self._offsets = {path: 0 for path in self.paths}
+        self._partials = {path: b"" for path in self.paths}
+
+    def __str__(self):
+        return "log line matching " + to_str(self.pattern.pattern)
+
+    def skip_existing(self, offsets=None):
+        """
+        Ignore what is already written in the log files
+
+        :param offsets:     Where to start reading each file. Optional, default their current size
+        :type offsets:      list[int]|None
+        """
+        if offsets is not None:
+            self._offsets.update(zip(self.paths, offsets))
+            return
+        for path in self.paths:
+            try:
+                self._offsets[path] = os.path.getsize(path)
+            except OSError:
+                self._offsets[path] = 0
+
+    async def check(self, timeout=1):
+        for path in self.paths:
+            try:
+                with open(path, "rb") as log_file:
+                    log_file.seek(self._offsets[path])
+                    data = log_file.read()
+            except OSError:
+                continue
+            self._offsets[path] += len(data)
+            data = self._partials[path] + data
+            end = data.rfind(b"\n") + 1
+            self._partials[path] = data[end:]
+            for line in data[:end].splitlines():
+                if self.pattern.search(line):
+                    return True
+        return False
+
+
+async def wait_until_ready(probes, timeout, is_alive=None, initial_delay=0.02, max_delay=2.0):
+    """
+    Wait for all the probes of a service to succeed, retrying with an exponential backoff and jitter
+
+    :param probes:          The probes
+    :type probes:           list[TcpProbe|HttpProbe|LogProbe]
+    :param timeout:         The maximum amount of time to wait, in seconds
+    :type timeout:          float
+    :param is_alive:        Called between attempts, we stop waiting if it returns False. Optional, default None
+    :type is_alive:         callable|None
+    :param initial_delay:   The first delay between two attempts, in seconds. Optional, default 0.02
+    :type initial_delay:    float
+    :param max_delay:       The maximum delay between two attempts, in seconds. Optional, default 2
+    :type max_delay:        float
+    :return:                None if ready, otherwise the probe that failed, or "exited" if is_alive returned False
+    :rtype:                 TcpProbe|HttpProbe|LogProbe|str|None
+    """
+    deadline = time.monotonic() + timeout
+    delay = initial_delay
+    remaining_probes = list(probes)
+    while True:
+        remaining = deadline - time.monotonic()
+        while remaining_probes and await remaining_probes[0].check(max(0.001, min(1, remaining))):
+            remaining_probes.pop(0)
+        if not remaining_probes:
+            return None
+        if is_alive is not None and not is_alive():
+            return "exited"
+        remaining = deadline - time.monotonic()
+        if remaining <= 0:
+            return remaining_probes[0]
+        # "Equal jitter": between half the delay and the full delay, so that services don't get probed in sync
+        await asyncio.sleep(min(remaining, delay / 2 + random.uniform(0, delay / 2)))
+        delay = min(delay * 2, max_delay)
+
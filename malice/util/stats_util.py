@@ -0,0 +1,334 @@
+# -*- coding: utf-8 -*-
+# vim: set fileencoding=utf-8:tabstop=4:softtabstop=4:shiftwidth=4:expandtab:textwidth=120
+
+"""
+    Copyright 2019 Samuel Déal
+
+    This file is part of Malice.
+
+    Malice is free software: you can redistribute it and/or modify
+    it under the terms of the GNU General Public License as published by
+    the Free Software Foundation, either version 3 of the License, or
+    (at your option) any later version.
+
+    This program is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU General Public License for more details.
+
+    You should have received a copy of the GNU General Public License
+    along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+    Streaming statistics, in constant memory: running moments and percentile sketches.
+    Both can be merged, so partial results computed in other processes can be combined.
+    Bulk updates use numpy when it's installed.
+"""
+
+# Python core libraries
+import math
+
+
+_numpy = None
+
+
+def _get_numpy():
+    """:return: The numpy module if it's installed, None otherwise"""
+    global _numpy
+    if _numpy is None:
+        try:
+            import numpy
+            _numpy = numpy
+        except ImportError:
+            _numpy = False
+    return _numpy or None
+
+
+def _as_array(values):
+    """Get values as a float numpy array if numpy is installed and it's worth it, None otherwise"""
+    numpy = _get_numpy()
+    if numpy is None:
+        return None
+    if isinstance(values, numpy.ndarray):
+        return values.astype(float, copy=False).ravel()
+    if isinstance(values, (list, tuple)) and len(values) >= 64:
+        return numpy.asarray(values, dtype=float)
+    return None
+
+
+class RunningStats(object):
+    """
+    Count, mean, variance, min and max of a stream of values, with Welford's online algorithm:
+    one pass, constant memory, and no catastrophic cancellation on large values
+    """
+
+    def __init__(self):
+        self.count = 0
+        self.mean = 0.0
+        self.m2 = 0.0  # Sum of the squared differences from the mean
+        self.min = None
+        self.max = None
+
+    def __repr__(self):
+        return "RunningStats(count=" + str(self.count) + ", mean=" + str(self.mean) + ", stddev=" + \
+               str(self.stddev) + ", min=" + str(self.min) + ", max=" + str(self.max) + ")"
+
+    def add(self, value):
+        """
+        Add a value
+
+        :param value:   The value
+        :type value:    float
+        """
+        value = float(value)  # As in the bulk path: min and max are floats whatever the input
+        self.count += 1
+        delta = value - self.mean
+        self.mean += delta / self.count
+        self.m2 += delta * (value - self.mean)
+        if self.min is None or value < self.min:
+            self.min = value
+        if self.max is None or value > self.max:
+            self.max = value
+
+    def extend(self, values):
+        """
+        Add values. With numpy, arrays and large lists are processed in bulk
+
+        :param values:  The values
+        :type values:   collections.Iterable[float]|numpy.ndarray
+        :return:        self
+        :rtype:         RunningStats
+        """
+        array = _as_array(values)
+        if array is None:
+            for value in values:
+                self.add(value)
+            return self
+        if len(array):
+            batch = RunningStats()
+            batch.count = len(array)
+            batch.mean = float(array.mean())
+            batch.m2 = float(((array - batch.mean) ** 2).sum())
+            batch.min = float(array.min())
+            batch.max = float(array.max())
+            self.merge(batch)
+        return self
+
+    def merge(self, other):
+        """
+        Add the values accumulated by another instance (Chan et al. parallel algorithm)
+
+        :param other:   The other statistics
+        :type other:    RunningStats
+        :return:        self
+        :rtype:         RunningStats
+        """
+        if other.count == 0:
+            return self
+        if self.count == 0:
+            self.count, self.mean, self.m2, self.min, self.max = other.count, other.mean, other.m2, other.min, other.max
+            return self
+        count = self.count + other.count
+        delta = other.mean - self.mean
+        self.mean += delta * other.count / count
+        self.m2 += other.m2 + delta * delta * self.count * other.count / count
+        self.count = count
+        self.min = min(self.min, other.min)
+        self.max = max(self.max, other.max)
+        return self
+
+    @property
+    def variance(self):
+        """The sample variance, None with less than two values"""
+        return self.m2 / (self.count - 1) if self.count > 1 else None
+
+    @property
+    def population_variance(self):
+        """The population variance, None without values"""
+        return self.m2 / self.count if self.count else None
+
+    @property
+    def stddev(self):
+        """The sample standard deviation, None with less than two values"""
+        variance = self.variance
+        return math.sqrt(variance) if variance is not None else None
+
+    def to_dict(self):
+        """
+        :return:    The state, json serializable, see from_dict
+        :rtype:     dict
+        """
+        return {"count": self.count, "mean": self.mean, "m2": self.m2, "min": self.min, "max": self.max}
+
+    @classmethod
+    def from_dict(cls, state):
+        """
+        :param state:   A state given by to_dict
+        :type state:    dict
+        :return:        The statistics
+        :rtype:         RunningStats
+        """
+        result = cls()
+        result.count, result.mean, result.m2 = state["count"], state["mean"], state["m2"]
+        result.min, result.max = state["min"], state["max"]
+        return result
+
+
+class PercentileSketch(object):
+    """
+    Approximate percentiles of a stream of positive values (ex: durations), in constant memory.
+    Values are counted in logarithmic buckets, so each percentile is known with a bounded relative error
+    (1% by default), whatever the distribution. Sketches with the same accuracy can be merged
+    """
+
+    def __init__(self, relative_accuracy=0.01, min_value=1e-9):
+        """
+        :param relative_accuracy:   The maximum relative error of the percentiles. Optional, default 0.01
+        :type relative_accuracy:    float
+        :param min_value:           Values below it are counted as 0. Optional, default 1e-9
+        :type min_value:            float
+        """
+        if not 0 < relative_accuracy < 1:
+            raise ValueError("Invalid relative accuracy " + str(relative_accuracy))
+        self.relative_accuracy = relative_accuracy
+        self.min_value = min_value
+        self.gamma = (1 + relative_accuracy) / (1 - relative_accuracy)
+        self._log_gamma = math.log(self.gamma)
+        self.buckets = {}
+        self.zero_count = 0
+        self.count = 0
+        self.min = None
+        self.max = None
+
+    def add(self, value, count=1):
+        """
+        Add a value
+
+        :param value:   The value, positive and finite
+        :type value:    float
+        :param count:   The number of occurrences. Optional, default 1
+        :type count:    int
+        """
+        value = float(value)  # As in the bulk path: min and max are floats whatever the input
+        if not 0 <= value < math.inf:  # Also false for NaN
+            raise ValueError("PercentileSketch only supports positive finite values, got " + str(value))
+        if value < self.min_value:
+            self.zero_count += count
+        else:
+            index = int(math.ceil(math.log(value) / self._log_gamma))
+            self.buckets[index] = self.buckets.get(index, 0) + count
+        self.count += count
+        if self.min is None or value < self.min:
+            self.min = value
+        if self.max is None or value > self.max:
+            self.max = value
+
+    def extend(self, values):
+        """
+        Add values. With numpy, arrays and large lists are bucketed in bulk
+
+        :param values:  The values, positive and finite
+        :type values:   collections.Iterable[float]|numpy.ndarray
+        :return:        self
+        :rtype:         PercentileSketch
+        """
+        array = _as_array(values)
+        if array is None:
+            for value in values:
+                self.add(value)
+            return self
+        if not len(array):
+            return self
+        numpy = _get_numpy()
+        if (array < 0).any() or not numpy.isfinite(array).all():
+            raise ValueError("PercentileSketch only supports positive finite values")
+        small = array < self.min_value
+        self.zero_count += int(small.sum())
+        indexes, counts = numpy.unique(numpy.ceil(numpy.log(array[~small]) / self._log_gamma).astype(int),
+                                       return_counts=True)
+        for index, count in zip(indexes.tolist(), counts.tolist()):
+            self.buckets[index] = self.buckets.get(index, 0) + count
+        self.count += len(array)
+        array_min, array_max = float(array.min()), float(array.max())
+        self.min = array_min if self.min is None else min(self.min, array_min)
+        self.max = array_max if self.max is None else max(self.max, array_max)
+        return self
+
+    def merge(self, other):
+        """
+        Add the values counted by another sketch
+
+        :param other:   The other sketch, with the same accuracy
+        :type other:    PercentileSketch
+        :return:        self
+        :rtype:         PercentileSketch
+        """
+        if other.gamma != self.gamma or other.min_value != self.min_value:
+            raise ValueError("Can't merge percentile sketches with different accuracies")
+        for index, count in other.buckets.items():
+            self.buckets[index] = self.buckets.get(index, 0) + count
+        self.zero_count += other.zero_count
+        self.count += other.count
+        if other.count:
+            self.min = other.min if self.min is None else min(self.min, other.min)
+            self.max = other.max if self.max is None else max(self.max, other.max)
+        return self
+
+    def percentile(self, point):
+        """
+        Get an approximate percentile
+
+        :param point:   The percentile, between 0 and 100, ex: 99
+        :type point:    float
+        :return:        The value, None without values
+        :rtype:         float|None
+        """
+        if not self.count:
+            return None
+        rank = point / 100.0 * (self.count - 1)
+        seen = self.zero_count
+        if rank < seen:
+            return 0.0
+        for index in sorted(self.buckets):
+            seen += self.buckets[index]
+            if rank < seen:
+                value = 2 * self.gamma ** index / (self.gamma + 1)  # Middle of the bucket, in relative terms
+                return max(self.min, min(self.max, value))
+        return self.max
+
+    def percentiles(self, points=(50, 95, 99)):
+        """
+        :param points:  The percentiles to compute. Optional, default (50, 95, 99)
+        :type points:   collections.Iterable[float]
+        :return:        The percentiles, by name, ex: {"p50": 0.012, ...}
+        :rtype:         dict[str, float|None]
+        """
+        return {"p" + str(point): self.percentile(point) for point in points}
+
+    def to_dict(self):
+        """
+        :return:    The state, json serializable, see from_dict
+        :rtype:     dict
+        """
+        return {
+            "relative_accuracy": self.relative_accuracy,
+            "min_value": self.min_value,
+            "buckets": [[index, count] for index, count in sorted(self.buckets.items())],
+            "zero_count": self.zero_count,
+            "count": self.count,
+            "min": self.min,
+            "max": self.max,
+        }
+
+    @classmethod
+    def from_dict(cls, state):
+        """
+        :param state:   A state given by to_dict
+        :type state:    dict
+        :return:        The sketch
+        :rtype:         PercentileSketch
+        """
+        result = cls(state["relative_accuracy"], state["min_value"])
+        result.buckets = {index: count for index, count in state["buckets"]}
+        result.zero_count, result.count = state["zero_count"], state["count"]
+        result.min, result.max = state["min"], state["max"]
+        return result
@@ -0,0 +1,190 @@
+# -*- coding: utf-8 -*-
+# vim: set fileencoding=utf-8:tabstop=4:softtabstop=4:shiftwidth=4:expandtab:textwidth=120
+
+"""
+    Copyright 2019 Samuel Déal
+
+    This file is part of Malice.
+
+    Malice is free software: you can redistribute it and/or modify
+    it under the terms of the GNU General Public License as published by
+    the Free Software Foundation, either version 3 of the License, or
+    (at your option) any later version.
+
+    This program is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU General Public License for more details.
+
+    You should have received a copy of the GNU General Public License
+    along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+    Lightweight tracing of the hot paths, exported as Chrome trace events (chrome://tracing, Perfetto).
+    Disabled by default: span() then returns a shared no-op context manager, and traced functions cost one extra
+    call and a flag check.
+"""
+
+# Python core libraries
+import os
+import time
+import functools
+from _thread import get_ident  # threading.get_ident, without importing threading
+
+
+_enabled = False
+_events = []  # (name, start in ns, duration in ns, thread id, args)
+
+
+class _NullSpan(object):
+    __slots__ = ()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *unused):
+        return False
+
+
+_NULL_SPAN = _NullSpan()
+
+
+class _Span(object):
+    __slots__ = ("name", "args", "start")
+
+    def __init__(self, name, args):
+        self.name = name
+        self.args = args
+        self.start = 0
+
+    def __enter__(self):
+        self.start = time.perf_counter_ns()
+        return self
+
+    def __exit__(self, exc_type, *unused):
+        end = time.perf_counter_ns()
+        if exc_type is not None:
+            self.args["error"] = exc_type.__name__
+        _events.append((self.name, self.start, end - self.start, get_ident(), self.args))
+        return False
+
+
+def enable():
+    """Start recording spans"""
+    global _enabled
+    _enabled = True
+
+
+def disable():
+    """Stop recording spans. The recorded ones are kept"""
+    global _enabled
+    _enabled = False
+
+
+def is_enabled():
+    """
+    :return:    True if spans are recorded
+    :rtype:     bool
+    """
+    return _enabled
+
+
+def reset():
+    """Forget the recorded spans"""
+    del _events[:]
+
+
+def span(name, **args):
+    """
+    This method should be used via the 'with' keyword
+    Time a block of code
+
+    :param name:    The span name, ex: "proc.run_cmd"
+    :type name:     str
+    :param args:    Details shown with the span, ex: the command. Only computed values: keep them cheap
+    :type args:     any
+    :return:        The span context manager
+    :rtype:         _Span|_NullSpan
+    """
+    if not _enabled:
+        return _NULL_SPAN
+    return _Span(name, args)
+
+
+def traced(name):
+    """
+    Decorator timing each call of a function
+
+    :param name:    The span name
+    :type name:     str
+    :return:        The decorator
+    :rtype:         callable
+    """
+    def decorator(func):
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            if not _enabled:
+                return func(*args, **kwargs)
+            with _Span(name, {}):
+                return func(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+def get_events():
+    """
+    :return:    The recorded spans: name, start (ns), duration (ns), thread id and details
+    :rtype:     list[Tuple[str, int, int, int, dict]]
+    """
+    return list(_events)
+
+
+def write_chrome_trace(path):
+    """
+    Write the recorded spans as a Chrome trace event file
+
+    :param path:    The output file
+    :type path:     str
+    """
+    import json
+
+    pid = os.getpid()
+    origin = min([start for _, start, _, _, _ in _events] or [0])
+    trace_events = [{
+        "name": name,
+        "ph": "X",
+        "ts": (start - origin) / 1000.0,
+        "dur": duration / 1000.0,
+        "pid": pid,
+        "tid": tid,
+        "args": {key: value if isinstance(value, (int, float, bool)) else str(value) for key, value in args.items()},
+    } for name, start, duration, tid, args in _events]
+    with open(path, "w") as trace_file:
+        json.dump({"traceEvents": trace_events, "displayTimeUnit": "ms"}, trace_file)
+
+
+def get_summary(limit=15):
+    """
+    Summarize the recorded spans: the total time by span name, and the slowest spans
+
+    :param limit:   The number of lines of each part. Optional, default 15
+    :type limit:    int
+    :return:        The summary, as text
+    :rtype:         str
+    """
+    totals = {}
+    for name, _, duration, _, _ in _events:
+        total, count, longest = totals.get(name, (0, 0, 0))
+        totals[name] = (total + duration, count + 1, max(longest, duration))
+    lines = ["Total time by span:"]
+    for name, (total, count, longest) in sorted(totals.items(), key=lambda item: -item[1][0])[:limit]:
+        lines.append("  " + _format_ms(total) + "  " + str(count).rjust(6) + "x  max " + _format_ms(longest) + "  " +
+                     name)
+    lines.append("Slowest spans:")
+    for name, _, duration, _, args in sorted(_events, key=lambda event: -event[2])[:limit]:
+        details = " ".join(key + "=" + str(value)[:80] for key, value in sorted(args.items()))
+        lines.append("  " + _format_ms(duration) + "  " + name + ("  " + details if details else ""))
+    return "\n".join(lines)
+
+
+def _format_ms(duration):
+    return ("{:.3f}".format(duration / 1e6) + " ms").rjust(12)
@@ -23,6 +23,7 @@
 
 # Python core libraries
 import collections
+import collections.abc
 
 
 def ll_float(var):
@@ -34,6 +35,8 @@ def ll_float(var):
     :return:        True if the value can be cast to float
     :rtype:         bool
     """
+    if isinstance(var, (int, float)):
+        return True
     try:
         float(var)
         return True
@@ -50,6 +53,8 @@ def ll_int(var):
     :return:        True if the value can be cast to float
     :rtype:         bool
     """
+    if isinstance(var, int):
+        return True
     try:
         int(var)
         return True
@@ -98,7 +103,7 @@ def is_array(var):
         return False
     if isinstance(var, dict):
         return False
-    return isinstance(var, collections.Iterable)
+    return isinstance(var, collections.abc.Iterable)
 
 
 def is_dict(var):
@@ -107,6 +112,41 @@ def is_dict(var):
     return isinstance(var, dict)
 
 
+_TRUE_STRINGS = frozenset(('yes', 'true', 't', 'y', '1', 'o', 'oui', 'on'))
+_FALSE_STRINGS = frozenset(('no', 'false', 'f', 'n', '0', 'non', 'off'))
+
+
+def _parse_bool(value):
+    """Parse a boolean: True, False, or None if the value doesn't look like a boolean"""
+    if value is None:
+        return None
+    if isinstance(value, bool):
+        return value
+    if isinstance(value, str):
+        lowered = value.lower()
+        if lowered in _TRUE_STRINGS:
+            return True
+        if lowered in _FALSE_STRINGS:
+            return False
+    elif isinstance(value, int):
+        return value == 1 if value in (0, 1) else None
+    # Uncommon cases: numbers as strings ("1.0"), floats, bytes...
+    if ll_float(value):
+        number = float(value)
+        if number != number or number in (float("inf"), float("-inf")):
+            return None
+        return int(number) == 1 if int(number) in (0, 1) else None
+    try:
+        lowered = to_str(value).lower()
+    except Exception:
+        return None
+    if lowered in _TRUE_STRINGS:
+        return True
+    if lowered in _FALSE_STRINGS:
+        return False
+    return None
+
+
 def ll_bool(value):
     """
     Check if value looks like a bool
@@ -116,22 +156,7 @@ def ll_bool(value):
     :return:            The boolean value
     :rtype:             bool
     """
-    if value is None:
-        return False
-    if isinstance(value, bool):
-        return True
-    if ll_float(value):
-        return int(float(value)) in (0, 1)
-    try:
-        value = to_str(value)
-    except Exception:
-        return False
-    if value.lower() in ('yes', 'true', 't', 'y', '1', 'o', 'oui', 'on'):
-        return True
-    elif value.lower() in ('no', 'false', 'f', 'n', '0', 'non', 'off'):
-        return True
-    else:
-        return False
+    return _parse_bool(value) is not None
 
 
 def to_bool(value):
@@ -144,24 +169,10 @@ def to_bool(value):
     :return:            The boolean value
     :rtype:             bool
     """
-    if value is None:
-        raise TypeError("Not a boolean")
-    if isinstance(value, bool):
-        return value
-    if ll_float(value):
-        if not int(float(value)) in (0, 1):
-            raise TypeError("Not a boolean")
-        return int(float(value)) == 1
-    try:
-        value = to_str(value)
-    except Exception:
-        raise TypeError("Not a boolean")
-    if value.lower() in ('yes', 'true', 't', 'y', '1', 'o', 'oui', 'on'):
-        return True
-    elif value.lower() in ('no', 'false', 'f', 'n', '0', 'non', 'off'):
-        return False
-    else:
+    result = _parse_bool(value)
+    if result is None:
         raise TypeError("Not a boolean")
+    return result
 
 
 def to_bytes(var):
@@ -208,3 +219,152 @@ def to_str(var):
     :rtype:         str
     """
     return to_unicode(var)
+
+
+class CoercionError(RuntimeError):
+    """A value doesn't have the type its schema expects"""
+
+    def __init__(self, message, key=None, value=None):
+        RuntimeError.__init__(self, message)
+        self.key = key
+        self.value = value
+
+
+def _to_list(value):
+    if isinstance(value, (list, tuple)):
+        return list(value)
+    return [item.strip() for item in to_str(value).split(",") if item.strip()]
+
+
+def _to_int(value):
+    """int(), without the silent truncation: 3, 3.0 and "3.0" are accepted, 3.7 and "3.7" are not"""
+    if isinstance(value, (str, bytes)):
+        text = to_str(value).strip()
+        try:
+            return int(text)
+        except ValueError:
+            value = float(text)
+    if isinstance(value, float) and not value.is_integer():  # Also rejects inf and nan
+        raise ValueError("Not an integer: " + repr(value))
+    result = int(value)
+    if result != value:
+        raise ValueError("Not an integer: " + repr(value))
+    return result
+
+
+# Converters by type name, and the description used in the errors
+_CONVERTERS = {
+    "str": (to_str, "a string"),
+    "int": (_to_int, "an integer"),
+    "float": (float, "a number"),
+    "bool": (to_bool, "a boolean"),
+    "list": (_to_list, "a comma separated list"),
+}
+
+Field = collections.namedtuple("Field", ("kind", "default", "required"))
+Field.__doc__ = """A schema field: its kind (a type name of _CONVERTERS, or a callable), its default value, and whether
+it is required"""
+
+
+def field(kind="str", default=None, required=False):
+    """
+    Describe a schema field
+
+    :param kind:        The type name ("str", "int", "float", "bool", "list") or a conversion function, which raises
+                        ValueError or TypeError on invalid values. Optional, default "str"
+    :type kind:         str|callable
+    :param default:     The value when the key is missing. Optional, default None
+    :type default:      any
+    :param required:    Raise an error when the key is missing. Optional, default False
+    :type required:     bool
+    :return:            The field
+    :rtype:             Field
+    """
+    return Field(kind, default, required)
+
+
+_MISSING = object()
+
+
+class Schema(object):
+    """
+    Convert dictionaries of values (ex: a configuration section) to typed values.
+    The conversion of each field is resolved once, when the schema is created: converting then costs a dictionary
+    lookup and a conversion call per field, exceptions only happen on invalid values
+    """
+
+    def __init__(self, fields, allow_unknown=True):
+        """
+        :param fields:          The fields, by key: a Field, or only its kind
+        :type fields:           dict[str, Field|str|callable]
+        :param allow_unknown:   Keep the keys which are not in the schema, as they are, instead of raising an error.
+                                Optional, default True
+        :type allow_unknown:    bool
+        """
+        converters = []
+        for key, spec in fields.items():
+            if not isinstance(spec, Field):
+                spec = Field(spec, None, False)
+            if callable(spec.kind):
+                convert, expected = spec.kind, "a valid " + getattr(spec.kind, "__name__", "value")
+            elif spec.kind in _CONVERTERS:
+                convert, expected = _CONVERTERS[spec.kind]
+            else:
+                raise ValueError("Unknown schema type " + to_str(spec.kind) + " for " + key)
+            # Mutable defaults are copied, so results don't share them
+            copy_default = isinstance(spec.default, (list, dict, set))
+            converters.append((key, convert, expected, spec.default, copy_default, spec.required))
+        self._converters = tuple(converters)
+        self.keys = frozenset(fields)
+        self.allow_unknown = allow_unknown
+
+    def coerce(self, values, context=None):
+        """
+        Convert values
+
+        :param values:      The values, by key
+        :type values:       dict[str, any]
+        :param context:     Prefix of the error messages, ex: "Service web". Optional, default None
+        :type context:      str|None
+        :return:            The converted values, with the defaults of the missing keys
+        :rtype:             dict[str, any]
+        """
+        result = {}
+        for key, convert, expected, default, copy_default, required in self._converters:
+            value = values.get(key, _MISSING)
+            if value is _MISSING or value is None:
+                if required:
+                    raise CoercionError((context + ": " if context else "") + "missing " + key, key)
+                result[key] = default.copy() if copy_default else default
+                continue
+            try:
+                result[key] = convert(value)
+            except (ValueError, TypeError):
+                raise CoercionError((context + ": " if context else "") + "invalid " + key + " " + repr(value) +
+                                    ", expected " + expected, key, value)
+        if len(values) > len(result) or not self.keys.issuperset(values):
+            unknown = [key for key in values if key not in self.keys]
+            if unknown and not self.allow_unknown:
+                raise CoercionError((context + ": " if context else "") + "unknown key(s) " + ", ".join(unknown),
+                                    unknown[0])
+            for key in unknown:
+                result[key] = values[key]
+        return result
+
+    def coerce_many(self, records, context=None):
+        """
+        Convert a list of records, or sections by name
+
+        :param records:     The records, or the sections by name
+        :type records:      list[dict[str, any]]|dict[str, dict[str, any]]
+        :param context:     Prefix of the error messages, followed by the record index or section name.
+                            Optional, default None
+        :type context:      str|None
+        :return:            The converted records, or sections by name
+        :rtype:             list[dict[str, any]]|dict[str, dict[str, any]]
+        """
+        coerce = self.coerce
+        prefix = context + " " if context else ""
+        if isinstance(records, collections.abc.Mapping):
+            return {name: coerce(values, prefix + to_str(name)) for name, values in records.items()}
+        return [coerce(values, prefix + "#" + str(index)) for index, values in enumerate(records)]
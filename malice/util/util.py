@@ -23,18 +23,19 @@
 # Python core libraries
 import json
 import os
+import sys
 import signal
 import contextlib
-import socket
-import string
-import random
 import datetime
-import uuid
-import configparser
-import subprocess
+import time
+import collections
+import collections.abc
+# socket, random, uuid, configparser and subprocess are imported where they are used:
+# this module is loaded on every malice invocation, including shell completion
 
 # Project specific libs
-from util.type_util import *
+from malice.util.type_util import *
+from malice.util import trace_util
 
 
 PATH_TYPE_UNIX = 1
@@ -221,19 +222,108 @@ def tcp_port_status(host, port):
     :return:        True if we successfully ping the server, False otherwise
     :rtype:         bool
     """
-    
-    s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-    s.settimeout(1)
+    import socket
+
+    with trace_util.span("util.tcp_port_status", host=host, port=port):
+        s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        s.settimeout(1)
+        try:
+            s.connect((host, int(port)))
+            s.shutdown(2)
+            return True
+        except Exception:
+            return False
+        finally:
+            s.close()
+
+
+PortStatus = collections.namedtuple("PortStatus", ("host", "port", "is_open", "latency", "error"))
+PortStatus.__doc__ = """Result of a tcp port check: latency is the connection time in seconds (None if closed),
+error is None if the port is open, "timeout" or the connection error otherwise"""
+
+
+async def tcp_port_status_async(host, port, timeout=1):
+    """
+    Ping a tcp port, asyncio version
+
+    :param host:        The hostname or ip of a distant machine
+    :type host:         str
+    :param port:        The port to ping
+    :type port:         int|str
+    :param timeout:     The connection timeout, in seconds. Optional, default 1
+    :type timeout:      float
+    :return:            The port status
+    :rtype:             PortStatus
+    """
+    import asyncio
+
+    if not ll_int(port) or not 0 < int(port) < 65536:
+        return PortStatus(host, port, False, None, "invalid port \"" + to_str(port) + "\"")
+    port = int(port)
+    start = time.monotonic()
     try:
-        s.connect((host, int(port)))
-        s.shutdown(2)
-        return True
-    except Exception:
-        return False
+        _, writer = await asyncio.wait_for(asyncio.open_connection(host, port), timeout)
+    except asyncio.TimeoutError:
+        return PortStatus(host, port, False, None, "timeout")
+    except (OSError, ValueError) as e:
+        return PortStatus(host, port, False, None, to_str(e) or e.__class__.__name__)
+    latency = time.monotonic() - start
+    writer.close()
+    return PortStatus(host, port, True, latency, None)
+
+
+def iter_as_completed(coroutines, max_concurrency):
+    """
+    Run coroutines on a new event loop, at most max_concurrency at a time, and yield their results as they complete.
+    The coroutines are taken lazily from the iterable. Stopping the iteration cancels the running ones.
+
+    :param coroutines:          The coroutines to run
+    :type coroutines:           collections.Iterable[collections.abc.Coroutine]
+    :param max_concurrency:     The maximum number of coroutines running at the same time
+    :type max_concurrency:      int
+    :return:                    The coroutine results, in completion order
+    :rtype:                     collections.Iterator[any]
+    """
+    import asyncio
+    import itertools
+
+    loop = asyncio.new_event_loop()
+    coroutines = iter(coroutines)
+    pending = set(loop.create_task(coroutine) for coroutine in itertools.islice(coroutines, max_concurrency))
+    try:
+        while pending:
+            done, pending = loop.run_until_complete(asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED))
+            for coroutine in itertools.islice(coroutines, len(done)):
+                pending.add(loop.create_task(coroutine))
+            for task in done:
+                yield task.result()
+    finally:
+        for task in pending:
+            task.cancel()
+        if pending:
+            loop.run_until_complete(asyncio.gather(*pending, return_exceptions=True))
+        loop.close()
+
+
+def tcp_ports_status(endpoints, timeout=1, max_connections=256):
+    """
+    Ping many tcp ports concurrently
+
+    :param endpoints:           The (host, port) couples to check
+    :type endpoints:            collections.Iterable[Tuple[str, int|str]]
+    :param timeout:             The connection timeout, in seconds. Optional, default 1
+    :type timeout:              float
+    :param max_connections:     The maximum number of connections in progress at the same time. Optional, default 256
+    :type max_connections:      int
+    :return:                    The port statuses, as soon as they are known
+    :rtype:                     collections.Iterator[PortStatus]
+    """
+    return iter_as_completed((tcp_port_status_async(host, port, timeout) for host, port in endpoints),
+                             max_connections)
 
 
 class SaltChars(object):
-    chars = string.ascii_letters + string.digits
+    chars = "abcdefghijklmnopqrstuvwxyzABCDEFGHIJKLMNOPQRSTUVWXYZ0123456789"
 
 
 def generate_salt(length=12):
@@ -245,23 +335,28 @@ def generate_salt(length=12):
     :return:            the generated salt
     :rtype:             str
     """
+    import random
+
     salt = ''
     for i in range(length):
         salt += SaltChars.chars[random.randint(0, len(SaltChars.chars) - 1)]
     return salt
 
 
-def write_conf(filename, data, section="Job"):
+def render_conf(data, section="Job"):
     """
-    Write a dictionary as config file> For complex objects, values are saved as json dump
+    Render a dictionary as a config file. For complex objects, values are saved as json dump
 
-    :param filename:    The config file name and path
-    :type filename:     str
     :param data:        The data to save
-    :type data:         dict[str, str]
+    :type data:         dict[str, any]
     :param section:     The config file main section. Optional, default "Job"
     :type section:      str
+    :return:            The config file content
+    :rtype:             str
     """
+    import io
+    import configparser
+
     conf = configparser.RawConfigParser()
 
     conf.add_section(section)
@@ -271,26 +366,489 @@ def write_conf(filename, data, section="Job"):
         else:
             conf.set(section, to_str(key), json.dumps(value))
 
-    with open(filename, 'wb') as configfile:
-        conf.write(configfile)
+    output = io.StringIO()
+    conf.write(output)
+    return output.getvalue()
 
 
-def load_ini_file(filename):
+def write_conf(filename, data, section="Job"):
+    """
+    Write a dictionary as config file> For complex objects, values are saved as json dump.
+    The file is left untouched if its content doesn't change
+
+    :param filename:    The config file name and path
+    :type filename:     str
+    :param data:        The data to save
+    :type data:         dict[str, str]
+    :param section:     The config file main section. Optional, default "Job"
+    :type section:      str
+    :return:            True if the file was written, False if it was already up to date
+    :rtype:             bool
+    """
+    return write_files({filename: render_conf(data, section)}).written == 1
+
+
+def write_confs(confs, section="Job", fsync=True):
+    """
+    Write many config files, see write_conf and write_files
+
+    :param confs:       The data to save, by file name
+    :type confs:        dict[str, dict[str, str]]
+    :param section:     The config files main section. Optional, default "Job"
+    :type section:      str
+    :param fsync:       Make the written files durable. Optional, default True
+    :type fsync:        bool
+    :return:            The number of written and skipped files
+    :rtype:             WriteStats
+    """
+    return write_files({filename: render_conf(data, section) for filename, data in confs.items()}, fsync)
+
+
+WriteStats = collections.namedtuple("WriteStats", ("written", "skipped"))
+WriteStats.__doc__ = """Result of write_files: the number of files written, and left untouched because up to date"""
+
+
+def _is_up_to_date(path, content):
+    try:
+        if os.stat(path).st_size != len(content):
+            return False
+        with open(path, "rb") as current_file:
+            return current_file.read() == content
+    except OSError:
+        return False
+
+
+def write_files(files, fsync=True):
+    """
+    Write files atomically (temporary file then rename), skipping the ones whose content is already right.
+    With fsync, the data of each written file is synced before its rename, and each directory is synced once,
+    after all its renames
+
+    :param files:       The files content, by path
+    :type files:        dict[str, str|bytes]
+    :param fsync:       Make the written files durable. Optional, default True
+    :type fsync:        bool
+    :return:            The number of written and skipped files
+    :rtype:             WriteStats
+    """
+    dirs = set()
+    written = 0
+    for path, content in files.items():
+        content = to_bytes(content)
+        if _is_up_to_date(path, content):
+            continue
+        directory = os.path.dirname(os.path.abspath(path))
+        os.makedirs(directory, exist_ok=True)
+        tmp_path = os.path.join(directory, "." + os.path.basename(path) + "." + str(os.getpid()) + ".tmp")
+        try:
+            with open(tmp_path, "wb") as tmp_file:
+                tmp_file.write(content)
+                if fsync:
+                    tmp_file.flush()
+                    os.fsync(tmp_file.fileno())
+            os.replace(tmp_path, path)
+        except BaseException:
+            if os.path.exists(tmp_path):
+                os.unlink(tmp_path)
+            raise
+        dirs.add(directory)
+        written += 1
+    if fsync:
+        for directory in dirs:
+            fd = os.open(directory, os.O_RDONLY)
+            try:
+                os.fsync(fd)
+            finally:
+                os.close(fd)
+    return WriteStats(written, len(files) - written)
+
+
+def get_user_cache_dir(*parts):
+    """
+    Get a path in the malice user cache directory ($XDG_CACHE_HOME/malice, ~/.cache/malice by default)
+
+    :param parts:   The path parts, relative to the cache directory
+    :type parts:    str
+    :return:        The absolute path
+    :rtype:         str
+    """
+    cache_dir = os.environ.get("XDG_CACHE_HOME") or os.path.join(os.path.expanduser("~"), ".cache")
+    return os.path.join(cache_dir, "malice", *parts)
+
+
+# Parsed ini files, by absolute path: (stat key, values)
+_ini_cache = {}
+_INI_CACHE_VERSION = 1
+
+
+def _get_ini_key(stat):
+    return stat.st_size, stat.st_mtime_ns, stat.st_ino, stat.st_dev
+
+
+def _parse_ini(filename):
+    import configparser
+
     conf = configparser.ConfigParser()
-    conf.read(filename)
+    with open(filename) as ini_file:
+        conf.read_file(ini_file, filename)
+    result = {conf.default_section: dict(conf.defaults())}
+    for section in conf.sections():
+        result[section] = dict(conf.items(section))
+    return result
+
+
+def _get_ini_cache_path(path):
+    import hashlib
+
+    return get_user_cache_dir("ini", hashlib.sha1(os.fsencode(path)).hexdigest() + ".bin")
+
+
+def _read_ini_cache(path, key):
+    """Read the compiled form of an ini file, None if it's missing or stale"""
+    import marshal
+
+    try:
+        with open(_get_ini_cache_path(path), "rb") as cache_file:
+            header, values = marshal.loads(cache_file.read())
+    except (OSError, EOFError, ValueError, TypeError):
+        return None
+    if header != (_INI_CACHE_VERSION, sys.hexversion, path) + key:
+        return None
+    return values
+
+
+def _write_ini_cache(path, key, values):
+    import marshal
+
+    cache_path = _get_ini_cache_path(path)
+    tmp_path = cache_path + "." + str(os.getpid()) + ".tmp"
+    try:
+        os.makedirs(os.path.dirname(cache_path), exist_ok=True)
+        with open(tmp_path, "wb") as cache_file:
+            cache_file.write(marshal.dumps(((_INI_CACHE_VERSION, sys.hexversion, path) + key, values)))
+        os.replace(tmp_path, cache_path)
+    except OSError:
+        pass  # Only slower next time
+
+
+def load_ini_values(filename, use_disk_cache=True):
+    """
+    Load an ini file as a dictionary of sections, with the defaults applied and the values interpolated
+    (like ConfigParser.items). The "DEFAULT" entry holds the defaults.
+    Parsed files are cached in memory, and in a compiled (marshal) form in the user cache directory: as long as the
+    size, modification time and inode of the file don't change, loading it costs a stat and a small read.
+    The result is shared: don't modify it
+
+    :param filename:        The ini file path
+    :type filename:         str
+    :param use_disk_cache:  Use the compiled form cache. Optional, default True
+    :type use_disk_cache:   bool
+    :return:                The values, by section and key
+    :rtype:                 dict[str, dict[str, str]]
+    """
+    path = os.path.abspath(filename)
+    key = _get_ini_key(os.stat(path))
+    cached = _ini_cache.get(path)
+    if cached is not None and cached[0] == key:
+        return cached[1]
+    values = _read_ini_cache(path, key) if use_disk_cache else None
+    if values is None:
+        values = _parse_ini(path)
+        if use_disk_cache:
+            _write_ini_cache(path, key, values)
+    _ini_cache[path] = (key, values)
+    return values
+
+
+def _parse_ini_files(paths):
+    return [_parse_ini(path) for path in paths]
+
+
+def load_ini_dir(directory, pattern="*.ini", max_workers=None):
+    """
+    Load all the ini files of a directory (see load_ini_values).
+    The files missing from the caches are parsed in parallel, in a process pool when there are many of them
+
+    :param directory:       The directory
+    :type directory:        str
+    :param pattern:         The file names to load (glob pattern). Optional, default "*.ini"
+    :type pattern:          str
+    :param max_workers:     The maximum number of processes. Optional, default the number of CPUs
+    :type max_workers:      int|None
+    :return:                The values of each file, by path, in name order
+    :rtype:                 collections.OrderedDict[str, dict[str, dict[str, str]]]
+    """
+    import fnmatch
+
+    directory = os.path.abspath(directory)
+    paths = sorted(entry.path for entry in os.scandir(directory) if fnmatch.fnmatch(entry.name, pattern)
+                   and entry.is_file())
+    result = collections.OrderedDict()
+    missing = []
+    for path in paths:
+        key = _get_ini_key(os.stat(path))
+        cached = _ini_cache.get(path)
+        values = cached[1] if cached is not None and cached[0] == key else _read_ini_cache(path, key)
+        if values is None:
+            missing.append((path, key))
+        else:
+            _ini_cache[path] = (key, values)
+        result[path] = values
+
+    max_workers = max_workers or os.cpu_count() or 1
+    if len(missing) >= 16 and max_workers > 1:
+        import concurrent.futures
+
+        # Parsing is CPU bound: processes, by batches to limit the pickling round trips
+        batch_size = max(1, len(missing) // (max_workers * 4))
+        batches = [[path for path, _ in missing[i:i + batch_size]] for i in range(0, len(missing), batch_size)]
+        with concurrent.futures.ProcessPoolExecutor(max_workers) as executor:
+            parsed = [values for batch in executor.map(_parse_ini_files, batches) for values in batch]
+    else:
+        parsed = _parse_ini_files([path for path, _ in missing])
+    for (path, key), values in zip(missing, parsed):
+        _write_ini_cache(path, key, values)
+        _ini_cache[path] = (key, values)
+        result[path] = values
+    return result
+
+
+def overlay_ini(layers):
+    """
+    Merge ini files values, the last layers overriding the first ones, without copying them
+
+    :param layers:      The values of each file, ex: from load_ini_values
+    :type layers:       list[dict[str, dict[str, str]]]
+    :return:            The merged values, by section (each one a read through view of the layers)
+    :rtype:             dict[str, collections.ChainMap]
+    """
+    sections = collections.OrderedDict()
+    for layer in reversed(layers):
+        for section, values in layer.items():
+            sections.setdefault(section, []).append(values)
+    return {section: collections.ChainMap(*maps) for section, maps in sections.items()}
+
+
+def load_ini_file(filename):
+    """
+    Load an ini file. The values are read through the cache of load_ini_values, and already interpolated
+
+    :param filename:    The ini file path
+    :type filename:     str
+    :return:            The parsed file, an empty one if it doesn't exist
+    :rtype:             configparser.ConfigParser
+    """
+    import configparser
+
+    conf = configparser.ConfigParser(interpolation=None)
+    try:
+        values = load_ini_values(filename)
+    except FileNotFoundError:
+        return conf
+    conf.read_dict(values)
     return conf
 
 
 def compute_variance(data):
-    y_squared_dot = sum(i * i for i in data)
-    y_dot_squared = sum(data) ** 2
-    return (y_squared_dot - y_dot_squared / len(data)) / (len(data) - 1)
+    """
+    Compute the sample variance of values, in one pass (see stats_util.RunningStats)
 
+    :param data:    The values, at least two
+    :type data:     collections.Iterable[float]
+    :return:        The sample variance
+    :rtype:         float
+    """
+    from malice.util.stats_util import RunningStats
+
+    variance = RunningStats().extend(data).variance
+    if variance is None:
+        raise ZeroDivisionError("The variance needs at least two values")
+    return variance
+
+
+# Conversion of the types json doesn't know, by type: resolved once per type (see _get_json_cast)
+_json_casts = {}
+_json_encoder = None
+_orjson = None
+_JSON_LEAF_TYPES = (str, int, float)  # And bool, an int
+
+
+def _dt_to_json(val):
+    return dt_to_timestamp(val)
+
+
+def _get_json_cast(cls):
+    import uuid
+
+    if issubclass(cls, collections.abc.Mapping):
+        cast = dict
+    elif issubclass(cls, datetime.datetime):
+        cast = _dt_to_json
+    elif issubclass(cls, uuid.UUID):
+        cast = to_str
+    elif issubclass(cls, collections.abc.Iterable) and not issubclass(cls, (str, bytes)):
+        cast = list
+    else:
+        cast = to_str
+    _json_casts[cls] = cast
+    return cast
+
+
+def _json_default(val):
+    """
+    Called by the json encoder for the values it doesn't know. Only the value itself is converted (a mapping to a
+    dict, an iterable to a list...): the encoder then goes on with its items, no copy of the whole graph is made
+    """
+    cast = _json_casts.get(type(val))
+    if cast is None:
+        cast = _get_json_cast(type(val))
+    return cast(val)
+
+
+def _get_json_encoder():
+    global _json_encoder
+    if _json_encoder is None:
+        _json_encoder = json.JSONEncoder(default=_json_default)
+    return _json_encoder
+
+
+def _get_orjson():
+    """:return: The orjson module if it's installed, None otherwise"""
+    global _orjson
+    if _orjson is None:
+        try:
+            import orjson
+            _orjson = orjson
+        except ImportError:
+            _orjson = False
+    return _orjson or None
 
-def json_encode(val):
+
+def _orjson_dumps(val):
+    orjson = _get_orjson()
+    return orjson.dumps(val, default=_json_default,
+                        option=orjson.OPT_NON_STR_KEYS | orjson.OPT_PASSTHROUGH_DATETIME)
+
+
+def json_encode(val, accelerated=False):
+    """
+    Encode a value as json, converting what json doesn't support like cast_for_json, in a single pass
+
+    :param val:             The value to encode
+    :type val:              any
+    :param accelerated:     Use orjson if it's installed. Its output differs: compact, datetime keys as ISO strings
+                            instead of timestamps, NaN and infinities as null. Optional, default False
+    :type accelerated:      bool
+    :return:                The json string, None if val is None
+    :rtype:                 str|None
+    """
     if val is None:
         return None
-    return json.dumps(cast_for_json(val))
+    if accelerated and _get_orjson():
+        try:
+            return _orjson_dumps(val).decode("utf-8")
+        except TypeError:
+            pass  # Unsupported by orjson, ex: too large integers
+    try:
+        return _get_json_encoder().encode(val)
+    except TypeError:
+        return json.dumps(cast_for_json(val))  # Keys json can't encode, ex: uuid keys
+
+
+def _encode_json_float(val):
+    if val != val:
+        return "NaN"
+    if val == float("inf"):
+        return "Infinity"
+    if val == float("-inf"):
+        return "-Infinity"
+    return float.__repr__(val)
+
+
+def _encode_json_leaf(val):
+    """Encode a str, int, float, bool or None like the standard encoder"""
+    if isinstance(val, str):
+        return json.encoder.encode_basestring_ascii(val)
+    if val is None:
+        return "null"
+    if val is True:
+        return "true"
+    if val is False:
+        return "false"
+    if isinstance(val, int):
+        return int.__repr__(val)
+    return _encode_json_float(val)
+
+
+def _encode_json_key(key):
+    """Encode a mapping key like the standard encoder does, after cast_for_json"""
+    if isinstance(key, str):
+        return json.encoder.encode_basestring_ascii(key)
+    if key is None or isinstance(key, (int, float)):
+        return json.encoder.encode_basestring_ascii(_encode_json_leaf(key))
+    cast = cast_for_json(key)
+    if cast is None or isinstance(cast, (str, int, float)):
+        return _encode_json_key(cast)
+    return json.encoder.encode_basestring_ascii(to_str(key))
+
+
+def _iter_json(val):
+    """Encode a value like json_encode, by pieces: containers are walked, never encoded (nor copied) at once"""
+    if val is None or isinstance(val, _JSON_LEAF_TYPES):
+        yield _encode_json_leaf(val)
+    elif isinstance(val, dict):
+        separator = "{"
+        for key, item in val.items():
+            if item is None or isinstance(item, _JSON_LEAF_TYPES):
+                yield separator + _encode_json_key(key) + ": " + _encode_json_leaf(item)
+            else:
+                yield separator + _encode_json_key(key) + ": "
+                yield from _iter_json(item)
+            separator = ", "
+        yield "{}" if separator == "{" else "}"
+    elif isinstance(val, (list, tuple)):
+        separator = "["
+        for item in val:
+            if item is None or isinstance(item, _JSON_LEAF_TYPES):
+                yield separator + _encode_json_leaf(item)
+            else:
+                yield separator
+                yield from _iter_json(item)
+            separator = ", "
+        yield "[]" if separator == "[" else "]"
+    else:
+        yield from _iter_json(_json_default(val))
+
+
+def json_dump(val, output, chunk_size=65536, accelerated=False):
+    """
+    Encode a value as json into a file, like json_encode, streaming: the whole document is never built in memory
+
+    :param val:             The value to encode
+    :type val:              any
+    :param output:          The text output
+    :type output:           io.TextIOBase
+    :param chunk_size:      The approximate size of each write. Optional, default 64 KiB
+    :type chunk_size:       int
+    :param accelerated:     Use orjson if it's installed, see json_encode. It can't stream: the document is built
+                            in memory, then written by chunks. Optional, default False
+    :type accelerated:      bool
+    """
+    if accelerated and _get_orjson():
+        data = json_encode(val, accelerated)
+        for start in range(0, len(data), chunk_size):
+            output.write(data[start:start + chunk_size])
+        return
+    pieces = []
+    size = 0
+    for piece in _iter_json(val):
+        pieces.append(piece)
+        size += len(piece)
+        if size >= chunk_size:
+            output.write("".join(pieces))
+            pieces = []
+            size = 0
+    output.write("".join(pieces))
 
 
 def dt_to_timestamp(dt, default=None):
@@ -311,13 +869,15 @@ def dt_to_timestamp(dt, default=None):
 
 
 def cast_for_json(val):
+    import uuid
+
     if val is None:
         return None
     if is_primitive(val):
         return val
-    if isinstance(val, collections.Mapping):
+    if isinstance(val, collections.abc.Mapping):
         return {cast_for_json(key): cast_for_json(subval) for key, subval in val.items()}
-    elif isinstance(val, collections.Iterable):
+    elif isinstance(val, collections.abc.Iterable):
         return [cast_for_json(subval) for subval in val]
     elif isinstance(val, datetime.datetime):
         return dt_to_timestamp(val)
@@ -346,6 +906,8 @@ def is_json(var):
 
 
 def log_error(log, e):
+    import subprocess
+
     log.exception(e)
     if isinstance(e, subprocess.CalledProcessError) and e.output:
         log.error("Output:  \n"+to_str(e.output).strip())
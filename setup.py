@@ -24,6 +24,7 @@ setuptools.setup(
     url="https://github.com/SamuelDeal/malice",
     packages=setuptools.find_packages(),
     install_requires=requirements,
+    python_requires=">=3.7",
     entry_points={"console_scripts": ["malice = malice:main"]},
     classifiers=[
         "Development Status :: 1 - Planning",
@@ -39,9 +40,7 @@ setuptools.setup(
         "Operating System :: OS Independent",
         "Programming Language :: Python",
         "Programming Language :: Python :: 3",
-        "Programming Language :: Python :: 3.4",
-        "Programming Language :: Python :: 3.5",
-        "Programming Language :: Python :: 3.6",
+        "Programming Language :: Python :: 3.7",
         "Topic :: Software Development",
         "Topic :: Software Development :: Build Tools",
         "Topic :: Software Development :: Libraries",
@@ -0,0 +1,70 @@
+# -*- coding: utf-8 -*-
+# vim: set fileencoding=utf-8:tabstop=4:softtabstop=4:shiftwidth=4:expandtab:textwidth=120
+
+"""
+    Copyright 2019 Samuel Déal
+
+    This file is part of Malice.
+
+    Malice is free software: you can redistribute it and/or modify
+    it under the terms of the GNU General Public License as published by
+    the Free Software Foundation, either version 3 of the License, or
+    (at your option) any later version.
+
+    This program is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU General Public License for more details.
+
+    You should have received a copy of the GNU General Public License
+    along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+    Configuration lookup: dev start --watch compares the configuration path with the paths the watcher reports
+"""
+
+# Python core libraries
+import os
+import shutil
+import tempfile
+import unittest
+
+# Project specific libs
+import malice.core.config
+from malice.util import fs_util
+
+
+class FindPathTest(unittest.TestCase):
+    def setUp(self):
+        self.base_dir = os.path.realpath(tempfile.mkdtemp())
+        self.work_dir = os.path.join(self.base_dir, "work")
+        os.mkdir(self.work_dir)
+        self.config_path = os.path.join(self.base_dir, "malice.ini")
+        with open(self.config_path, "w") as config_file:
+            config_file.write("[malice]\n")
+
+    def tearDown(self):
+        malice.core.config.set_path(None)
+        shutil.rmtree(self.base_dir)
+
+    def test_relative_paths_are_normalized(self):
+        for path in ("../malice.ini", "./../malice.ini", "../work/../malice.ini"):
+            self.assertEqual(malice.core.config.find_path(path, self.work_dir), self.config_path)
+        self.assertEqual(malice.core.config.find_path(None, self.work_dir, {"MALICE_CONFIG": "../malice.ini"}),
+                         self.config_path)
+
+    def test_relative_command_line_path(self):
+        malice.core.config.set_path("./../malice.ini")  # As given by -c
+        self.assertEqual(malice.core.config.find_path(cwd=self.work_dir), self.config_path)
+
+    def test_watcher_reports_the_config_path(self):
+        malice.core.config.set_path("../malice.ini")
+        config_path = malice.core.config.find_path(cwd=self.work_dir)
+        with fs_util.TreeWatcher([config_path], poll_interval=0.05) as watcher:
+            with open(config_path, "a") as config_file:
+                config_file.write("[vars]\nchanged = 1\n")
+            changed = watcher.wait(timeout=5, debounce=0.05)
+        self.assertIn(config_path, changed)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,85 @@
+# -*- coding: utf-8 -*-
+# vim: set fileencoding=utf-8:tabstop=4:softtabstop=4:shiftwidth=4:expandtab:textwidth=120
+
+"""
+    Copyright 2019 Samuel Déal
+
+    This file is part of Malice.
+
+    Malice is free software: you can redistribute it and/or modify
+    it under the terms of the GNU General Public License as published by
+    the Free Software Foundation, either version 3 of the License, or
+    (at your option) any later version.
+
+    This program is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU General Public License for more details.
+
+    You should have received a copy of the GNU General Public License
+    along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+    Cold start budget: the entry point runs on every invocation and every shell completion request.
+    Each test runs a fresh interpreter, so that nothing imported by the test runner hides a regression.
+"""
+
+# Python core libraries
+import os
+import sys
+import unittest
+import subprocess
+
+
+PROJECT_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+# Cumulative import time of malice.malice, in microseconds. About 7 ms on a laptop: the margin absorbs slow machines,
+# not new imports
+IMPORT_BUDGET_US = 25000
+# Must not be loaded by the entry point before a command is dispatched
+FORBIDDEN_MODULES = ("argparse", "socket", "subprocess", "json", "malice.daemon", "malice.core")
+
+
+def _run_python(code, **env):
+    full_env = dict(os.environ, PYTHONPATH=PROJECT_DIR, MALICE_SOCKET=os.path.join(PROJECT_DIR, "no-such.sock"))
+    full_env.update(env)
+    full_env.pop("_ARGCOMPLETE", None)
+    return subprocess.run([sys.executable] + list(code), env=full_env, cwd=PROJECT_DIR, stdout=subprocess.PIPE,
+                          stderr=subprocess.PIPE, universal_newlines=True, check=True)
+
+
+def _get_loaded(modules):
+    return [name for name in modules if name in FORBIDDEN_MODULES or name.startswith("malice.core.")]
+
+
+class StartupTest(unittest.TestCase):
+    def test_import_time(self):
+        best = None
+        for _ in range(3):  # The best of a few runs: the others measure the machine load
+            stderr = _run_python(["-X", "importtime", "-c", "import malice.malice"]).stderr
+            for line in stderr.splitlines():
+                parts = line.split("|")
+                if len(parts) == 3 and parts[2].strip() == "malice.malice":
+                    cumulative = int(parts[1])
+                    best = cumulative if best is None else min(best, cumulative)
+        self.assertIsNotNone(best, "malice.malice import time not found")
+        self.assertLess(best, IMPORT_BUDGET_US, "import malice.malice took " + str(best) + " us")
+
+    def test_import_is_lazy(self):
+        stdout = _run_python(["-c", "import sys, malice.malice; print(' '.join(sys.modules))"]).stdout
+        self.assertEqual(_get_loaded(stdout.split()), [])
+
+    def test_no_daemon_import_without_socket(self):
+        code = "import sys, malice.malice\n" \
+               "sys.argv = ['malice', '--help']\n" \
+               "try:\n" \
+               "    malice.malice.main()\n" \
+               "except SystemExit:\n" \
+               "    pass\n" \
+               "sys.stderr.write(' '.join(sys.modules))\n"
+        for env in ({}, {"MALICE_DAEMON": "off"}):
+            loaded = _run_python(["-c", code], **env).stderr.split()
+            self.assertNotIn("malice.daemon", loaded)
+            self.assertNotIn("socket", loaded)
+
+
+if __name__ == '__main__':
+    unittest.main()